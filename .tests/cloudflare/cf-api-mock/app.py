@@ -6,7 +6,8 @@ official `cloudflare` SDK is pointed here via CLOUDFLARE_API_URL):
 
   GET    /user/tokens/verify   -> active token
   GET    /zones                -> one active zone (only hit if no CLOUDFLARE_ZONE_ID)
-  GET    /certificates         -> [] (forces a fresh generation)
+  GET    /certificates         -> the certificates signed so far (none at start, which
+                                  forces a fresh generation)
   POST   /certificates         -> SIGNS the submitted CSR with a mock Origin CA and
                                   echoes the CSR back verbatim (the job verifies the
                                   returned csr == the one it sent)
@@ -14,13 +15,27 @@ official `cloudflare` SDK is pointed here via CLOUDFLARE_API_URL):
   DELETE /certificates/<id>    -> revoke
   GET    /aop-ca.pem           -> the mock CA in PEM (Authenticated Origin Pull CA)
 
+and the account IP List surface used by the edge ban sync:
+
+  GET    /accounts/<acc>/rules/lists                    -> the lists
+  POST   /accounts/<acc>/rules/lists                    -> create a list
+  GET    /accounts/<acc>/rules/lists/<id>/items         -> the list items
+  POST   /accounts/<acc>/rules/lists/<id>/items         -> async add, returns an operation_id
+  DELETE /accounts/<acc>/rules/lists/<id>/items         -> async delete, returns an operation_id
+  GET    /accounts/<acc>/rules/lists/bulk_operations/<op> -> "pending" on the first poll,
+                                                         then "completed" (changes applied)
+
+Set MOCK_RATE_LIMIT_EVERY=N to answer every Nth list write with a 429 and
+Retry-After: 1, like Cloudflare's API rate limit.
+
 Each request is logged to stdout so the test can assert the plugin reached the mock.
 """
 
 import json
+from os import getenv
 from datetime import datetime, timedelta, timezone
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
-from urllib.parse import urlparse
+from urllib.parse import parse_qs, urlparse
 
 from cryptography import x509
 from cryptography.hazmat.primitives import hashes, serialization
@@ -46,6 +61,10 @@ _ca_cert = (
 _CA_PEM = _ca_cert.public_bytes(serialization.Encoding.PEM)
 
 _certs = {}
+_lists = {}
+_operations = {}
+_writes = 0
+RATE_LIMIT_EVERY = int(getenv("MOCK_RATE_LIMIT_EVERY", "0"))
 
 
 def sign_csr(csr_pem: str) -> str:
@@ -71,6 +90,21 @@ def envelope(result):
     return {"success": True, "errors": [], "messages": [], "result": result}
 
 
+def list_route(path: str):
+    """Split ``/accounts/<acc>/rules/lists[/...]`` into the parts after ``lists``, else None."""
+    parts = path.strip("/").split("/")
+    if len(parts) < 4 or parts[0] != "accounts" or parts[2:4] != ["rules", "lists"]:
+        return None
+    return parts[4:]
+
+
+def queue_operation(apply) -> dict:
+    """Record an async list operation, applied on its first "completed" poll."""
+    op_id = f"op-mock-{len(_operations) + 1}"
+    _operations[op_id] = {"apply": apply, "polls": 0}
+    return {"operation_id": op_id}
+
+
 class Handler(BaseHTTPRequestHandler):
     def log_message(self, format, *args):  # noqa: A002
         print(f"MOCK {self.command} {self.path}", flush=True)
@@ -93,33 +127,113 @@ class Handler(BaseHTTPRequestHandler):
     def _not_found(self):
         self._send(404, {"success": False, "errors": [{"code": 1, "message": "not found"}], "messages": [], "result": None})
 
+    def _rate_limited(self) -> bool:
+        global _writes
+        _writes += 1
+        if not RATE_LIMIT_EVERY or _writes % RATE_LIMIT_EVERY:
+            return False
+        body = json.dumps(
+            {"success": False, "errors": [{"code": 971, "message": "Please wait and consider throttling your request speed"}], "messages": [], "result": None}
+        ).encode()
+        self.send_response(429)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(body)
+        return True
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", "0"))
+        try:
+            return json.loads(self.rfile.read(length) or b"{}") if length else {}
+        except Exception:
+            return {}
+
+    def _get_list(self, route):
+        if not route:
+            lists = [{k: v for k, v in lst.items() if k != "items"} for lst in _lists.values()]
+            return self._send(200, envelope(lists))
+        if route[0] == "bulk_operations" and len(route) == 2:
+            op = _operations.get(route[1])
+            if not op:
+                return self._not_found()
+            op["polls"] += 1
+            if op["polls"] == 1:
+                return self._send(200, envelope({"id": route[1], "status": "pending"}))
+            if op["apply"]:
+                op["apply"]()
+                op["apply"] = None
+            return self._send(200, envelope({"id": route[1], "status": "completed", "completed": _NOW.isoformat()}))
+        lst = _lists.get(route[0])
+        if not lst:
+            return self._not_found()
+        if route[1:] == ["items"]:
+            obj = envelope(list(lst["items"].values()))
+            obj["result_info"] = {"cursors": {}}
+            return self._send(200, obj)
+        return self._not_found()
+
+    def _write_list(self, route, body):
+        if not route and self.command == "POST":
+            list_id = f"list-mock-{len(_lists) + 1}"
+            _lists[list_id] = {"id": list_id, "name": body.get("name", ""), "kind": body.get("kind", "ip"), "num_items": 0, "items": {}}
+            return self._send(200, envelope({k: v for k, v in _lists[list_id].items() if k != "items"}))
+        lst = _lists.get(route[0])
+        if not lst or route[1:] != ["items"]:
+            return self._not_found()
+        if self._rate_limited():
+            return None
+        items = lst["items"]
+        if self.command == "POST":
+
+            def apply():
+                for entry in body if isinstance(body, list) else []:
+                    ip = entry.get("ip")
+                    if ip and not any(item["ip"] == ip for item in items.values()):
+                        item_id = f"item-mock-{ip}"
+                        items[item_id] = {"id": item_id, "ip": ip}
+
+        else:
+
+            def apply():
+                for entry in body.get("items", []) if isinstance(body, dict) else []:
+                    items.pop(entry.get("id"), None)
+
+        return self._send(200, envelope(queue_operation(apply)))
+
     def do_GET(self):
         path = urlparse(self.path).path
         if path == "/user/tokens/verify":
             return self._send(200, envelope({"id": "mock-token", "status": "active"}))
         if path == "/aop-ca.pem":
             return self._send_raw(200, _CA_PEM, "application/x-pem-file")
+        # The SDK paginates until it gets an empty page: only page 1 carries results.
+        first_page = parse_qs(urlparse(self.path).query).get("page", ["1"])[0] == "1"
         if path == "/zones":
             zone = {"id": "zone-mock-123", "name": "example.com", "status": "active", "type": "full", "modified_on": "2025-01-01T00:00:00Z"}
-            obj = envelope([zone])
+            obj = envelope([zone] if first_page else [])
             obj["result_info"] = {"page": 1, "per_page": 25, "count": 1, "total_count": 1}
             return self._send(200, obj)
         if path == "/certificates":
-            obj = envelope([])
-            obj["result_info"] = {"page": 1, "per_page": 25, "count": 0, "total_count": 0}
+            certs = list(_certs.values()) if first_page else []
+            obj = envelope(certs)
+            obj["result_info"] = {"page": 1, "per_page": 25, "count": len(certs), "total_count": len(_certs)}
             return self._send(200, obj)
         if path.startswith("/certificates/"):
             cert = _certs.get(path.rsplit("/", 1)[-1])
             return self._send(200, envelope(cert)) if cert else self._not_found()
+        route = list_route(path)
+        if route is not None:
+            return self._get_list(route)
         return self._not_found()
 
     def do_POST(self):
         path = urlparse(self.path).path
-        length = int(self.headers.get("Content-Length", "0"))
-        try:
-            body = json.loads(self.rfile.read(length) or b"{}") if length else {}
-        except Exception:
-            body = {}
+        body = self._read_json()
+        route = list_route(path)
+        if route is not None:
+            return self._write_list(route, body)
         if path == "/certificates":
             csr = body.get("csr", "")
             cert_id = f"cert-mock-{len(_certs) + 1}"
@@ -142,6 +256,9 @@ class Handler(BaseHTTPRequestHandler):
             cert_id = path.rsplit("/", 1)[-1]
             _certs.pop(cert_id, None)
             return self._send(200, envelope({"id": cert_id}))
+        route = list_route(path)
+        if route is not None:
+            return self._write_list(route, self._read_json())
         return self._not_found()
 
 
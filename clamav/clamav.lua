@@ -1,5 +1,6 @@
 local clamav_helpers = require("clamav.clamav_helpers")
 local class = require("middleclass")
+local journal = require("clamav.journal")
 local plugin = require("bunkerweb.plugin")
 local sha512 = require("resty.sha512")
 local str = require("resty.string")
@@ -10,17 +11,54 @@ local clamav = class("clamav", plugin)
 
 local ngx = ngx
 local NOTICE = ngx.NOTICE
+local WARN = ngx.WARN
 local ERR = ngx.ERR
 local socket = ngx.socket
+local worker = ngx.worker
+local ngx_timer = ngx.timer
 local HTTP_INTERNAL_SERVER_ERROR = ngx.HTTP_INTERNAL_SERVER_ERROR
 local HTTP_OK = ngx.HTTP_OK
+local now = ngx.now
+local sleep = ngx.sleep
 local to_hex = str.to_hex
 local has_variable = utils.has_variable
 local get_deny_status = utils.get_deny_status
 local tonumber = tonumber
+local tostring = tostring
+local ipairs = ipairs
+local concat = table.concat
 -- The big-endian INSTREAM length prefix lives in clamav/clamav_helpers.lua so it
 -- can be unit-tested with busted outside OpenResty (see spec/clamav_helpers_spec.lua).
 local stream_size = clamav_helpers.stream_size
+local frames = clamav_helpers.frames
+local session_reply = clamav_helpers.session_reply
+local session_reusable = clamav_helpers.session_reusable
+local parse_backends = clamav_helpers.parse_backends
+local pick_backend = clamav_helpers.pick_backend
+local signature_version = clamav_helpers.signature_version
+local cache_key = clamav_helpers.cache_key
+local verdict_ttl = clamav_helpers.verdict_ttl
+local cap_chunk = clamav_helpers.cap_chunk
+local journal_key = clamav_helpers.journal_key
+
+-- Persistent cache of the verdicts (see clamav/journal.lua), flushed every JOURNAL_INTERVAL
+-- seconds and holding up to CLAMAV_PERSISTENT_CACHE_SIZE of them.
+local JOURNAL = "/var/cache/bunkerweb/clamav_verdicts.journal"
+local JOURNAL_INTERVAL = 5
+-- Per-worker journal of the persistent cache, built again only when
+-- CLAMAV_PERSISTENT_CACHE_SIZE changes.
+local journal_size_setting = nil
+local persistent_cache = nil
+
+-- Per-worker backend state : the parsed CLAMAV_HOST list (parsed again when the setting
+-- changes), scans in flight and consecutive connect failures per backend id, and the
+-- turn used to spread the load. Which backends are down is shared by every worker
+-- through the datastore (see mark_down).
+local backends_setting = nil
+local backends = {}
+local inflight = {}
+local failures = {}
+local turn = 0
 
 local read_all = function(form)
 	while true do
@@ -34,9 +72,48 @@ local read_all = function(form)
 	end
 end
 
+local function health_check_timer(premature, self)
+	if premature then
+		return
+	end
+	self:health_check()
+end
+
+-- Also runs (prematurely) when the worker exits, to write what is still queued.
+local function journal_timer(_, self)
+	self.journal:flush()
+end
+
 function clamav:initialize(ctx)
 	-- Call parent initialize
 	plugin.initialize(self, "clamav", ctx)
+	if self.variables["CLAMAV_PERSISTENT_CACHE"] == "yes" then
+		local size = self.variables["CLAMAV_PERSISTENT_CACHE_SIZE"]
+		if not persistent_cache or size ~= journal_size_setting then
+			journal_size_setting = size
+			persistent_cache =
+				journal.new(self.datastore, self.logger, JOURNAL, "plugin_clamav", tonumber(size) or 10000)
+		end
+		self.journal = persistent_cache
+	end
+end
+
+function clamav:init()
+	-- Check if init is needed
+	local init_needed, err = has_variable("USE_CLAMAV", "yes")
+	if init_needed == nil then
+		return self:ret(false, "can't check USE_CLAMAV variable : " .. err)
+	end
+	if not init_needed or self.variables["CLAMAV_PERSISTENT_CACHE"] ~= "yes" then
+		return self:ret(true, "init not needed")
+	end
+	-- Load the persistent cache into the datastore
+	local loaded
+	loaded, err = self.journal:load()
+	if not loaded then
+		return self:ret(false, "can't load ClamAV persistent cache into datastore : " .. err)
+	end
+	return self:ret(true, "loaded " .. tostring(loaded) .. " verdict(s) from the ClamAV persistent cache")
 end
 
 function clamav:init_worker()
@@ -48,22 +125,31 @@ function clamav:init_worker()
 	if not init_needed or self.is_loading then
 		return self:ret(true, "init_worker not needed")
 	end
-	-- Send PING to ClamAV
-	local ok, data = self:command("PING")
-	if not ok then
-		return self:ret(false, "connectivity with ClamAV failed : " .. data)
-	end
-	if data ~= "PONG" then
-		return self:ret(false, "wrong data received from ClamAV : " .. data)
-	end
-	self.logger:log(
-		NOTICE,
-		"connectivity with "
-			.. self.variables["CLAMAV_HOST"]
-			.. ":"
-			.. self.variables["CLAMAV_PORT"]
-			.. " is successful"
-	)
+	-- Health checks are shared through the datastore : one worker runs them for all.
+	if worker.id() ~= 0 then
+		return self:ret(true, "ClamAV health checks run in worker 0")
+	end
+	local interval = tonumber(self.variables["CLAMAV_HEALTH_CHECK_INTERVAL"]) or 0
+	if interval > 0 then
+		local ok
+		ok, err = ngx_timer.every(interval, health_check_timer, self)
+		if not ok then
+			return self:ret(false, "can't create the ClamAV health check timer : " .. err)
+		end
+	end
+	if self.journal then
+		local ok
+		ok, err = ngx_timer.every(JOURNAL_INTERVAL, journal_timer, self)
+		if not ok then
+			return self:ret(false, "can't create the ClamAV persistent cache timer : " .. err)
+		end
+	end
+	-- Send PING to every ClamAV backend
+	local up, errors = self:health_check()
+	if up == 0 then
+		return self:ret(false, "connectivity with ClamAV failed : " .. concat(errors, ", "))
+	end
+	self.logger:log(NOTICE, "connectivity with " .. tostring(up) .. " ClamAV backend(s) is successful")
 	return self:ret(true, "success")
 end
 
@@ -85,14 +171,31 @@ function clamav:access()
 	end
 
 	-- Check files
-	local ok, detected, checksum = self:scan()
+	local ok, detected, checksum, id = self:scan()
+	self:leave_backend()
 	if not ok then
+		if self.variables["CLAMAV_FAIL_MODE"] == "closed" then
+			self.logger:log(ERR, "error while scanning file(s) : " .. detected)
+			return self:ret(true, "file(s) could not be scanned, denying request", get_deny_status())
+		end
 		return self:ret(false, "error while scanning file(s) : " .. detected)
 	end
+	-- Oversize files (CLAMAV_OVERSIZE_POLICY=deny) are denied without being scanned.
+	if id == "oversize" then
+		return self:ret(true, detected, get_deny_status(), nil, {
+			id = "oversize",
+			max_size = tonumber(self.variables["CLAMAV_MAX_SCAN_SIZE"]),
+		})
+	end
 	if detected then
+		-- A prefix scan (CLAMAV_OVERSIZE_POLICY=prefix) has no checksum of the whole file.
+		local reason = "file is detected : " .. detected
+		if checksum then
+			reason = "file with checksum " .. checksum .. " is detected : " .. detected
+		end
 		return self:ret(
 			true,
-			"file with checksum " .. checksum .. "is detected : " .. detected,
+			reason,
 			get_deny_status(),
 			nil,
 			{
@@ -105,9 +208,9 @@ function clamav:access()
 	return self:ret(true, "no file detected")
 end
 
-function clamav:command(cmd)
+function clamav:command(cmd, backend)
 	-- Get socket
-	local clamav_socket, err = self:socket()
+	local clamav_socket, err = self:connect(backend)
 	if not clamav_socket then
 		return false, err
 	end
@@ -129,36 +232,299 @@ function clamav:command(cmd)
 	return true, data
 end
 
-function clamav:socket()
+-- PING every backend, closing its circuit breaker when it answers and opening it when it
+-- doesn't. Returns the number of backends up and the list of failures.
+function clamav:health_check()
+	local up = 0
+	local errors = {}
+	local version = nil
+	for _, backend in ipairs(self:get_backends()) do
+		local ok, data = self:command("PING", backend)
+		if ok and data ~= "PONG" then
+			ok, data = false, "wrong data received : " .. data
+		end
+		if ok then
+			up = up + 1
+			failures[backend.id] = 0
+			self.datastore:delete("plugin_clamav_down_" .. backend.id)
+			-- Newest signature database among the backends up
+			local got, reply = self:command("VERSION", backend)
+			local backend_version = got and signature_version(reply)
+			if backend_version and (not version or backend_version > version) then
+				version = backend_version
+			end
+		else
+			errors[#errors + 1] = backend.id .. " : " .. data
+			self:mark_down(backend, data)
+		end
+	end
+	if version then
+		self:set_version(version)
+	end
+	return up, errors
+end
+
+-- Store the signature version scan verdicts are cached under : once it changes, the
+-- verdicts of the previous databases are no longer looked up and just expire.
+function clamav:set_version(version)
+	local current = self.datastore:get("plugin_clamav_version")
+	if current == version then
+		return
+	end
+	local ok, err = self.datastore:set("plugin_clamav_version", version)
+	if not ok then
+		self.logger:log(ERR, "can't store ClamAV signature version into datastore : " .. err)
+		return
+	end
+	if current then
+		self.logger:log(
+			NOTICE,
+			"ClamAV signatures updated from version "
+				.. tostring(current)
+				.. " to "
+				.. tostring(version)
+				.. ", previous scan results won't be used anymore"
+		)
+	end
+end
+
+function clamav:get_backends()
+	local hosts = self.variables["CLAMAV_HOST"]
+	if hosts ~= backends_setting then
+		backends_setting = hosts
+		backends = parse_backends(hosts, self.variables["CLAMAV_PORT"])
+	end
+	return backends
+end
+
+-- Open the circuit breaker of a backend : every worker skips it for CLAMAV_BREAKER_COOLDOWN
+-- seconds, or until a health check finds it up again, instead of waiting on its timeouts.
+function clamav:mark_down(backend, reason)
+	local ok, err = self.datastore:set(
+		"plugin_clamav_down_" .. backend.id,
+		reason,
+		tonumber(self.variables["CLAMAV_BREAKER_COOLDOWN"]) or 30
+	)
+	if not ok then
+		self.logger:log(ERR, "can't store ClamAV backend state into datastore : " .. err)
+	end
+	self.logger:log(WARN, "ClamAV backend " .. backend.id .. " marked down : " .. reason)
+end
+
+-- Open a socket to the backend picked by CLAMAV_BALANCE for a scan. A backend that fails
+-- to connect is skipped for the rest of the call and, after CLAMAV_BREAKER_THRESHOLD
+-- failures in a row, marked down. The scan holds its backend until leave_backend().
+function clamav:socket(session)
+	self:leave_backend()
+	local list = self:get_backends()
+	local down = {}
+	for _, backend in ipairs(list) do
+		if self.datastore:get("plugin_clamav_down_" .. backend.id) then
+			down[backend.id] = true
+		end
+	end
+	local err = "no ClamAV backend available"
+	while true do
+		local backend = pick_backend(list, down, inflight, self.variables["CLAMAV_BALANCE"], turn)
+		if not backend then
+			return false, err
+		end
+		turn = turn + 1
+		local tcp_socket
+		tcp_socket, err = self:connect(backend, session)
+		if tcp_socket then
+			failures[backend.id] = 0
+			inflight[backend.id] = (inflight[backend.id] or 0) + 1
+			self.backend = backend
+			return tcp_socket
+		end
+		err = backend.id .. " : " .. err
+		down[backend.id] = true
+		failures[backend.id] = (failures[backend.id] or 0) + 1
+		if failures[backend.id] >= (tonumber(self.variables["CLAMAV_BREAKER_THRESHOLD"]) or 3) then
+			failures[backend.id] = 0
+			self:mark_down(backend, err)
+		end
+	end
+end
+
+-- Give back the backend slot held by the current scan (least-conn accounting).
+function clamav:leave_backend()
+	local backend = self.backend
+	if backend then
+		inflight[backend.id] = inflight[backend.id] - 1
+		self.backend = nil
+	end
+end
+
+-- Connect to a backend. With session set and a keepalive pool configured, the socket
+-- comes from the worker's pool and is inside a clamd IDSESSION (started on the first use
+-- of the connection), so several INSTREAM scans can go over it : replies are then prefixed
+-- with a request id (see session_reply) and the socket goes back through release().
+-- Otherwise clamd closes the connection after its first reply. self.session tells which.
+function clamav:connect(backend, session)
 	-- Init socket
 	local tcp_socket = socket.tcp()
 	tcp_socket:settimeout(tonumber(self.variables["CLAMAV_TIMEOUT"]))
-	local ok, err = tcp_socket:connect(self.variables["CLAMAV_HOST"], tonumber(self.variables["CLAMAV_PORT"]))
+	local pool_size = session and tonumber(self.variables["CLAMAV_KEEPALIVE_POOL_SIZE"]) or 0
+	self.session = pool_size > 0
+	if not self.session then
+		local ok, err = tcp_socket:connect(backend.host, backend.port)
+		if not ok then
+			return false, err
+		end
+		return tcp_socket
+	end
+	local ok, err = tcp_socket:connect(backend.host, backend.port, {
+		pool = "clamav_session_" .. backend.id,
+		pool_size = pool_size,
+	})
 	if not ok then
 		return false, err
 	end
+	if tcp_socket:getreusedtimes() == 0 then
+		local bytes
+		bytes, err = tcp_socket:send("nIDSESSION\n")
+		if not bytes then
+			tcp_socket:close()
+			return false, err
+		end
+	end
 	return tcp_socket
 end
 
+-- Hand a session socket back once its last reply has been read : it is kept alive for
+-- the next scan, or closed when the pool is disabled or full (clamd then ends the
+-- session by itself). Sockets in any other state must be closed instead.
+function clamav:release(scan_socket)
+	local pool_size = tonumber(self.variables["CLAMAV_KEEPALIVE_POOL_SIZE"]) or 0
+	if pool_size > 0 then
+		local ok, err = scan_socket:setkeepalive(tonumber(self.variables["CLAMAV_KEEPALIVE_TIMEOUT"]), pool_size)
+		if ok then
+			return
+		end
+		self.logger:log(ERR, "can't put ClamAV session into keepalive pool : " .. err)
+	end
+	scan_socket:close()
+end
+
 function clamav:scan()
 	-- Loop on files
-	local form = upload:new(4096, 512, true)
+	local chunk_size = tonumber(self.variables["CLAMAV_CHUNK_SIZE"]) or 4096
+	local form = upload:new(chunk_size, 512, true)
 	if not form then
 		return false, "failed to create upload form"
 	end
+	-- Chunks are sent as { size prefix, chunk } : cosockets write arrays without building
+	-- the concatenated string, and full-size chunks (most of them) share one prefix.
+	local frame = {}
+	local full_size = stream_size(chunk_size)
 	local sha = sha512:new()
+	-- Verdicts are cached per signature version (see health_check)
+	self.version = self.datastore:get("plugin_clamav_version")
+	-- Files up to this size are held in memory and hashed before clamd is contacted, so a
+	-- cached one is never sent. Bigger ones (or every file with 0) are streamed as read.
+	local hash_first = tonumber(self.variables["CLAMAV_HASH_FIRST_SIZE"]) or 0
+	-- Past max_size bytes (0 = no cap) nothing more of a file is hashed or sent to clamd :
+	-- it is allowed unscanned, denied, or judged on the prefix already sent (see policy).
+	local max_size = tonumber(self.variables["CLAMAV_MAX_SCAN_SIZE"]) or 0
+	local policy = self.variables["CLAMAV_OVERSIZE_POLICY"]
+	-- With keepalive enabled, one socket (a clamd session) serves every file of the form,
+	-- otherwise each file gets its own. in_file is set inside a part with a filename,
+	-- streaming once that part is being sent as an INSTREAM, buffer holds its chunks until
+	-- then and skipping once the rest of the part is ignored.
 	local scan_socket = nil
+	local in_file = false
+	local streaming = false
+	local skipping = false
+	local buffer = nil
+	local buffered = 0
+	local file_size = 0
+	-- Checksum whose in-flight lock is held by this request, if any
+	local locked = nil
+
+	local function unlock()
+		if locked then
+			self:unlock(locked)
+			locked = nil
+		end
+	end
+
+	local function fail(err)
+		unlock()
+		if scan_socket then
+			scan_socket:close()
+		end
+		read_all(form)
+		return false, err
+	end
+
+	-- Let go of the socket when the scan is over : an unfinished INSTREAM can't be reused.
+	local function done()
+		if scan_socket then
+			if streaming then
+				scan_socket:close()
+			else
+				self:release(scan_socket)
+			end
+			scan_socket = nil
+		end
+	end
+
+	-- Start an INSTREAM for the current file (opening the socket on first use) and send
+	-- whatever was buffered so far.
+	local function start_stream()
+		local bytes, err
+		if not scan_socket then
+			scan_socket, err = self:socket(true)
+			if not scan_socket then
+				return false, "socket failed : " .. err
+			end
+		end
+		bytes, err = scan_socket:send("nINSTREAM\n")
+		if not bytes then
+			return false, "socket:send() failed : " .. err
+		end
+		streaming = true
+		if buffer and #buffer > 0 then
+			bytes, err = scan_socket:send(frames(buffer))
+			if not bytes then
+				return false, "socket:send() failed : " .. err
+			end
+		end
+		buffer = nil
+		buffered = 0
+		return true
+	end
+
+	-- Terminate the INSTREAM with a zero-length frame and read clamd's verdict line.
+	local function finish_stream()
+		streaming = false
+		local bytes, err = scan_socket:send(stream_size(0))
+		if not bytes then
+			return false, "socket:send() failed : " .. err
+		end
+		local data
+		data, err = scan_socket:receive("*l")
+		if not data then
+			return false, err
+		end
+		data = session_reply(data)
+		if not session_reusable(data, self.session) then
+			scan_socket:close()
+			scan_socket = nil
+		end
+		return true, data
+	end
+
 	while true do
 		-- Read part
 		local typ, res, err = form:read()
 		if not typ then
-			if scan_socket then
-				scan_socket:close()
-			end
-			return false, "form:read() failed : " .. err
+			return fail("form:read() failed : " .. err)
 		end
 
-		local bytes
+		local ok, bytes
 
 		-- Header case : check if we have a filename
 		if typ == "header" then
@@ -172,67 +538,145 @@ function clamav:scan()
 					break
 				end
 			end
-			if found then
-				if scan_socket then
+			if found and not in_file then
+				in_file = true
+				file_size = 0
+				if hash_first > 0 then
+					buffer = {}
+				else
+					ok, err = start_stream()
+					if not ok then
+						return fail(err)
+					end
+				end
+			end
+			-- Oversize file case : its remaining chunks are read and dropped
+		elseif skipping and typ ~= "eof" then
+			if typ == "part_end" then
+				in_file = false
+				skipping = false
+			end
+			-- Body case : update checksum and send to clamav (or buffer it)
+		elseif typ == "body" and in_file then
+			local oversize
+			res, oversize = cap_chunk(res, file_size, max_size, policy)
+			file_size = file_size + #res
+			if oversize == "allow" or oversize == "deny" then
+				if streaming then
 					scan_socket:close()
+					scan_socket = nil
+					streaming = false
 				end
-				scan_socket, err = self:socket()
-				if not scan_socket then
-					read_all(form)
-					return false, "socket failed : " .. err
+				buffer = nil
+				buffered = 0
+				sha:reset()
+				if oversize == "deny" then
+					-- No need to parse the rest of the form : nginx discards the body
+					-- of a denied request by itself.
+					done()
+					return true,
+						"file larger than CLAMAV_MAX_SCAN_SIZE (" .. tostring(max_size) .. " bytes)",
+						nil,
+						"oversize"
 				end
-				bytes, err = scan_socket:send("nINSTREAM\n")
-				if not bytes then
-					scan_socket:close()
-					read_all(form)
-					return false, "socket:send() failed : " .. err
+				self.logger:log(
+					NOTICE,
+					"file larger than CLAMAV_MAX_SCAN_SIZE (" .. tostring(max_size) .. " bytes) allowed without scan"
+				)
+				skipping = true
+			else
+				sha:update(res)
+				-- An empty frame would end the INSTREAM (a prefix may be cut down to nothing).
+				if streaming and #res > 0 then
+					frame[1] = #res == chunk_size and full_size or stream_size(#res)
+					frame[2] = res
+					bytes, err = scan_socket:send(frame)
+					if not bytes then
+						return fail("socket:send() failed : " .. err)
+					end
+				elseif not streaming then
+					if #res > 0 then
+						buffer[#buffer + 1] = res
+					end
+					buffered = buffered + #res
+					-- Too big to hold : stream it from now on, the cache is checked at the end.
+					if buffered > hash_first or oversize then
+						ok, err = start_stream()
+						if not ok then
+							return fail(err)
+						end
+					end
+				end
+				-- Prefix policy : judge the file on its first max_size bytes, uncached
+				-- since the checksum of the whole file is never known.
+				if oversize then
+					local data
+					ok, data = finish_stream()
+					if not ok then
+						return fail(data)
+					end
+					sha:reset()
+					skipping = true
+					local detected = data:match("^stream: (.*) FOUND$")
+					if detected then
+						done()
+						return true, detected
+					end
 				end
-			end
-			-- Body case : update checksum and send to clamav
-		elseif typ == "body" and scan_socket then
-			sha:update(res)
-			bytes, err = scan_socket:send(stream_size(#res) .. res)
-			if not bytes then
-				scan_socket:close()
-				read_all(form)
-				return false, "socket:send() failed : " .. err
 			end
 			-- Part end case : get final checksum and clamav result
-		elseif typ == "part_end" and scan_socket then
+		elseif typ == "part_end" and in_file then
+			in_file = false
 			local checksum = to_hex(sha:final())
 			sha:reset()
 			-- Check if file is in cache
-			local ok, cached = self:is_in_cache(checksum)
+			local cached
+			ok, cached = self:is_in_cache(checksum)
 			if not ok then
 				self.logger:log(
 					ngx.ERR,
 					"can't check if file with checksum " .. checksum .. " is in cache : " .. cached
 				)
-			elseif cached then
-				scan_socket:close()
-				scan_socket = nil
+				cached = nil
+			end
+			-- Only one request scans a given file at a time : the others wait for its verdict
+			-- and only scan the file themselves if none comes. A file already streamed to
+			-- clamd only needs its INSTREAM finished : waiting would hold that socket (and a
+			-- clamd thread) for nothing, so its scan is completed right away instead.
+			if not cached then
+				local acquired = self:lock(checksum)
+				if acquired == false and not streaming then
+					cached = self:wait_verdict(checksum)
+				elseif acquired then
+					locked = checksum
+				end
+			end
+			if cached then
+				if streaming then
+					-- The INSTREAM is left unfinished : the connection can't be reused.
+					scan_socket:close()
+					scan_socket = nil
+					streaming = false
+				end
+				buffer = nil
+				buffered = 0
 				if cached ~= "clean" then
+					done()
 					read_all(form)
 					return true, cached, checksum
 				end
 			else
-				-- End the INSTREAM
-				bytes, err = scan_socket:send(stream_size(0))
-				if not bytes then
-					scan_socket:close()
-					read_all(form)
-					return false, "socket:send() failed : " .. err
+				if not streaming then
+					ok, err = start_stream()
+					if not ok then
+						return fail(err)
+					end
 				end
-				-- Read result
 				local data
-				data, err = scan_socket:receive("*l")
-				if not data then
-					scan_socket:close()
-					read_all(form)
-					return false, err
+				ok, data = finish_stream()
+				if not ok then
+					return fail(data)
 				end
-				scan_socket:close()
-				scan_socket = nil
 				if data:match("^.*INSTREAM size limit exceeded.*$") then
 					self.logger:log(
 						ERR,
@@ -240,6 +684,7 @@ function clamav:scan()
 							.. checksum
 							.. " because size exceeded StreamMaxLength in clamd.conf"
 					)
+					unlock()
 				else
 					-- luacheck: ignore iend
 					local istart, iend
@@ -252,7 +697,9 @@ function clamav:scan()
 					if not ok then
 						self.logger:log(ERR, "can't cache result : " .. err)
 					end
+					unlock()
 					if detected ~= "clean" then
+						done()
 						read_all(form)
 						return true, detected, checksum
 					end
@@ -260,9 +707,7 @@ function clamav:scan()
 			end
 			-- End of body case : no file detected
 		elseif typ == "eof" then
-			if scan_socket then
-				scan_socket:close()
-			end
+			done()
 			return true
 		end
 	end
@@ -271,21 +716,89 @@ function clamav:scan()
 end
 
 function clamav:is_in_cache(checksum)
-	local ok, data = self.cachestore:get("plugin_clamav_" .. checksum)
+	local ok, data = self.cachestore:get(cache_key(checksum, self.version))
 	if not ok then
 		return false, data
 	end
+	if data == nil and self.journal then
+		data = self:restore(checksum)
+	end
 	return true, data
 end
 
 function clamav:add_to_cache(checksum, value)
-	local ok, err = self.cachestore:set("plugin_clamav_" .. checksum, value, 86400)
+	local ttl =
+		verdict_ttl(value, self.variables["CLAMAV_CACHE_CLEAN_TTL"], self.variables["CLAMAV_CACHE_DETECTED_TTL"])
+	local ok, err = self.cachestore:set(cache_key(checksum, self.version), value, ttl)
 	if not ok then
 		return false, err
 	end
+	if self.journal then
+		self.journal:append(journal_key(checksum, self.version), value, ttl)
+	end
 	return true
 end
 
+-- Move a verdict loaded from the persistent cache back into the cache. It is written to
+-- the journal again, which keeps the file in least recently used order for compaction.
+function clamav:restore(checksum)
+	local key = journal_key(checksum, self.version)
+	local verdict, ttl = self.journal:take(key)
+	if not verdict then
+		return nil
+	end
+	local ok, err = self.cachestore:set(cache_key(checksum, self.version), verdict, ttl)
+	if not ok then
+		self.logger:log(ERR, "can't cache result : " .. err)
+	end
+	self.journal:append(key, verdict, ttl)
+	return verdict
+end
+
+-- Take the in-flight lock of a checksum for the time of a scan. Returns true when taken,
+-- false when another request holds it and nil when it can't be checked (the file is then
+-- scanned without it). The lock expires by itself should its holder never release it.
+function clamav:lock(checksum)
+	-- add() only succeeds when the key doesn't exist yet, which the datastore wrapper has
+	-- no equivalent for : the shared dict behind it is used directly.
+	local ok, err = ngx.shared.datastore:add(
+		"plugin_clamav_lock_" .. checksum,
+		true,
+		(tonumber(self.variables["CLAMAV_TIMEOUT"]) or 1000) / 1000 + 1
+	)
+	if ok then
+		return true
+	end
+	if err == "exists" then
+		return false
+	end
+	self.logger:log(ERR, "can't lock scan of file with checksum " .. checksum .. " : " .. err)
+	return nil
+end
+
+function clamav:unlock(checksum)
+	ngx.shared.datastore:delete("plugin_clamav_lock_" .. checksum)
+end
+
+-- Wait, up to CLAMAV_TIMEOUT, for the request holding the in-flight lock of a checksum to
+-- cache its verdict. Returns the verdict, or nil if the lock went away without one.
+function clamav:wait_verdict(checksum)
+	local deadline = now() + (tonumber(self.variables["CLAMAV_TIMEOUT"]) or 1000) / 1000
+	repeat
+		sleep(0.05)
+		-- The lock is checked first : a verdict cached just before it was released is seen.
+		local scanning = ngx.shared.datastore:get("plugin_clamav_lock_" .. checksum)
+		local ok, cached = self:is_in_cache(checksum)
+		if ok and cached then
+			return cached
+		end
+		if not scanning then
+			return nil
+		end
+	until now() >= deadline
+	return nil
+end
+
 function clamav:api()
 	if self.ctx.bw.uri == "/clamav/ping" and self.ctx.bw.request_method == "POST" then
 		-- Check clamav connection
@@ -297,15 +810,24 @@ function clamav:api()
 			return self:ret(true, "Clamav plugin not enabled")
 		end
 
-		-- Send PING to ClamAV
-		local ok, data = self:command("PING")
-		if not ok then
-			return self:ret(true, "connectivity with ClamAV failed : " .. data, HTTP_INTERNAL_SERVER_ERROR)
-		end
-		if data ~= "PONG" then
-			return self:ret(true, "wrong data received from ClamAV : " .. data, HTTP_INTERNAL_SERVER_ERROR)
+		-- Send PING to every ClamAV backend
+		local up, errors = self:health_check()
+		if up == 0 then
+			return self:ret(
+				true,
+				"connectivity with ClamAV failed : " .. concat(errors, ", "),
+				HTTP_INTERNAL_SERVER_ERROR
+			)
 		end
-		return self:ret(true, "connectivity with ClamAV is successful", HTTP_OK)
+		return self:ret(
+			true,
+			"connectivity with ClamAV is successful ("
+				.. tostring(up)
+				.. "/"
+				.. tostring(#self:get_backends())
+				.. " backends up)",
+			HTTP_OK
+		)
 	end
 	return self:ret(false, "success")
 end
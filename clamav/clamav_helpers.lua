@@ -2,6 +2,9 @@
 -- outside the OpenResty runtime. No ngx/resty dependencies — see
 -- spec/clamav_helpers_spec.lua.
 local floor = math.floor
+local ipairs = ipairs
+local tonumber = tonumber
+local tostring = tostring
 
 local _M = {}
 
@@ -19,4 +22,128 @@ function _M.stream_size(size)
 		:reverse()
 end
 
+-- INSTREAM frames of a list of chunks as one flat array ({ size1, chunk1, size2, ... })
+-- that a cosocket sends in a single call without concatenating anything. Empty chunks
+-- are skipped : a zero-length frame would end the stream.
+function _M.frames(chunks)
+	local out = {}
+	for _, chunk in ipairs(chunks) do
+		if #chunk > 0 then
+			out[#out + 1] = _M.stream_size(#chunk)
+			out[#out + 1] = chunk
+		end
+	end
+	return out
+end
+
+-- Strip the "<id>: " prefix clamd puts before every reply inside an IDSESSION, so
+-- callers can match the same "stream: ... FOUND" lines as outside a session.
+function _M.session_reply(line)
+	return (line:gsub("^%d+: ", "", 1))
+end
+
+-- True when a (prefix-stripped) clamd reply leaves the connection usable for another
+-- command. Outside an IDSESSION (session false) clamd closes it after its reply, and it
+-- ends the session after an error reply (e.g. "INSTREAM size limit exceeded. ERROR"), so
+-- such a socket must be closed instead of kept for the next file.
+function _M.session_reusable(reply, session)
+	if not session then
+		return false
+	end
+	return reply:find(" OK$") ~= nil or reply:find(" FOUND$") ~= nil
+end
+
+-- Parse CLAMAV_HOST into the list of clamd backends : space-separated "host",
+-- "host:port" or "[ipv6]:port" entries, the port defaulting to default_port. Each
+-- backend gets an id ("host:port") used to key its health and load state.
+function _M.parse_backends(hosts, default_port)
+	local backends = {}
+	for entry in (hosts or ""):gmatch("%S+") do
+		local host, port = entry:match("^%[(.+)%]:(%d+)$")
+		if not host then
+			host = entry:match("^%[(.+)%]$")
+		end
+		if not host then
+			host, port = entry:match("^([^:]+):(%d+)$")
+		end
+		if not host then
+			host = entry
+		end
+		port = tonumber(port) or tonumber(default_port)
+		backends[#backends + 1] = { host = host, port = port, id = host .. ":" .. tostring(port) }
+	end
+	return backends
+end
+
+-- Pick the backend for the next scan among those not in down (a set of ids) :
+-- "round-robin" takes the next one in turn, anything else the one with the fewest
+-- scans in flight (inflight maps ids to counts), ties going to the next in turn so
+-- an idle pool still spreads its load. Returns nil when every backend is down.
+function _M.pick_backend(backends, down, inflight, method, turn)
+	local count = #backends
+	local best = nil
+	for i = 0, count - 1 do
+		local backend = backends[(turn + i) % count + 1]
+		if not down[backend.id] then
+			if method == "round-robin" then
+				return backend
+			end
+			if not best or (inflight[backend.id] or 0) < (inflight[best.id] or 0) then
+				best = backend
+			end
+		end
+	end
+	return best
+end
+
+-- Apply the CLAMAV_MAX_SCAN_SIZE cap (max_size, 0 = none) to a body chunk of a file whose
+-- first file_size bytes were already read. Returns the part of chunk to hash and send
+-- to clamd and, once the cap is crossed, the action of policy : "allow" or "deny" (none
+-- of chunk kept) or "prefix" (chunk cut to the bytes left before the cap, maybe none).
+function _M.cap_chunk(chunk, file_size, max_size, policy)
+	if max_size <= 0 or file_size + #chunk <= max_size then
+		return chunk, nil
+	end
+	if policy == "prefix" then
+		return chunk:sub(1, max_size - file_size), "prefix"
+	end
+	if policy == "deny" then
+		return "", "deny"
+	end
+	return "", "allow"
+end
+
+-- Signature database version (the number after the engine version) of a clamd
+-- VERSION reply such as "ClamAV 1.4.1/27431/Tue Oct 13 08:32:11 2026", nil when
+-- the reply carries none (e.g. "ClamAV 1.4.1" while no database is loaded).
+function _M.signature_version(reply)
+	return tonumber((reply or ""):match("^ClamAV [^/]+/(%d+)"))
+end
+
+-- Cache key of a scan verdict. The signature version is part of it so verdicts cached
+-- before a database update are simply never read again once clamd reports the new one.
+function _M.cache_key(checksum, version)
+	if version then
+		return "plugin_clamav_" .. tostring(version) .. "_" .. checksum
+	end
+	return "plugin_clamav_" .. checksum
+end
+
+-- Cache TTL of a verdict : clean files and detections each have their own.
+function _M.verdict_ttl(verdict, clean_ttl, detected_ttl)
+	if verdict == "clean" then
+		return tonumber(clean_ttl) or 86400
+	end
+	return tonumber(detected_ttl) or 86400
+end
+
+-- Compact key of a verdict in the persistent cache journal : the signature version and
+-- the first 32 hex digits (128 bits) of the checksum are enough to tell files apart.
+function _M.journal_key(checksum, version)
+	if version then
+		return tostring(version) .. "_" .. checksum:sub(1, 32)
+	end
+	return checksum:sub(1, 32)
+end
+
 return _M
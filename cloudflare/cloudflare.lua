@@ -1,6 +1,8 @@
+local cjson = require("cjson")
 local class = require("middleclass")
+local clusterstore = require("bunkerweb.clusterstore")
 local cloudflare_helpers = require("cloudflare.cloudflare_helpers")
-local ipmatcher = require("resty.ipmatcher")
+local lrucache = require("resty.lrucache")
 local plugin = require("bunkerweb.plugin")
 local ssl = require("ngx.ssl")
 local utils = require("bunkerweb.utils")
@@ -8,6 +10,8 @@ local utils = require("bunkerweb.utils")
 local cloudflare = class("cloudflare", plugin)
 
 local ngx = ngx
+local worker = ngx.worker
+local ngx_timer = ngx.timer
 local var = ngx.var
 local ngx_req = ngx.req
 local INFO = ngx.INFO
@@ -24,16 +28,33 @@ local get_multiple_variables = utils.get_multiple_variables
 local has_variable = utils.has_variable
 local has_not_variable = utils.has_not_variable
 local read_files = utils.read_files
-local ipmatcher_new = ipmatcher.new
-local match_trusted = cloudflare_helpers.match_trusted
+local new_classifier = cloudflare_helpers.new_classifier
+local classify = cloudflare_helpers.classify
 local classify_cache = cloudflare_helpers.classify_cache
 local parse_additional = cloudflare_helpers.parse_additional
-local cache_key = cloudflare_helpers.cache_key
+local verdict_key = cloudflare_helpers.verdict_key
 local trusted_list_empty = cloudflare_helpers.trusted_list_empty
+local new_metrics = cloudflare_helpers.new_metrics
+local count = cloudflare_helpers.count
+local observe = cloudflare_helpers.observe
+local merge_metrics = cloudflare_helpers.merge_metrics
+local hit_ratio = cloudflare_helpers.hit_ratio
+local keyspace_events_enabled = cloudflare_helpers.keyspace_events_enabled
+local keyspace_key = cloudflare_helpers.keyspace_key
+local encode = cjson.encode
+local decode = cjson.decode
+local pcall = pcall
+local type = type
+local clock = os.clock
+local now = ngx.now
 local clear_header = ngx_req.clear_header
 local tostring = tostring
+local tonumber = tonumber
 local ipairs = ipairs
 local insert = table.insert
+local concat = table.concat
+local format = string.format
+local crc32_long = ngx.crc32_long
 local open = io.open
 
 -- Client-supplied request headers that an upstream might trust as coming from
@@ -49,6 +70,105 @@ local CF_HEADERS = {
 	"CF-Worker",
 }
 
+-- Per-worker view of the trusted ranges snapshot published by init(). services maps a
+-- server_name to its parsed CLOUDFLARE_ADDITIONAL_TRUSTED_FROM list and (lazily) its
+-- compiled classifier ; the whole table is dropped when the snapshot generation moves,
+-- so a request normally only compares generations (no table or gmatch on the hot path).
+local worker_generation = nil
+local services = {}
+
+-- Stand-in snapshot while init() hasn't published one (the trust check fails open).
+local EMPTY_SNAPSHOT = { ipv4 = {}, ipv6 = {} }
+
+-- Worker-local LRU of trust verdicts checked before cachestore_local, so repeat visitors
+-- skip the shared-dict round trip. Created on first use (its size is a setting).
+local trust_lru = nil
+
+-- Worker-local LRU of parsed origin certificates (lazy loading), created on first use.
+local cert_lru = nil
+
+-- Seconds an SNI whose origin certificate can't be loaded is remembered in the datastore.
+local NO_CERT_TTL = 60
+
+-- Hot path metrics of this worker (counters and latency histograms), copied to the
+-- datastore every METRICS_INTERVAL seconds so the API can sum every worker's view.
+local metrics = new_metrics()
+local METRICS_INTERVAL = 10
+
+-- Copy this worker's metrics to the datastore for the API route. Entries expire on their
+-- own when a worker goes away (reload), so only live workers are summed.
+local function publish_metrics(premature, self)
+	if premature then
+		return
+	end
+	local ok, err = self.datastore:set(
+		"plugin_cloudflare_metrics_" .. tostring(worker.id()),
+		encode(metrics),
+		METRICS_INTERVAL * 3
+	)
+	if not ok then
+		self.logger:log(ERR, "can't publish cloudflare metrics into datastore : " .. err)
+	end
+end
+
+-- Edge ban sync (cf-edge-ban-sync.py) reads the ban keys changed since its previous run
+-- from BAN_EVENTS (ban key -> time of its last keyspace event) instead of scanning every
+-- ban key. Worker 0 of each instance feeds it from Redis keyspace notifications and keeps
+-- BAN_EVENTS_ALIVE up while subscribed ; BAN_EVENTS_START is when the current stretch of
+-- uninterrupted coverage began, so the job knows which of its watermarks it can trust.
+-- The names and the retention are shared with the job.
+local BAN_EVENTS = "plugin_cloudflare_ban_events"
+local BAN_EVENTS_ALIVE = "plugin_cloudflare_ban_events_alive"
+local BAN_EVENTS_START = "plugin_cloudflare_ban_events_start"
+local BAN_EVENTS_HEARTBEAT = 10
+local BAN_EVENTS_ALIVE_TTL = BAN_EVENTS_HEARTBEAT * 3
+local BAN_EVENTS_RETENTION = 86400
+
+-- Keep cloudflare:watch_bans() running. After a broken connection it waits for the
+-- heartbeat to expire before retrying, so unless another instance kept watching, the
+-- retry restarts the coverage instead of hiding the gap. A Redis without the needed
+-- keyspace events, or that refuses CONFIG, is not retried : it is logged once and the
+-- job keeps scanning every ban key until a reload.
+local function watch_bans(premature, self)
+	if premature or worker.exiting() then
+		return
+	end
+	local ok, err, retry = self:watch_bans()
+	if ok or worker.exiting() then
+		return
+	end
+	if not retry then
+		self.logger:log(WARN, err)
+		return
+	end
+	self.logger:log(ERR, err)
+	ok, err = ngx_timer.at(BAN_EVENTS_ALIVE_TTL, watch_bans, self)
+	if not ok then
+		self.logger:log(ERR, "can't create the ban events timer : " .. err)
+	end
+end
+
+-- Paths of the origin certificate and key written by cf-manage-origin-certs.py.
+local function origin_cert_files(server_name)
+	local dir = "/var/cache/bunkerweb/cloudflare/" .. server_name .. "/"
+	return { dir .. "origin_cert.pem", dir .. "private.key" }
+end
+
+-- Parse a { cert, key } pair of PEM strings into the { cert_chain, priv_key } pair
+-- returned by ssl_certificate().
+local function parse_origin_cert(data)
+	local cert_chain, err = parse_pem_cert(data[1])
+	if not cert_chain then
+		return nil, "error while parsing pem cert : " .. err
+	end
+	local priv_key
+	priv_key, err = parse_pem_priv_key(data[2])
+	if not priv_key then
+		return nil, "error while parsing pem priv key : " .. err
+	end
+	return { cert_chain, priv_key }
+end
+
 -- Strip client-supplied Cloudflare headers (defence-in-depth when the peer is not a
 -- trusted Cloudflare IP). Module-local: it needs no instance state.
 local function strip_cf_headers()
@@ -60,24 +180,47 @@ end
 function cloudflare:initialize(ctx)
 	-- Call parent initialize
 	plugin.initialize(self, "cloudflare", ctx)
-	-- Decode trusted_ips — only in request phases that actually consume it (access/preread).
-	-- self.is_request gates out init/ssl_certificate/etc., avoiding a per-handshake build.
+	-- Phases record hot path metrics through self.metrics, left nil when disabled.
+	if self.variables["CLOUDFLARE_METRICS"] == "yes" then
+		self.metrics = metrics
+	end
+	-- Resolve the service's trusted ranges — only in request phases that actually consume
+	-- them (access/preread). self.is_request gates out init/ssl_certificate/etc.
 	if get_phase() ~= "init" and self.is_request and self:is_needed() then
-		local trusted_ips, err = self.datastore:get("plugin_cloudflare_trusted_ips", true)
-		if not trusted_ips then
+		local snapshot, err = self.datastore:get("plugin_cloudflare_trusted_ips", true)
+		if not snapshot then
 			self.logger:log(ERR, err)
-			trusted_ips = {}
-		end
-		-- Build a FRESH per-request table. self.datastore:get(key, true) returns the
-		-- worker-LRU table by reference, so the read-only ipv4/ipv6 lists may be shared,
-		-- but "additional" (from the multisite CLOUDFLARE_ADDITIONAL_TRUSTED_FROM setting)
-		-- MUST be rebuilt each request — mutating the shared table would leak memory and
-		-- bleed one service's additional IPs into every other service.
-		self.trusted_ips = {
-			ipv4 = trusted_ips.ipv4 or {},
-			ipv6 = trusted_ips.ipv6 or {},
-			additional = parse_additional(self.variables["CLOUDFLARE_ADDITIONAL_TRUSTED_FROM"]),
-		}
+			snapshot = EMPTY_SNAPSHOT
+		end
+		-- A new generation means init() loaded new lists : forget everything derived
+		-- from the previous snapshot. The worker verdict LRU is flushed, and verdicts in
+		-- cachestore_local are keyed by generation (see verdict_key) so the old ones are
+		-- never read again.
+		if snapshot.generation ~= worker_generation then
+			worker_generation = snapshot.generation
+			services = {}
+			if trust_lru then
+				trust_lru:flush_all()
+			end
+		end
+		local server_name = self.ctx.bw.server_name
+		local additional = self.variables["CLOUDFLARE_ADDITIONAL_TRUSTED_FROM"]
+		local service = services[server_name]
+		if not service or service.additional ~= additional then
+			-- The snapshot is shared by reference and never mutated : each service gets
+			-- its own table so one service's additional IPs never bleed into another.
+			service = {
+				additional = additional,
+				trusted_ips = {
+					ipv4 = snapshot.ipv4 or {},
+					ipv6 = snapshot.ipv6 or {},
+					additional = parse_additional(additional),
+				},
+			}
+			service.empty = trusted_list_empty(service.trusted_ips)
+			services[server_name] = service
+		end
+		self.service = service
 	end
 end
 
@@ -98,6 +241,139 @@ function cloudflare:is_needed()
 	return is_needed
 end
 
+function cloudflare:init_worker()
+	-- Check if init_worker is needed
+	if not self:is_needed() then
+		return self:ret(true, "init_worker not needed")
+	end
+	-- Ban events are only needed by the incremental edge ban sync, one watcher per instance
+	if
+		worker.id() == 0
+		and get_variable("USE_CLOUDFLARE_EDGE_BAN_SYNC", false) == "yes"
+		and get_variable("CLOUDFLARE_EDGE_BAN_SYNC_MODE", false) == "incremental"
+		and get_variable("USE_REDIS", false) == "yes"
+	then
+		local ok, err = ngx_timer.at(0, watch_bans, self)
+		if not ok then
+			return self:ret(false, "can't create the ban events timer : " .. err)
+		end
+	end
+	if not self.metrics then
+		return self:ret(true, "cloudflare metrics are disabled")
+	end
+	local ok, err = ngx_timer.every(METRICS_INTERVAL, publish_metrics, self)
+	if not ok then
+		return self:ret(false, "can't create the metrics timer : " .. err)
+	end
+	return self:ret(true, "success")
+end
+
+-- Connect to the Redis server holding the bans through the core clusterstore, so that
+-- the USE_REDIS settings (Sentinel included) apply, with read_timeout (ms) overriding
+-- REDIS_TIMEOUT for reads. The connection stays out of the keepalive pool : a subscribed
+-- one can't be reused, the caller closes it. Returns (red, database).
+function cloudflare:redis_connect(read_timeout)
+	local variables = {}
+	for _, name in ipairs({ "REDIS_DATABASE", "REDIS_TIMEOUT" }) do
+		local value, err = get_variable(name, false)
+		if value == nil then
+			return nil, "can't get " .. name .. " variable : " .. err
+		end
+		variables[name] = value
+	end
+	local store = clusterstore:new(false)
+	local ok, err = store:connect()
+	if not ok then
+		return nil, "can't connect to Redis : " .. err
+	end
+	local red = store.redis_client
+	if read_timeout then
+		local timeout = tonumber(variables["REDIS_TIMEOUT"]) or 1000
+		red:set_timeouts(timeout, timeout, read_timeout)
+	end
+	return red, tonumber(variables["REDIS_DATABASE"]) or 0
+end
+
+-- Record the keyspace events of the ban keys into BAN_EVENTS until the subscription
+-- breaks or the worker exits. Returns (false, err, retry) on failure.
+function cloudflare:watch_bans()
+	local sub, database = self:redis_connect(BAN_EVENTS_HEARTBEAT * 1000)
+	if not sub then
+		return false, database, true
+	end
+	local store, err = self:redis_connect()
+	if not store then
+		sub:close()
+		return false, err, true
+	end
+	local function fail(msg, retry)
+		sub:close()
+		store:close()
+		return false, msg, retry
+	end
+	local flags
+	flags, err = store:config("get", "notify-keyspace-events")
+	-- Managed Redis services often disable CONFIG : that won't change before a reload either
+	if not flags then
+		return fail(
+			"can't get the notify-keyspace-events Redis setting ("
+				.. err
+				.. "), edge ban sync will scan every ban key on each run",
+			false
+		)
+	end
+	if not keyspace_events_enabled(flags[2]) then
+		return fail(
+			"Redis notify-keyspace-events must include K and either A or g$x, "
+				.. "edge ban sync will scan every ban key on each run",
+			false
+		)
+	end
+	local ok
+	ok, err = sub:psubscribe("__keyspace@" .. tostring(database) .. "__:bans_*")
+	if not ok then
+		return fail("can't subscribe to the ban keyspace events : " .. err, true)
+	end
+	-- No watcher was alive : the events before now are lost, coverage restarts here.
+	ok, err = store:set(BAN_EVENTS_ALIVE, "1", "EX", BAN_EVENTS_ALIVE_TTL, "NX")
+	if ok == "OK" then
+		ok, err = store:set(BAN_EVENTS_START, tostring(now()))
+	end
+	if not ok then
+		return fail("can't mark the ban events as tracked : " .. err, true)
+	end
+	self.logger:log(INFO, "recording ban keyspace events for the edge ban sync")
+	local beat = now()
+	while not worker.exiting() do
+		local res
+		res, err = sub:read_reply()
+		if res then
+			local key = res[1] == "pmessage" and keyspace_key(res[3])
+			if key then
+				ok, err = store:zadd(BAN_EVENTS, now(), key)
+				if not ok then
+					return fail("can't record a ban event : " .. err, true)
+				end
+			end
+		elseif err ~= "timeout" then
+			return fail("lost the ban keyspace events subscription : " .. err, true)
+		end
+		if now() - beat >= BAN_EVENTS_HEARTBEAT then
+			beat = now()
+			ok, err = store:set(BAN_EVENTS_ALIVE, "1", "EX", BAN_EVENTS_ALIVE_TTL)
+			if ok then
+				ok, err = store:zremrangebyscore(BAN_EVENTS, "-inf", beat - BAN_EVENTS_RETENTION)
+			end
+			if not ok then
+				return fail("can't refresh the ban events heartbeat : " .. err, true)
+			end
+		end
+	end
+	sub:close()
+	store:close()
+	return true
+end
+
 function cloudflare:set()
 	-- Check if set is needed
 	if not self:is_needed() then
@@ -108,7 +384,13 @@ function cloudflare:set()
 	-- loaded for this server, otherwise BunkerWeb may enable a TLS vhost with no
 	-- usable certificate until the daily cert job catches up.
 	if self.variables["CLOUDFLARE_API_TOKEN"] ~= "" and self.variables["CLOUDFLARE_MANAGE_ORIGIN_CERTS"] == "yes" then
-		local data = self.internalstore:get("plugin_cloudflare_" .. self.ctx.bw.server_name, true)
+		local data
+		if self.variables["CLOUDFLARE_ORIGIN_CERTS_LOADING"] == "lazy" then
+			local index = self.internalstore:get("plugin_cloudflare_origin_certs", true)
+			data = index and index[self.ctx.bw.server_name]
+		else
+			data = self.internalstore:get("plugin_cloudflare_" .. self.ctx.bw.server_name, true)
+		end
 		if data then
 			https_configured = "yes"
 			self.ctx.bw.https_configured = "yes"
@@ -123,12 +405,11 @@ function cloudflare:init()
 		return self:ret(true, "init not needed")
 	end
 	-- Read trusted_ips downloaded by cf-trusted-ips-download.py. "additional" comes
-	-- from the CLOUDFLARE_ADDITIONAL_TRUSTED_FROM setting (parsed per-request), no job
-	-- writes an additional.list, so only ipv4/ipv6 are read from disk here.
+	-- from the CLOUDFLARE_ADDITIONAL_TRUSTED_FROM setting (parsed once per worker and
+	-- service), no job writes an additional.list, so only ipv4/ipv6 are read from disk.
 	local trusted_ips = {
 		["ipv4"] = {},
 		["ipv6"] = {},
-		["additional"] = {},
 	}
 	local i = 0
 	for _, kind in ipairs({ "ipv4", "ipv6" }) do
@@ -141,6 +422,12 @@ function cloudflare:init()
 			f:close()
 		end
 	end
+	-- Publish the lists as an immutable snapshot tagged with a generation derived from
+	-- their content (the datastore is rebuilt on every reload, so a counter kept there
+	-- would never move) : workers keep everything they derived from a snapshot (parsed
+	-- additional lists, classifiers, verdicts) until the lists actually change.
+	trusted_ips.generation =
+		format("%08x", crc32_long(concat(trusted_ips.ipv4, "\n") .. "|" .. concat(trusted_ips.ipv6, "\n")))
 	-- Load them into datastore
 	local ok, err = self.datastore:set("plugin_cloudflare_trusted_ips", trusted_ips, nil, true)
 	if not ok then
@@ -154,6 +441,17 @@ function cloudflare:init()
 		and has_not_variable("CLOUDFLARE_API_TOKEN", "")
 		and has_variable("CLOUDFLARE_MANAGE_ORIGIN_CERTS", "yes")
 	then
+		local loading
+		loading, err = get_variable("CLOUDFLARE_ORIGIN_CERTS_LOADING", false)
+		if not loading then
+			return self:ret(false, "can't get CLOUDFLARE_ORIGIN_CERTS_LOADING variable : " .. err)
+		end
+		-- In lazy mode only the server name -> files index is built here, the PEM files
+		-- are parsed by ssl_certificate() on the first handshake for each SNI.
+		local index = nil
+		if loading == "lazy" then
+			index = {}
+		end
 		local multisite
 		multisite, err = get_variable("MULTISITE", false)
 		if not multisite then
@@ -177,21 +475,13 @@ function cloudflare:init()
 					and multisite_vars["CLOUDFLARE_MANAGE_ORIGIN_CERTS"] == "yes"
 					and server_name ~= "global"
 				then
-					local check, data = read_files({
-						"/var/cache/bunkerweb/cloudflare/" .. server_name .. "/origin_cert.pem",
-						"/var/cache/bunkerweb/cloudflare/" .. server_name .. "/private.key",
-					})
+					local check
+					check, err =
+						self:load_origin_cert(origin_cert_files(server_name), multisite_vars["SERVER_NAME"], index)
 					if not check then
-						self.logger:log(ERR, "error while reading files : " .. data)
+						self.logger:log(ERR, err)
 						ret_ok = false
-						ret_err = "error reading files"
-					else
-						check, err = self:load_data(data, multisite_vars["SERVER_NAME"])
-						if not check then
-							self.logger:log(ERR, "error while loading data : " .. err)
-							ret_ok = false
-							ret_err = "error loading data"
-						end
+						ret_err = "error loading origin certificates"
 					end
 				end
 			end
@@ -201,21 +491,19 @@ function cloudflare:init()
 			if not server_name then
 				return self:ret(false, "can't get SERVER_NAME variable : " .. err)
 			end
-			local check, data = read_files({
-				"/var/cache/bunkerweb/cloudflare/" .. server_name:match("%S+") .. "/origin_cert.pem",
-				"/var/cache/bunkerweb/cloudflare/" .. server_name:match("%S+") .. "/private.key",
-			})
+			local check
+			check, err = self:load_origin_cert(origin_cert_files(server_name:match("%S+")), server_name, index)
 			if not check then
-				self.logger:log(ERR, "error while reading files : " .. data)
+				self.logger:log(ERR, err)
 				ret_ok = false
-				ret_err = "error reading files"
-			else
-				check, err = self:load_data(data, server_name)
-				if not check then
-					self.logger:log(ERR, "error while loading data : " .. err)
-					ret_ok = false
-					ret_err = "error loading data"
-				end
+				ret_err = "error loading origin certificates"
+			end
+		end
+		if index then
+			local ok
+			ok, err = self.internalstore:set("plugin_cloudflare_origin_certs", index, nil, true)
+			if not ok then
+				return self:ret(false, "can't store origin certificates index into internalstore : " .. err)
 			end
 		end
 	else
@@ -224,6 +512,36 @@ function cloudflare:init()
 	return self:ret(ret_ok, ret_err)
 end
 
+-- Eager mode parses the files of a service now, lazy mode (index not nil) only checks
+-- that they exist and records them under each of the service's server names.
+function cloudflare:load_origin_cert(files, server_name, index)
+	if index then
+		for _, file in ipairs(files) do
+			local f = open(file, "r")
+			if not f then
+				return false, "error while reading files : can't open " .. file
+			end
+			f:close()
+		end
+		for key in server_name:gmatch("%S+") do
+			index[key] = files
+			-- Forget a failure cached before this reload, the job may have fixed it since.
+			self.datastore:delete("plugin_cloudflare_no_cert_" .. key)
+		end
+		return true
+	end
+	local check, data = read_files(files)
+	if not check then
+		return false, "error while reading files : " .. data
+	end
+	local err
+	check, err = self:load_data(data, server_name)
+	if not check then
+		return false, "error while loading data : " .. err
+	end
+	return true
+end
+
 function cloudflare:ssl_certificate()
 	local server_name, err = ssl_server_name()
 	if not server_name then
@@ -233,36 +551,106 @@ function cloudflare:ssl_certificate()
 		end
 		return self:ret(true, "no SNI provided")
 	end
-	local data
-	data, err = self.internalstore:get("plugin_cloudflare_" .. server_name, true)
+	if not self.metrics then
+		return self:certificate(server_name)
+	end
+	-- os.clock() is the worker's CPU time : the lookup never yields, so it measures the
+	-- lookup itself, with a finer resolution than ngx.now().
+	local start = clock()
+	local ret = self:certificate(server_name)
+	observe(self.metrics, "cert_lookup", clock() - start)
+	return ret
+end
+
+function cloudflare:certificate(server_name)
+	if self.variables["CLOUDFLARE_ORIGIN_CERTS_LOADING"] == "lazy" then
+		return self:lazy_certificate(server_name)
+	end
+	local data, err = self.internalstore:get("plugin_cloudflare_" .. server_name, true)
 	if not data and err ~= "not found" then
 		return self:ret(
 			false,
 			"error while getting plugin_cloudflare_" .. server_name .. " from internalstore : " .. err
 		)
 	elseif data then
+		if self.metrics then
+			count(self.metrics, "cert_hit")
+		end
 		return self:ret(true, "certificate/key data found", data)
 	end
 	return self:ret(true, "cloudflare is not used")
 end
 
-function cloudflare:load_data(data, server_name)
-	-- Load certificate
-	local cert_chain, err = parse_pem_cert(data[1])
-	if not cert_chain then
-		return false, "error while parsing pem cert : " .. err
+-- Lazy mode : serve the SNI from the worker LRU, parsing its files on the first miss.
+-- Files that can't be read or parsed are remembered in the datastore for a short while
+-- so the other workers don't all hit the disk again on every handshake.
+function cloudflare:lazy_certificate(server_name)
+	local lru = self:get_cert_lru()
+	local data = lru and lru:get(server_name)
+	if data then
+		if self.metrics then
+			count(self.metrics, "cert_hit")
+		end
+		return self:ret(true, "certificate/key data found", data)
 	end
-	-- Load key
-	local priv_key
-	priv_key, err = parse_pem_priv_key(data[2])
-	if not priv_key then
-		return false, "error while parsing pem priv key : " .. err
+	local index, err = self.internalstore:get("plugin_cloudflare_origin_certs", true)
+	if not index then
+		if err ~= "not found" then
+			return self:ret(false, "error while getting origin certificates index from internalstore : " .. err)
+		end
+		return self:ret(true, "cloudflare is not used")
+	end
+	local files = index[server_name]
+	if not files then
+		return self:ret(true, "cloudflare is not used")
+	end
+	if self.datastore:get("plugin_cloudflare_no_cert_" .. server_name) then
+		if self.metrics then
+			count(self.metrics, "cert_negative_hit")
+		end
+		return self:ret(true, "no usable origin certificate for " .. server_name .. " (cached)")
+	end
+	local check, content = read_files(files)
+	if check then
+		data, err = parse_origin_cert(content)
+	else
+		err = "error while reading files : " .. content
+	end
+	if self.metrics then
+		count(self.metrics, data and "cert_load" or "cert_load_error")
+	end
+	if not data then
+		self.datastore:set("plugin_cloudflare_no_cert_" .. server_name, true, NO_CERT_TTL)
+		return self:ret(false, "can't load origin certificate for " .. server_name .. " : " .. err)
+	end
+	if lru then
+		lru:set(server_name, data)
+	end
+	return self:ret(true, "certificate/key data loaded", data)
+end
+
+-- Return the worker-local LRU of parsed origin certificates, creating it on first use.
+function cloudflare:get_cert_lru()
+	if not cert_lru then
+		local err
+		cert_lru, err = lrucache.new(tonumber(self.variables["CLOUDFLARE_ORIGIN_CERTS_CACHE_SIZE"]) or 1000)
+		if not cert_lru then
+			self.logger:log(ERR, "can't create the origin certificates LRU : " .. err)
+		end
+	end
+	return cert_lru
+end
+
+function cloudflare:load_data(data, server_name)
+	local cert_key, err = parse_origin_cert(data)
+	if not cert_key then
+		return false, err
 	end
 	-- Cache parsed cert/key in the internalstore (worker-local, like the letsencrypt
 	-- core plugin) so private keys never reach the API-exposed datastore.
 	for key in server_name:gmatch("%S+") do
 		local ok
-		ok, err = self.internalstore:set("plugin_cloudflare_" .. key, { cert_chain, priv_key }, nil, true)
+		ok, err = self.internalstore:set("plugin_cloudflare_" .. key, cert_key, nil, true)
 		if not ok then
 			return false, "error while setting data into internalstore : " .. err
 		end
@@ -270,31 +658,108 @@ function cloudflare:load_data(data, server_name)
 	return true
 end
 
+-- Return the compiled classifier for the current service, building it on the first
+-- cache miss of the service within the current snapshot generation.
+function cloudflare:get_classifier()
+	local service = self.service
+	if not service then
+		return nil, "trusted_ips is nil"
+	end
+	if not service.classifier then
+		local classifier, err = new_classifier(service.trusted_ips)
+		if not classifier then
+			return nil, err
+		end
+		if self.metrics then
+			count(self.metrics, "matcher_build")
+		end
+		service.classifier = classifier
+	end
+	return service.classifier
+end
+
+-- Return the worker-local verdict LRU, creating it on first use.
+function cloudflare:get_trust_lru()
+	if not trust_lru then
+		local err
+		trust_lru, err = lrucache.new(tonumber(self.variables["CLOUDFLARE_TRUST_CACHE_SIZE"]) or 10000)
+		if not trust_lru then
+			self.logger:log(ERR, "can't create the trust verdict LRU : " .. err)
+		end
+	end
+	return trust_lru
+end
+
 -- Compute (and cache) the trust verdict for an address: "ipv4"/"ipv6"/"additional"
 -- when trusted, "ko" when not. Returns nil, err on failure (callers fail open).
 function cloudflare:peer_trust(addr)
+	-- Worker LRU first. Services without an additional list share IP-only entries, so
+	-- the bare IP is the key and no key string has to be built on a hit.
+	local lru = self:get_trust_lru()
+	local additional = self.variables["CLOUDFLARE_ADDITIONAL_TRUSTED_FROM"]
+	local lru_key = addr
+	if additional and additional:find("%S") then
+		lru_key = verdict_key(worker_generation, self.ctx.bw.server_name, addr, additional)
+	end
+	if lru then
+		local cached = lru:get(lru_key)
+		if cached then
+			if self.metrics then
+				count(self.metrics, "trust_lru_hit")
+			end
+			return cached
+		end
+	end
+	local ttl = tonumber(self.variables["CLOUDFLARE_TRUST_CACHE_TTL"]) or 86400
 	local ok, cached = self:is_in_cache(addr)
 	if not ok then
 		self.logger:log(ERR, "error while checking cache : " .. cached)
 	elseif classify_cache(cached) ~= "miss" then
+		if self.metrics then
+			count(self.metrics, "trust_cache_hit")
+		end
+		if lru then
+			lru:set(lru_key, cached, ttl)
+		end
 		return cached
 	end
-	if not self.trusted_ips then
-		return nil, "trusted_ips is nil"
+	if self.metrics then
+		count(self.metrics, "trust_cache_miss")
+	end
+	local classifier, err = self:get_classifier()
+	if not classifier then
+		return nil, err
 	end
-	local trusted, kind_or_err = match_trusted(self.trusted_ips, addr, ipmatcher_new)
+	local trusted, kind_or_err = classify(classifier, addr)
 	if trusted == nil then
 		return nil, kind_or_err
 	end
 	local verdict = kind_or_err -- "ipv4"/"ipv6"/"additional" or "ko"
-	local err
-	ok, err = self:add_to_cache(addr, verdict)
+	if lru then
+		lru:set(lru_key, verdict, ttl)
+	end
+	ok, err = self:add_to_cache(addr, verdict, ttl)
 	if not ok then
 		self.logger:log(ERR, "error while adding element to cache : " .. err)
 	end
 	return verdict
 end
 
+-- peer_trust() with its latency recorded when metrics are enabled (see ssl_certificate()
+-- for the clock), counting the errors the callers fail open on.
+function cloudflare:timed_peer_trust(addr)
+	if not self.metrics then
+		return self:peer_trust(addr)
+	end
+	local start = clock()
+	local verdict, err = self:peer_trust(addr)
+	observe(self.metrics, "peer_trust", clock() - start)
+	if verdict == nil then
+		count(self.metrics, "fail_open_error")
+	end
+	return verdict, err
+end
+
 function cloudflare:access()
 	-- Check if access is needed
 	if not self:is_needed() then
@@ -349,12 +814,15 @@ function cloudflare:access()
 	-- Fail open until the trusted ranges have loaded, so we never deny everyone (or
 	-- cache a bogus "ko" for a legitimate IP) during the brief window before the
 	-- cf-trusted-ips-download.py job has populated the list.
-	if trusted_list_empty(self.trusted_ips) then
+	if not self.service or self.service.empty then
+		if self.metrics then
+			count(self.metrics, "fail_open_empty")
+		end
 		return self:ret(true, "cloudflare trusted IP list not loaded yet, allowing")
 	end
 
 	local realip_remote_addr = var.realip_remote_addr
-	local verdict, err = self:peer_trust(realip_remote_addr)
+	local verdict, err = self:timed_peer_trust(realip_remote_addr)
 	if verdict == nil then
 		-- Fail open: never deny because of an internal error.
 		self.logger:log(
@@ -388,11 +856,14 @@ function cloudflare:preread()
 		return self:ret(true, "cloudflare trust check not needed")
 	end
 	-- Fail open until the trusted ranges have loaded (see access()).
-	if trusted_list_empty(self.trusted_ips) then
+	if not self.service or self.service.empty then
+		if self.metrics then
+			count(self.metrics, "fail_open_empty")
+		end
 		return self:ret(true, "cloudflare trusted IP list not loaded yet, allowing")
 	end
 	local realip_remote_addr = var.realip_remote_addr
-	local verdict, err = self:peer_trust(realip_remote_addr)
+	local verdict, err = self:timed_peer_trust(realip_remote_addr)
 	if verdict == nil then
 		self.logger:log(
 			ERR,
@@ -408,15 +879,31 @@ function cloudflare:preread()
 end
 
 function cloudflare:is_in_cache(ele)
-	local ok, data = self.cachestore_local:get(cache_key(self.ctx.bw.server_name, ele))
+	local ok, data = self.cachestore_local:get(
+		verdict_key(
+			worker_generation,
+			self.ctx.bw.server_name,
+			ele,
+			self.variables["CLOUDFLARE_ADDITIONAL_TRUSTED_FROM"]
+		)
+	)
 	if not ok then
 		return false, data
 	end
 	return true, data
 end
 
-function cloudflare:add_to_cache(ele, value)
-	local ok, err = self.cachestore_local:set(cache_key(self.ctx.bw.server_name, ele), value, 86400)
+function cloudflare:add_to_cache(ele, value, ttl)
+	local ok, err = self.cachestore_local:set(
+		verdict_key(
+			worker_generation,
+			self.ctx.bw.server_name,
+			ele,
+			self.variables["CLOUDFLARE_ADDITIONAL_TRUSTED_FROM"]
+		),
+		value,
+		ttl or 86400
+	)
 	if not ok then
 		return false, err
 	end
@@ -439,10 +926,53 @@ function cloudflare:api()
 		local n6 = (data and data.ipv6) and #data.ipv6 or 0
 		return self:ret(
 			true,
-			"cloudflare is up (trusted ranges: " .. tostring(n4) .. " IPv4, " .. tostring(n6) .. " IPv6)",
+			"cloudflare is up (trusted ranges: "
+				.. tostring(n4)
+				.. " IPv4, "
+				.. tostring(n6)
+				.. " IPv6, generation "
+				.. tostring(data and data.generation or "none")
+				.. ")",
 			HTTP_OK
 		)
 	end
+	if self.ctx.bw.uri == "/cloudflare/metrics" and self.ctx.bw.request_method == "GET" then
+		if not self.metrics then
+			return self:ret(true, "cloudflare metrics are disabled", HTTP_OK)
+		end
+		-- Sum the snapshots published by the other workers with this worker's live view.
+		local total = new_metrics()
+		local workers = 0
+		local current = worker.id()
+		for id = 0, worker.count() - 1 do
+			if id == current then
+				merge_metrics(total, metrics)
+				workers = workers + 1
+			else
+				local raw = self.datastore:get("plugin_cloudflare_metrics_" .. tostring(id))
+				if raw then
+					local ok, snapshot = pcall(decode, raw)
+					if ok and type(snapshot) == "table" then
+						merge_metrics(total, snapshot)
+						workers = workers + 1
+					end
+				end
+			end
+		end
+		local counters = total.counters
+		local trust_lookups = (counters.trust_cache_hit or 0) + (counters.trust_cache_miss or 0)
+		total.workers = workers
+		total.latency_buckets_us = cloudflare_helpers.LATENCY_BUCKETS
+		total.hit_ratios = {
+			trust_lru = hit_ratio(counters.trust_lru_hit, trust_lookups),
+			trust_cache = hit_ratio(
+				(counters.trust_lru_hit or 0) + (counters.trust_cache_hit or 0),
+				counters.trust_cache_miss
+			),
+			cert = hit_ratio(counters.cert_hit, (counters.cert_load or 0) + (counters.cert_load_error or 0)),
+		}
+		return self:ret(true, total, HTTP_OK)
+	end
 	return self:ret(false, "success")
 end
 
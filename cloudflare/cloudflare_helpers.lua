@@ -1,9 +1,21 @@
 -- Pure helpers extracted from cloudflare.lua so they can be unit-tested with
 -- busted outside the OpenResty runtime. No ngx/resty dependencies (the IP matcher
 -- is injected) — see spec/cloudflare_helpers_spec.lua.
+local floor = math.floor
+local ipairs = ipairs
+local pairs = pairs
+local tonumber = tonumber
 
 local _M = {}
 
+-- Trust kinds in priority order : when several kinds contain an address, the first one
+-- wins (the index is the "rank" stored in the classifier trie).
+local KINDS = { "ipv4", "ipv6", "additional" }
+
+-- Value of bit i (MSB first) within a byte is floor(byte / BIT[i + 1]) % 2. Arithmetic
+-- instead of bit ops so the module runs unchanged on LuaJIT and Lua 5.4 (busted).
+local BIT = { 128, 64, 32, 16, 8, 4, 2, 1 }
+
 -- Split a space-separated string of IPs/networks into a list. Tolerates nil/empty
 -- (the setting may be absent in the phase where initialize() runs).
 function _M.parse_additional(str)
@@ -20,8 +32,21 @@ function _M.cache_key(server_name, ele)
 	return "plugin_cloudflare_" .. tostring(server_name) .. "_" .. tostring(ele)
 end
 
+-- Build the cache key of a trust verdict. The generation of the trusted ranges it was
+-- computed from is part of the key, so verdicts cached before a reload that changed the
+-- lists are never read again (they expire by themselves). A verdict only depends on the
+-- service when it has its own CLOUDFLARE_ADDITIONAL_TRUSTED_FROM list ; otherwise it is
+-- keyed by IP alone (an empty server_name, which no real service has) so every multisite
+-- service shares one entry per Cloudflare edge IP instead of caching it once per service.
+function _M.verdict_key(generation, server_name, ele, additional)
+	if not additional or not additional:find("%S") then
+		server_name = ""
+	end
+	return _M.cache_key(tostring(generation) .. "_" .. server_name, ele)
+end
+
 -- Map a cached trust verdict to an action. The cache stores the *string* result of
--- match_trusted ("ipv4"/"ipv6"/"additional" when trusted, "ko" when not, nil on a
+-- classify ("ipv4"/"ipv6"/"additional" when trusted, "ko" when not, nil on a
 -- miss). Returning a boolean here is what silently disabled the deny feature before
 -- (a cached "ko" took the allow branch), hence this is unit-tested.
 function _M.classify_cache(cached)
@@ -51,25 +76,291 @@ function _M.trusted_list_empty(trusted_ips)
 	return true
 end
 
--- Decide whether addr is a trusted Cloudflare/additional IP. Checks ipv4, then ipv6,
--- then additional, returning (true, "<kind>") on the first match, (false, "ko") when
--- nothing matches, or (nil, err) if a matcher can't be built / errors. new_matcher is
--- injected (resty.ipmatcher.new in production, a fake in tests).
-function _M.match_trusted(trusted_ips, addr, new_matcher)
-	for _, kind in ipairs({ "ipv4", "ipv6", "additional" }) do
-		local matcher, err = new_matcher(trusted_ips[kind] or {})
-		if not matcher then
-			return nil, err
+-- Address family of a textual IP: "ipv6" when it contains a colon, else "ipv4". Used to
+-- route an address to the single Cloudflare list that can ever contain it.
+function _M.addr_family(addr)
+	if addr and addr:find(":", 1, true) then
+		return "ipv6"
+	end
+	return "ipv4"
+end
+
+-- Parse a dotted-quad IPv4 into its 4 bytes, or nil. Octets with leading zeros are
+-- rejected, like Python's ipaddress (the jobs' classifier must give the same verdicts).
+local function parse_ipv4(str)
+	local octets = { str:match("^(%d+)%.(%d+)%.(%d+)%.(%d+)$") }
+	if #octets ~= 4 then
+		return nil
+	end
+	local bytes = {}
+	for i, octet in ipairs(octets) do
+		if #octet > 3 or (#octet > 1 and octet:sub(1, 1) == "0") then
+			return nil
+		end
+		bytes[i] = tonumber(octet)
+		if bytes[i] > 255 then
+			return nil
+		end
+	end
+	return bytes
+end
+
+-- Parse colon-separated IPv6 groups (one side of a "::") into bytes, or nil. An
+-- embedded IPv4 is only accepted as the very last group when allow_ipv4 is set.
+local function parse_groups(str, allow_ipv4)
+	local bytes = {}
+	if str == "" then
+		return bytes
+	end
+	local pieces = {}
+	for piece in (str .. ":"):gmatch("([^:]*):") do
+		pieces[#pieces + 1] = piece
+	end
+	for i, piece in ipairs(pieces) do
+		if piece:find(".", 1, true) then
+			local v4 = i == #pieces and allow_ipv4 and parse_ipv4(piece)
+			if not v4 then
+				return nil
+			end
+			for _, byte in ipairs(v4) do
+				bytes[#bytes + 1] = byte
+			end
+		elseif piece:match("^%x%x?%x?%x?$") then
+			local group = tonumber(piece, 16)
+			bytes[#bytes + 1] = floor(group / 256)
+			bytes[#bytes + 1] = group % 256
+		else
+			return nil
+		end
+	end
+	return bytes
+end
+
+-- Parse an IPv6 (with optional "::" compression and trailing embedded IPv4) into its
+-- 16 bytes, or nil.
+local function parse_ipv6(str)
+	if str:find("[^%x:%.]") then
+		return nil
+	end
+	local head, tail = str, nil
+	local compressed = str:find("::", 1, true)
+	if compressed then
+		head, tail = str:sub(1, compressed - 1), str:sub(compressed + 2)
+		if tail:find("::", 1, true) then
+			return nil
+		end
+	end
+	local head_bytes = parse_groups(head, tail == nil)
+	if not head_bytes then
+		return nil
+	end
+	if not tail then
+		return #head_bytes == 16 and head_bytes or nil
+	end
+	local tail_bytes = parse_groups(tail, true)
+	-- "::" stands for at least one zero group.
+	if not tail_bytes or #head_bytes + #tail_bytes > 14 then
+		return nil
+	end
+	for _ = 1, 16 - #head_bytes - #tail_bytes do
+		head_bytes[#head_bytes + 1] = 0
+	end
+	for _, byte in ipairs(tail_bytes) do
+		head_bytes[#head_bytes + 1] = byte
+	end
+	return head_bytes
+end
+
+-- Parse a textual address into (family, bytes) where family is "ipv4" or "ipv6" and
+-- bytes its 4 or 16 network-order bytes. Returns (nil, err) when it is not an IP.
+function _M.parse_ip(addr)
+	if type(addr) ~= "string" then
+		return nil, "invalid IP address " .. tostring(addr)
+	end
+	local bytes
+	if _M.addr_family(addr) == "ipv6" then
+		bytes = parse_ipv6(addr)
+		if bytes then
+			return "ipv6", bytes
+		end
+	else
+		bytes = parse_ipv4(addr)
+		if bytes then
+			return "ipv4", bytes
+		end
+	end
+	return nil, "invalid IP address " .. addr
+end
+
+-- Parse an IP or CIDR into (family, bytes, prefix_len). A bare IP is a /32 or /128 and
+-- host bits past the prefix are ignored (1.2.3.4/24 is 1.2.3.0/24), like resty.ipmatcher.
+function _M.parse_cidr(cidr)
+	local addr, prefix = tostring(cidr):match("^([^/]+)/(%d+)$")
+	local family, bytes = _M.parse_ip(addr or cidr)
+	if not family then
+		return nil, "invalid IP/network " .. tostring(cidr)
+	end
+	local max = #bytes * 8
+	prefix = prefix and tonumber(prefix) or max
+	if prefix > max then
+		return nil, "invalid IP/network " .. tostring(cidr)
+	end
+	return family, bytes, prefix
+end
+
+-- Build a prefix-trie classifier over every kind of trusted_ips ({ ipv4 = {...},
+-- ipv6 = {...}, additional = {...} }). Each family gets a binary trie whose nodes hold
+-- the best (lowest) kind rank of the networks ending there, so classify() answers
+-- "which kind, if any, contains this address" in one walk of at most 32/128 bits
+-- however many networks are loaded. Returns (nil, err) on the first invalid entry so
+-- callers keep failing open.
+function _M.new_classifier(trusted_ips)
+	local classifier = { ipv4 = {}, ipv6 = {} }
+	for rank, kind in ipairs(KINDS) do
+		for _, cidr in ipairs(trusted_ips[kind] or {}) do
+			local family, bytes, prefix = _M.parse_cidr(cidr)
+			if not family then
+				return nil, bytes
+			end
+			local node = classifier[family]
+			for i = 0, prefix - 1 do
+				local bit = floor(bytes[floor(i / 8) + 1] / BIT[i % 8 + 1]) % 2
+				local child = node[bit]
+				if not child then
+					child = {}
+					node[bit] = child
+				end
+				node = child
+			end
+			if not node.rank or rank < node.rank then
+				node.rank = rank
+			end
+		end
+	end
+	return classifier
+end
+
+-- Classify addr with a classifier from new_classifier() : (true, "<kind>") when trusted,
+-- (false, "ko") when not, (nil, err) on an invalid address.
+function _M.classify(classifier, addr)
+	local family, bytes = _M.parse_ip(addr)
+	if not family then
+		return nil, bytes
+	end
+	local node = classifier[family]
+	local best = node.rank
+	for i = 0, #bytes * 8 - 1 do
+		if best == 1 then
+			break
 		end
-		local matched, merr = matcher:match(addr)
-		if merr then
-			return nil, merr
+		node = node[floor(bytes[floor(i / 8) + 1] / BIT[i % 8 + 1]) % 2]
+		if not node then
+			break
 		end
-		if matched then
-			return true, kind
+		if node.rank and (not best or node.rank < best) then
+			best = node.rank
 		end
 	end
+	if best then
+		return true, KINDS[best]
+	end
 	return false, "ko"
 end
 
+-- Upper bounds (microseconds) of the latency histogram buckets reported by the
+-- /cloudflare/metrics API route ; slower observations land in one extra "+Inf" bucket.
+_M.LATENCY_BUCKETS = { 10, 50, 100, 500, 1000, 5000 }
+
+-- Fresh metrics of one worker : plain counters plus one latency histogram per timed
+-- operation, both created on first use.
+function _M.new_metrics()
+	return { counters = {}, latency = {} }
+end
+
+-- Count n (default 1) events under name.
+function _M.count(metrics, name, n)
+	local counters = metrics.counters
+	counters[name] = (counters[name] or 0) + (n or 1)
+end
+
+-- Record a duration (seconds) in the histogram of name. Buckets are not cumulative :
+-- buckets[i] counts the observations in (LATENCY_BUCKETS[i - 1], LATENCY_BUCKETS[i]].
+function _M.observe(metrics, name, seconds)
+	local bounds = _M.LATENCY_BUCKETS
+	local histogram = metrics.latency[name]
+	if not histogram then
+		histogram = { buckets = {}, count = 0, sum_us = 0 }
+		for i = 1, #bounds + 1 do
+			histogram.buckets[i] = 0
+		end
+		metrics.latency[name] = histogram
+	end
+	local us = seconds * 1000000
+	local i = 1
+	while bounds[i] and us > bounds[i] do
+		i = i + 1
+	end
+	histogram.buckets[i] = histogram.buckets[i] + 1
+	histogram.count = histogram.count + 1
+	histogram.sum_us = histogram.sum_us + us
+end
+
+-- Add the metrics of one worker into total. Either may come back from a JSON round trip
+-- through the datastore, so missing tables are tolerated.
+function _M.merge_metrics(total, metrics)
+	for name, value in pairs(metrics.counters or {}) do
+		_M.count(total, name, value)
+	end
+	for name, histogram in pairs(metrics.latency or {}) do
+		local into = total.latency[name]
+		if not into then
+			into = { buckets = {}, count = 0, sum_us = 0 }
+			total.latency[name] = into
+		end
+		for i, n in ipairs(histogram.buckets or {}) do
+			into.buckets[i] = (into.buckets[i] or 0) + n
+		end
+		into.count = into.count + (histogram.count or 0)
+		into.sum_us = into.sum_us + (histogram.sum_us or 0)
+	end
+	return total
+end
+
+-- Share of hits among hits + misses, nil when nothing was counted yet.
+function _M.hit_ratio(hits, misses)
+	hits = hits or 0
+	local total = hits + (misses or 0)
+	if total == 0 then
+		return nil
+	end
+	return hits / total
+end
+
+-- True when Redis' notify-keyspace-events flags publish what the ban events watcher
+-- needs : keyspace channels (K) for set ($), del / expire (g) and expired (x) events,
+-- "A" standing for every event class.
+function _M.keyspace_events_enabled(flags)
+	if type(flags) ~= "string" or not flags:find("K", 1, true) then
+		return false
+	end
+	if flags:find("A", 1, true) then
+		return true
+	end
+	for _, class in ipairs({ "g", "$", "x" }) do
+		if not flags:find(class, 1, true) then
+			return false
+		end
+	end
+	return true
+end
+
+-- Key carried by a keyspace notification channel ("__keyspace@0__:bans_ip_1.2.3.4"), or
+-- nil for any other channel.
+function _M.keyspace_key(channel)
+	if type(channel) ~= "string" then
+		return nil
+	end
+	return channel:match("^__keyspace@%d+__:(.+)$")
+end
+
 return _M
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+from json import dumps
 from os import getenv, sep
 from os.path import dirname, join
 from sys import exit as sys_exit, path as sys_path
@@ -20,9 +21,11 @@ from logger import setup_logger  # type: ignore
 from common_utils import bytes_hash  # type: ignore
 from jobs import Job  # type: ignore
 
-from cloudflare_helpers import CF_AOP_CA_DEFAULT_URL  # type: ignore
+from cloudflare_helpers import CF_AOP_CA_DEFAULT_URL, conditional_headers, load_validators, response_validators  # type: ignore
 
 LOGGER = setup_logger("CLOUDFLARE.AOP-CA-DOWNLOAD", getenv("LOG_LEVEL", "INFO"))
+# ETag / Last-Modified of the CA URL, sent back as conditional request headers.
+VALIDATORS_FILE = "aop_ca_validators.json"
 status = 0
 
 
@@ -62,8 +65,15 @@ try:
     session.mount("http://", adapter)
     session.mount("https://", adapter)
 
+    validators = load_validators(JOB.get_cache(VALIDATORS_FILE))
+    # Only conditional while we still have the CA, a 304 would otherwise leave us without one.
+    headers = conditional_headers(validators.get(url)) if JOB.cache_hash("aop_ca.pem") else {}
+
     LOGGER.info(f"Downloading Cloudflare Authenticated Origin Pull CA from {url}...")
-    resp = session.get(url, timeout=timeout, allow_redirects=True, verify=True)
+    resp = session.get(url, headers=headers, timeout=timeout, allow_redirects=True, verify=True)
+    if resp.status_code == 304:
+        LOGGER.info("AOP CA is not modified since the last download, reload is not needed")
+        sys_exit(0)
     if resp.status_code != 200:
         LOGGER.error(f"Got status code {resp.status_code} while downloading the AOP CA, skipping...")
         sys_exit(2)
@@ -77,17 +87,25 @@ try:
         sys_exit(2)
 
     new_hash = bytes_hash(content)
-    if new_hash == JOB.cache_hash("aop_ca.pem"):
+    if new_hash != JOB.cache_hash("aop_ca.pem"):
+        cached, err = JOB.cache_file("aop_ca.pem", content, checksum=new_hash)
+        if not cached:
+            LOGGER.error(f"Error while caching the AOP CA : {err}")
+            sys_exit(2)
+        status = 1
+
+    source_validators = response_validators(resp.headers)
+    new_validators = {url: source_validators} if source_validators else {}
+    if new_validators != validators:
+        cached, err = JOB.cache_file(VALIDATORS_FILE, dumps(new_validators, sort_keys=True).encode())
+        if not cached:
+            LOGGER.warning(f"Error while caching the download validators, the next download won't be conditional : {err}")
+
+    if not status:
         LOGGER.info("AOP CA is identical to the cached one, reload is not needed")
         sys_exit(0)
 
-    cached, err = JOB.cache_file("aop_ca.pem", content, checksum=new_hash)
-    if not cached:
-        LOGGER.error(f"Error while caching the AOP CA : {err}")
-        sys_exit(2)
-
     LOGGER.info("🔒 Successfully downloaded the Cloudflare Authenticated Origin Pull CA ✅")
-    status = 1
 except SystemExit as e:
     status = e.code
 except:
@@ -3,6 +3,7 @@
 from os import getenv, sep
 from os.path import dirname, join
 from sys import exit as sys_exit, path as sys_path
+from time import perf_counter, sleep, time
 
 # BunkerWeb deps + this job's own directory (for cloudflare_helpers).
 sys_path.insert(0, dirname(__file__))
@@ -10,17 +11,93 @@ for deps_path in [join(sep, "usr", "share", "bunkerweb", *paths) for paths in ((
     if deps_path not in sys_path:
         sys_path.append(deps_path)
 
-from cloudflare import APIError, Cloudflare  # type: ignore
+from cloudflare import APIError, Cloudflare, RateLimitError  # type: ignore
 
 from logger import setup_logger  # type: ignore
 from common_utils import get_redis_client  # type: ignore
+from jobs import Job  # type: ignore
 
-from cloudflare_helpers import CF_API_DEFAULT_URL, get_env_secret, parse_ban_key  # type: ignore
+from cloudflare_helpers import (  # type: ignore
+    CF_API_DEFAULT_URL,
+    chunked,
+    collapse_bans,
+    dump_sync_state,
+    full_sync_due,
+    get_env_secret,
+    group_ban_keys,
+    load_sync_state,
+    parse_ban_date,
+    plan_edge_sync,
+    read_ban_changes,
+    retry_after_seconds,
+    select_bans,
+)
 
 LOGGER = setup_logger("CLOUDFLARE.EDGE-BAN-SYNC", getenv("LOG_LEVEL", "INFO"))
 status = 0
 # Cloudflare's default per-account IP List capacity. We never push more than this.
 MAX_ITEMS = 10000
+# Last-synced state (list id, pushed IPs, last full reconcile) kept in the job cache.
+STATE_FILE = "edge_ban_state.json"
+# Ban keys whose TTL and value are fetched per Redis round trip when ranking bans.
+PIPELINE_BATCH = 500
+# How many times a rate-limited (429) call is retried, honoring Retry-After.
+RATE_LIMIT_RETRIES = 5
+# How long to wait for one bulk list operation to complete, in seconds.
+OPERATION_TIMEOUT = 120
+
+
+def rate_limited(call, what: str):
+    """Run ``call``, sleeping and retrying on 429 as told by Cloudflare's Retry-After."""
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        try:
+            return call()
+        except RateLimitError as e:
+            if attempt == RATE_LIMIT_RETRIES:
+                raise
+            delay = retry_after_seconds(e.response.headers.get("retry-after"), 2**attempt)
+            LOGGER.warning(f"Rate limited by Cloudflare while {what}, retrying in {delay:.0f}s...")
+            sleep(delay)
+
+
+def wait_operation(client: Cloudflare, account_id: str, operation_id: str):
+    """Poll a bulk list operation until it is done. Returns ``(status, error)``."""
+    deadline = perf_counter() + OPERATION_TIMEOUT
+    delay = 0.5
+    while True:
+        operation = rate_limited(lambda: client.rules.lists.bulk_operations.get(operation_id, account_id=account_id), "polling a bulk operation")
+        status = getattr(operation, "status", None)
+        if status in ("completed", "failed"):
+            return status, getattr(operation, "error", None)
+        if perf_counter() >= deadline:
+            return "timeout", f"still {status} after {OPERATION_TIMEOUT}s"
+        sleep(delay)
+        delay = min(delay * 2, 5)
+
+
+def run_bulk(client: Cloudflare, account_id: str, verb: str, submit, entries: list, chunk_size: int) -> tuple:
+    """Submit ``entries`` in chunks and wait for each bulk operation to complete.
+
+    Returns ``(done, failed)``: the chunks whose operation completed and the number of
+    chunks that did not (failed, timed out or rejected), logging per-chunk timings.
+    """
+    chunks = list(chunked(entries, chunk_size))
+    done = []
+    for index, chunk in enumerate(chunks):
+        start = perf_counter()
+        try:
+            response = rate_limited(lambda: submit(chunk), f"submitting chunk {index + 1}/{len(chunks)} ({verb})")
+            status, error = wait_operation(client, account_id, response.operation_id)
+        except APIError as e:
+            status, error = "rejected", e
+        elapsed = perf_counter() - start
+        if status == "completed":
+            done.append(chunk)
+            LOGGER.info(f"Chunk {index + 1}/{len(chunks)}: {verb} {len(chunk)} item(s) in {elapsed:.2f}s")
+        else:
+            LOGGER.error(f"Chunk {index + 1}/{len(chunks)}: failed to {verb} {len(chunk)} item(s) after {elapsed:.2f}s ({status}): {error}")
+    return done, len(chunks) - len(done)
+
 
 try:
     if getenv("USE_CLOUDFLARE_EDGE_BAN_SYNC", "no") != "yes":
@@ -42,6 +119,24 @@ try:
         sys_exit(2)
 
     list_name = getenv("CLOUDFLARE_BAN_LIST_NAME", "bunkerweb_bans")
+    incremental = getenv("CLOUDFLARE_EDGE_BAN_SYNC_MODE", "incremental") == "incremental"
+    try:
+        full_sync_interval = int(getenv("CLOUDFLARE_EDGE_BAN_FULL_SYNC_INTERVAL", "3600"))
+    except ValueError:
+        full_sync_interval = 3600
+    priority = getenv("CLOUDFLARE_EDGE_BAN_PRIORITY", "recent")
+    try:
+        collapse_threshold = int(getenv("CLOUDFLARE_EDGE_BAN_COLLAPSE_THRESHOLD", "0"))
+    except ValueError:
+        collapse_threshold = 0
+    try:
+        chunk_size = max(int(getenv("CLOUDFLARE_EDGE_BAN_CHUNK_SIZE", "1000")), 1)
+    except ValueError:
+        chunk_size = 1000
+
+    JOB = Job(LOGGER, __file__)
+    state = load_sync_state(JOB.get_cache(STATE_FILE), account_id, list_name)
+    old_state = dump_sync_state(state)
 
     redis_client = get_redis_client(
         use_redis=True,
@@ -63,18 +158,60 @@ try:
         LOGGER.error("Could not connect to Redis, skipping edge ban sync...")
         sys_exit(2)
 
-    # Collect currently banned IPs (both global and service-scoped) from Redis.
-    banned = set()
-    for pattern in ("bans_ip_*", "bans_service_*_ip_*"):
-        for key in redis_client.scan_iter(pattern):
-            ip = parse_ban_key(key)
-            if ip:
-                banned.add(ip)
-    LOGGER.info(f"Found {len(banned)} active banned IP(s) in Redis")
+    now = time()
+    full = not incremental or full_sync_due(state, full_sync_interval, now)
+    changes = None
+    if not full:
+        # Incremental: only re-read the ban keys the Lua watcher saw change since the
+        # previous run, the bans of the other IPs are taken from the state.
+        changes = read_ban_changes(redis_client, state.get("bans"), state.get("since"), now)
+        if changes is None:
+            LOGGER.info("Ban keyspace events don't cover the time since the previous run, scanning every ban key...")
+    if changes is not None:
+        ban_keys, since = changes
+        LOGGER.info(f"Found {len(ban_keys)} active banned IP(s) after applying the ban events since the previous run")
+    else:
+        # Collect currently banned IPs (both global and service-scoped) from Redis. A large
+        # COUNT hint keeps the number of SCAN round trips low with tens of thousands of keys.
+        since = now
+        ban_keys = group_ban_keys(key for pattern in ("bans_ip_*", "bans_service_*_ip_*") for key in redis_client.scan_iter(pattern, count=1000))
+        LOGGER.info(f"Found {len(ban_keys)} active banned IP(s) in Redis")
+    if incremental:
+        state.update(bans=ban_keys, since=since)
+    else:
+        state.pop("bans", None)
+        state.pop("since", None)
 
-    if len(banned) > MAX_ITEMS:
-        LOGGER.warning(f"More than {MAX_ITEMS} banned IPs ({len(banned)}); only {MAX_ITEMS} will be synced to the Cloudflare list")
-        banned = set(sorted(banned)[:MAX_ITEMS])
+    items = collapse_bans(ban_keys, collapse_threshold)
+    if len(items) < len(ban_keys):
+        LOGGER.info(f"Collapsed {len(ban_keys)} banned IP(s) into {len(items)} edge list item(s)")
+
+    banned = set(items)
+    if len(items) > MAX_ITEMS:
+        # Rank by ban metadata : TTL and value of every key, fetched in pipelined batches
+        # so the read phase stays at one round trip per PIPELINE_BATCH keys.
+        meta = {}
+        keys = [(ip, key) for ip, ip_keys in ban_keys.items() for key in ip_keys]
+        for batch in chunked(keys, PIPELINE_BATCH):
+            pipe = redis_client.pipeline(transaction=False)
+            for _, key in batch:
+                pipe.ttl(key)
+                pipe.get(key)
+            results = pipe.execute()
+            for (ip, _), ttl, value in zip(batch, results[::2], results[1::2]):
+                if ttl == -2:  # expired since the scan
+                    continue
+                ttl = float("inf") if ttl == -1 else float(ttl)
+                old_ttl, old_date = meta.get(ip, (0.0, 0.0))
+                meta[ip] = (max(ttl, old_ttl), max(parse_ban_date(value), old_date))
+        items = {item: members for item, members in items.items() if any(ip in meta for ip in members)}
+        if len(items) > MAX_ITEMS:
+            LOGGER.warning(
+                f"More than {MAX_ITEMS} edge list items ({len(items)}); only the {MAX_ITEMS} with the "
+                + ("longest remaining ban" if priority == "ttl" else "most recent ban")
+                + " will be synced to the Cloudflare list"
+            )
+        banned = select_bans(items, meta, MAX_ITEMS, priority)
 
     try:
         api_timeout = float(getenv("CLOUDFLARE_API_TIMEOUT", "10"))
@@ -82,52 +219,96 @@ try:
         api_timeout = 10.0
     client = Cloudflare(api_token=token, base_url=getenv("CLOUDFLARE_API_URL", CF_API_DEFAULT_URL).rstrip("/"), timeout=api_timeout)
 
-    # Find or create the account IP List.
-    list_id = None
-    try:
-        for lst in client.rules.lists.list(account_id=account_id):
-            if getattr(lst, "name", None) == list_name and getattr(lst, "kind", None) == "ip":
-                list_id = lst.id
-                break
-        if not list_id:
-            LOGGER.info(f"Creating Cloudflare IP List '{list_name}'...")
-            created = client.rules.lists.create(account_id=account_id, kind="ip", name=list_name)
-            list_id = created.id
-    except APIError as e:
-        LOGGER.error(f"Failed to find/create the Cloudflare IP List '{list_name}': {e}")
-        sys_exit(2)
+    to_add, to_remove, unknown = set(), {}, set()
+    if not full:
+        # Incremental: diff against what the previous runs pushed, no list download.
+        to_add, to_remove, unknown = plan_edge_sync(banned, state["items"])
+        if unknown:
+            LOGGER.info(f"{len(unknown)} IP(s) to remove were pushed since the last full sync, running a full reconcile to resolve them...")
+            full = True
 
-    # Current items in the list (ip -> item id).
-    current = {}
-    try:
-        for item in client.rules.lists.items.list(list_id=list_id, account_id=account_id):
-            ip = getattr(item, "ip", None)
-            if ip:
-                current[ip] = getattr(item, "id", None)
-    except APIError as e:
-        LOGGER.error(f"Failed to list items of the Cloudflare IP List: {e}")
-        sys_exit(2)
+    if full:
+        # Find or create the account IP List.
+        list_id = None
+        try:
+            for lst in client.rules.lists.list(account_id=account_id):
+                if getattr(lst, "name", None) == list_name and getattr(lst, "kind", None) == "ip":
+                    list_id = lst.id
+                    break
+            if not list_id:
+                LOGGER.info(f"Creating Cloudflare IP List '{list_name}'...")
+                created = client.rules.lists.create(account_id=account_id, kind="ip", name=list_name)
+                list_id = created.id
+        except APIError as e:
+            LOGGER.error(f"Failed to find/create the Cloudflare IP List '{list_name}': {e}")
+            sys_exit(2)
 
-    current_ips = set(current.keys())
-    to_add = banned - current_ips
-    to_remove = current_ips - banned
+        # Current items in the list (ip -> item id).
+        current = {}
+        try:
+            for item in client.rules.lists.items.list(list_id=list_id, account_id=account_id):
+                ip = getattr(item, "ip", None)
+                if ip:
+                    current[ip] = getattr(item, "id", None)
+        except APIError as e:
+            LOGGER.error(f"Failed to list items of the Cloudflare IP List: {e}")
+            sys_exit(2)
 
+        state.update(list_id=list_id, items=current, last_full_sync=now)
+        to_add, to_remove, _ = plan_edge_sync(banned, current)
+    list_id = state["list_id"]
+
+    # Rate limits on the bulk calls are handled by rate_limited(), with our own logging.
+    bulk_client = client.with_options(max_retries=0)
+    failed = 0
+    if to_add:
+        # Cloudflare applies list item changes asynchronously : each chunk is only
+        # recorded as pushed once its bulk operation completed.
+        done, failures = run_bulk(
+            bulk_client,
+            account_id,
+            "add",
+            lambda chunk: bulk_client.rules.lists.items.create(list_id=list_id, account_id=account_id, body=[{"ip": ip} for ip in chunk]),
+            sorted(to_add),
+            chunk_size,
+        )
+        for chunk in done:
+            # Item ids are only known after the next full reconcile.
+            state["items"].update(dict.fromkeys(chunk))
+        failed += failures
+        LOGGER.info(f"➕ Added {sum(map(len, done))}/{len(to_add)} IP(s) to the Cloudflare edge IP List")
+    if to_remove:
+        done, failures = run_bulk(
+            bulk_client,
+            account_id,
+            "remove",
+            lambda chunk: bulk_client.rules.lists.items.delete(list_id=list_id, account_id=account_id, items=[{"id": to_remove[ip]} for ip in chunk]),
+            sorted(to_remove),
+            chunk_size,
+        )
+        for chunk in done:
+            for ip in chunk:
+                state["items"].pop(ip, None)
+        failed += failures
+        LOGGER.info(f"➖ Removed {sum(map(len, done))}/{len(to_remove)} IP(s) from the Cloudflare edge IP List")
     if not to_add and not to_remove:
-        LOGGER.info("Cloudflare edge IP List already in sync with BunkerWeb bans, nothing to do")
-        sys_exit(0)
+        LOGGER.info(f"Cloudflare edge IP List already in sync with BunkerWeb bans ({'full' if full else 'incremental'} check), nothing to do")
+    if failed:
+        # A failed or timed out operation leaves the list in an unknown state : make the
+        # next run reconcile against the real list.
+        state["last_full_sync"] = 0
 
-    try:
-        if to_add:
-            client.rules.lists.items.create(list_id=list_id, account_id=account_id, body=[{"ip": ip} for ip in to_add])
-            LOGGER.info(f"➕ Queued {len(to_add)} IP(s) to add to the Cloudflare edge IP List")
-        if to_remove:
-            items = [{"id": current[ip]} for ip in to_remove if current.get(ip)]
-            if items:
-                client.rules.lists.items.delete(list_id=list_id, account_id=account_id, items=items)
-                LOGGER.info(f"➖ Queued {len(items)} IP(s) to remove from the Cloudflare edge IP List")
-    except APIError as e:
-        LOGGER.error(f"Failed to update the Cloudflare edge IP List: {e}")
+    new_state = dump_sync_state(state)
+    if new_state != old_state:
+        cached, err = JOB.cache_file(STATE_FILE, new_state)
+        if not cached:
+            LOGGER.warning(f"Error while caching the edge ban sync state, next run will do a full reconcile : {err}")
+
+    if failed:
+        LOGGER.error(f"{failed} bulk operation(s) on the Cloudflare edge IP List did not complete, they will be retried on the next run")
         sys_exit(2)
+    if not to_add and not to_remove:
+        sys_exit(0)
 
     LOGGER.info("☁️ Successfully synced BunkerWeb bans to the Cloudflare edge IP List ✅")
     # 0, not 1: the sync only changes Cloudflare's edge (no local nginx config changed).
@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from hashlib import sha256
 from json import dumps
 from os import getenv, sep
 from os.path import dirname, join
 from pathlib import Path
-from subprocess import run
 from sys import exit as sys_exit, path as sys_path
-from typing import Dict
+from threading import Lock
+from time import perf_counter, time
+from typing import Any, Dict, List, Tuple
 
 # BunkerWeb deps + this job's own directory (for cloudflare_helpers).
 sys_path.insert(0, dirname(__file__))
@@ -15,20 +18,25 @@ for deps_path in [join(sep, "usr", "share", "bunkerweb", *paths) for paths in ((
     if deps_path not in sys_path:
         sys_path.append(deps_path)
 
-from cloudflare import APIError, Cloudflare  # type: ignore
+from cloudflare import APIError, Cloudflare, DefaultHttpxClient  # type: ignore
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.x509.oid import NameOID
 
 from logger import setup_logger  # type: ignore
 from jobs import Job  # type: ignore
 
 from cloudflare_helpers import (  # type: ignore
     CF_API_DEFAULT_URL,
+    TokenBucket,
     build_csr_config,
-    find_matching_cert,
+    find_indexed_cert,
     get_env_secret,
+    index_certs,
     is_expired,
+    load_inventory,
     request_type_for,
     select_zone,
     select_zone_name,
@@ -41,16 +49,146 @@ try:
 except ValueError:
     CLOUDFLARE_API_TIMEOUT = 10.0
 CACHE_PATH = Path(sep, "var", "cache", "bunkerweb", "cloudflare")
+try:
+    WORKERS = int(getenv("CLOUDFLARE_ORIGIN_CERTS_WORKERS", "4"))
+except ValueError:
+    WORKERS = 4
+# Cloudflare allows 1200 API requests per 5 minutes per user: every request made with a
+# token (pagination and retries included) draws from that token's shared budget.
+API_RATE = 4.0
+API_BURST = 10
+try:
+    INVENTORY_TTL = int(getenv("CLOUDFLARE_ORIGIN_CERTS_INVENTORY_TTL", "0"))
+except ValueError:
+    INVENTORY_TTL = 0
+INVENTORY_FILE = "inventory.json"
 status = 0
 
-# Cache one SDK client per token (multisite services may use distinct tokens).
+# Cache one SDK client per token (multisite services may use distinct tokens), shared
+# by the service workers along with the token verification verdicts.
 _clients: Dict[str, Cloudflare] = {}
+_clients_lock = Lock()
+_tokens: Dict[str, bool] = {}
+_token_locks: Dict[str, Lock] = {}
+_job_lock = Lock()
 
 
 def get_client(api_token: str) -> Cloudflare:
-    if api_token not in _clients:
-        _clients[api_token] = Cloudflare(api_token=api_token, base_url=CLOUDFLARE_API_URL, timeout=CLOUDFLARE_API_TIMEOUT)
-    return _clients[api_token]
+    with _clients_lock:
+        if api_token not in _clients:
+            budget = TokenBucket(API_RATE, API_BURST)
+            _clients[api_token] = Cloudflare(
+                api_token=api_token,
+                base_url=CLOUDFLARE_API_URL,
+                timeout=CLOUDFLARE_API_TIMEOUT,
+                http_client=DefaultHttpxClient(event_hooks={"request": [lambda request: budget.acquire()]}),
+            )
+            _token_locks[api_token] = Lock()
+        return _clients[api_token]
+
+
+def token_is_valid(api_token: str, first_server: str) -> bool:
+    """token_is_active, verified once per token however many workers share it."""
+    client = get_client(api_token)
+    with _token_locks[api_token]:
+        if api_token not in _tokens:
+            LOGGER.info(f"Checking if the API token for {first_server} is valid...")
+            _tokens[api_token] = token_is_active(client)
+            if _tokens[api_token]:
+                LOGGER.info(f"🔑 API token for {first_server} is valid ✅")
+        return _tokens[api_token]
+
+
+class Inventory:
+    """Zones (per token) and Origin CA certificates (per zone), listed once per run.
+
+    Services resolving to the same zone share one ``zones.list`` and one
+    ``origin_ca_certificates.list`` call; a per-key lock makes concurrent workers wait
+    for the first listing instead of repeating it. Certificates created or revoked by
+    this run are reflected so later services see them.
+    """
+
+    def __init__(self, data: Dict[str, Any]):
+        self.data = data
+        self.changed = False
+        self._indexes: Dict[str, Dict[frozenset, Dict]] = {}
+        self._lock = Lock()
+        self._key_locks: Dict[Tuple[str, str], Lock] = {}
+
+    def _key_lock(self, *key: str) -> Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, Lock())
+
+    def zones(self, client: Cloudflare, api_token: str, zone_name: str) -> List[Dict]:
+        """Active zones named ``zone_name`` visible to ``api_token`` (raises APIError)."""
+        # Keyed by a token digest: never persist the token, nor share zones across tokens.
+        token_zones = self.data["zones"].setdefault(sha256(api_token.encode()).hexdigest(), {})
+        with self._key_lock("zones", zone_name):
+            if zone_name not in token_zones:
+                token_zones[zone_name] = [
+                    {"id": z.id, "name": z.name, "type": getattr(z, "type", ""), "modified_on": str(getattr(z, "modified_on", ""))}
+                    for z in client.zones.list(name=zone_name, status="active")
+                ]
+                self.changed = True
+            return token_zones[zone_name]
+
+    def index(self, client: Cloudflare, zone_id: str) -> Dict[frozenset, Dict]:
+        """The zone's Origin CA certificates indexed by hostname set (raises APIError)."""
+        with self._key_lock("certs", zone_id):
+            if zone_id not in self.data["certs"]:
+                # SDK auto-paginates
+                self.data["certs"][zone_id] = [
+                    {"id": c.id, "hostnames": list(getattr(c, "hostnames", []) or []), "expires_on": getattr(c, "expires_on", "")}
+                    for c in client.origin_ca_certificates.list(zone_id=zone_id)
+                ]
+                self.changed = True
+            if zone_id not in self._indexes:
+                self._indexes[zone_id] = index_certs(self.data["certs"][zone_id])
+            return self._indexes[zone_id]
+
+    def add_cert(self, zone_id: str, cert: Dict):
+        with self._key_lock("certs", zone_id):
+            if zone_id in self.data["certs"]:
+                self.data["certs"][zone_id].insert(0, cert)
+                self._indexes.pop(zone_id, None)
+                self.changed = True
+
+    def remove_cert(self, cert_id: str):
+        for zone_id in list(self.data["certs"]):
+            with self._key_lock("certs", zone_id):
+                certs = self.data["certs"][zone_id]
+                if any(cert.get("id") == cert_id for cert in certs):
+                    self.data["certs"][zone_id] = [cert for cert in certs if cert.get("id") != cert_id]
+                    self._indexes.pop(zone_id, None)
+                    self.changed = True
+
+
+def generate_key_and_csr(first_server: str, domains: List[str], key_type: str) -> Tuple[bytes, str]:
+    """Generate a service's private key (PEM, unencrypted) and CSR (PEM) in-process.
+
+    Same key and request ``openssl req -nodes -new`` produced from build_csr_config():
+    RSA 2048 or ECDSA P-256, the same subject and the domains as DNS SANs. Raises
+    ValueError if the request can't be built (e.g. a CN over 64 characters).
+    """
+    key = ec.generate_private_key(ec.SECP256R1()) if key_type == "ecdsa" else rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    subject = x509.Name(
+        [
+            x509.NameAttribute(NameOID.COUNTRY_NAME, "AU"),
+            x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, "Some-State"),
+            x509.NameAttribute(NameOID.ORGANIZATION_NAME, "Internet Widgits Pty Ltd"),
+            x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, "IT Department"),
+            x509.NameAttribute(NameOID.COMMON_NAME, first_server),
+            x509.NameAttribute(NameOID.EMAIL_ADDRESS, f"contact@{first_server}"),
+        ]
+    )
+    csr = (
+        x509.CertificateSigningRequestBuilder()
+        .subject_name(subject)
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName(domain) for domain in domains]), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    private_key = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    return private_key, csr.public_bytes(serialization.Encoding.PEM).decode()
 
 
 def token_is_active(client: Cloudflare) -> bool:
@@ -78,11 +216,261 @@ def revoke_cert(client: Cloudflare, first_server: str, cert_id: str) -> bool:
             return False
         LOGGER.warning(f"Certificate {cert_id} was already revoked")
 
+    INVENTORY.remove_cert(cert_id)
     for name in ("cert.id", "origin_cert.pem", "private.key", "csr.pem", "csr.conf"):
-        JOB.del_cache(name, service_id=first_server)
+        del_cache(name, service_id=first_server)
     return True
 
 
+def cache_file(*args, **kwargs):
+    """JOB.cache_file, serialized across the service workers."""
+    with _job_lock:
+        return JOB.cache_file(*args, **kwargs)
+
+
+def del_cache(*args, **kwargs):
+    """JOB.del_cache, serialized across the service workers."""
+    with _job_lock:
+        return JOB.del_cache(*args, **kwargs)
+
+
+def run_service(first_server: str) -> Tuple[int, float]:
+    """Worker entry point: process_service() timed, an exception counting as an error."""
+    start = perf_counter()
+    try:
+        service_status = process_service(first_server)
+    except Exception:
+        LOGGER.exception(f"Exception while managing the origin certificate of {first_server}")
+        service_status = 2
+    return service_status, perf_counter() - start
+
+
+def process_service(first_server: str) -> int:
+    """Provision, renew or revoke the origin certificate of one service.
+
+    Runs in a worker thread. Returns the service's contribution to the job status: 0
+    (nothing to do), 1 (new certificate, reload needed) or 2 (error).
+    """
+    service_cache_path = CACHE_PATH.joinpath(first_server)
+
+    cert_id_file = service_cache_path.joinpath("cert.id")
+    origin_cert_file = service_cache_path.joinpath("origin_cert.pem")
+    csr_file = service_cache_path.joinpath("csr.pem")
+    private_key_file = service_cache_path.joinpath("private.key")
+    csr_conf_file = service_cache_path.joinpath("csr.conf")
+
+    # * Getting all the necessary data (api_token / zone_id support the _FILE secret convention)
+    api_token = get_env_secret(f"{first_server}_CLOUDFLARE_API_TOKEN", "CLOUDFLARE_API_TOKEN").strip().removeprefix("Bearer ").strip()
+    data = {
+        "use_cloudflare": getenv(f"{first_server}_USE_CLOUDFLARE", getenv("USE_CLOUDFLARE", "no")),
+        "manage_origin_certs": getenv(f"{first_server}_CLOUDFLARE_MANAGE_ORIGIN_CERTS", getenv("CLOUDFLARE_MANAGE_ORIGIN_CERTS", "yes")),
+        "api_token": api_token,
+        "domains": [
+            domain for domain in (getenv(f"{first_server}_SERVER_NAME", getenv("SERVER_NAME", "")).lower() or first_server).strip().split(" ") if domain
+        ],
+        "zone_id": get_env_secret(f"{first_server}_CLOUDFLARE_ZONE_ID", "CLOUDFLARE_ZONE_ID"),
+        "type": getenv(f"{first_server}_CLOUDFLARE_ORIGIN_CERT_TYPE", getenv("CLOUDFLARE_ORIGIN_CERT_TYPE", "rsa")),
+        "validity": getenv(f"{first_server}_CLOUDFLARE_ORIGIN_CERT_VALIDITY", getenv("CLOUDFLARE_ORIGIN_CERT_VALIDITY", "5475")),
+    }
+
+    if data["use_cloudflare"] != "yes" or data["manage_origin_certs"] != "yes":
+        LOGGER.info(f"Skipping origin certs generation for {first_server} because it is not configured to use Cloudflare or manage origin certs")
+
+        if cert_id_file.is_file():
+            if not api_token or not token_is_valid(api_token, first_server):
+                LOGGER.warning(
+                    f"API token for {first_server} is either not set or invalid, therefore we cannot revoke the existing origin certificate, check your Cloudflare account to see if the certificate isn't still active"
+                )
+                for name in ("cert.id", "origin_cert.pem", "csr.pem", "private.key", "csr.conf"):
+                    del_cache(name, service_id=first_server)
+            else:
+                LOGGER.info(f"Revoking existing origin certificate for {first_server}...")
+                if revoke_cert(get_client(api_token), first_server, cert_id_file.read_text().strip()):
+                    LOGGER.info(f"Successfully deleted existing origin certificate for {first_server}")
+        elif origin_cert_file.is_file() or csr_file.is_file() or private_key_file.is_file() or csr_conf_file.is_file():
+            LOGGER.warning(
+                f"Cache files found for {first_server} but no certificate ID, therefore we cannot revoke the existing origin certificate, check your Cloudflare account to see if the certificate isn't still active"
+            )
+            for name in ("origin_cert.pem", "csr.pem", "private.key", "csr.conf"):
+                del_cache(name, service_id=first_server)
+        return 0
+
+    LOGGER.debug(f"Data for service {first_server}: {dumps({k: v for k, v in data.items() if k != 'api_token'})}")
+
+    # * Checking if the data is valid
+    if not data["api_token"]:
+        LOGGER.warning(f"API token for {first_server} is not set, skipping origin certs generation...")
+        return 2
+
+    client = get_client(data["api_token"])
+
+    # * Checking if the API token is valid (verified once per token across workers)
+    if not token_is_valid(data["api_token"], first_server):
+        LOGGER.warning(f"API token for {first_server} is invalid or not active, skipping origin certs generation...")
+        return 2
+
+    cert_id = None
+    expired = False
+    changed = False
+    # * Inspecting the locally cached cert/key/CSR config to decide if we must act
+    if cert_id_file.is_file():
+        cert_id = cert_id_file.read_text().strip()
+
+        if csr_conf_file.is_file():
+            LOGGER.info(f"CSR configuration file found for {first_server}, checking if the subdomains have changed...")
+            changed = csr_conf_file.read_text() != build_csr_config(first_server, data["domains"])
+
+        if origin_cert_file.is_file() and private_key_file.is_file():
+            LOGGER.info(f"Certificate file found for {first_server}, checking if the certificate is still valid...")
+            certificate = x509.load_pem_x509_certificate(origin_cert_file.read_bytes(), default_backend())
+            not_valid_after = certificate.not_valid_after_utc  # type: ignore[attr-defined]  # cryptography>=42 (image ships 49)
+            if not_valid_after < datetime.now(tz=not_valid_after.tzinfo):
+                expired = True
+
+            public_key = certificate.public_key()
+            if isinstance(public_key, rsa.RSAPublicKey) and data["type"] == "ecdsa":
+                LOGGER.warning(f"Certificate type for {first_server} does not match the one we want to generate (ECDSA vs RSA)")
+                changed = True
+            elif isinstance(public_key, ec.EllipticCurvePublicKey) and data["type"] == "rsa":
+                LOGGER.warning(f"Certificate type for {first_server} does not match the one we want to generate (RSA vs ECDSA)")
+                changed = True
+        else:
+            expired = True
+
+    try:
+        if not cert_id:
+            # * Getting the zone ID if it is not set
+            if not data["zone_id"]:
+                zone_name = select_zone_name(data["domains"])
+                LOGGER.info(f"Getting the active zone ID for {first_server} (querying zone '{zone_name}')...")
+
+                zones = INVENTORY.zones(client, data["api_token"], zone_name)
+                if not zones:
+                    LOGGER.error(f"No active zone found for {first_server}'s API token, skipping origin certs generation...")
+                    return 2
+                if len(zones) > 1:
+                    LOGGER.warning(f"More than one zone found for {first_server}, using the one with the most recent modification date...")
+
+                zone = select_zone(zones)
+                if not zone:
+                    return 2
+                data["zone_id"] = zone.get("id", "")
+                if not data["zone_id"]:
+                    return 2
+                LOGGER.info(f"🌐 Zone ID for {first_server} is {data['zone_id']} (name: {zone.get('name', '')}, type: {zone.get('type', '')})")
+
+            # * Looking up the zone's existing origin certificates (listed once per zone)
+            cert_id, found, cert_expired = find_indexed_cert(INVENTORY.index(client, data["zone_id"]), data["domains"])
+            if cert_expired:
+                expired = True
+            if not found:
+                cert_id = None
+
+            if cert_id and not expired:
+                if cert_id_file.is_file() and origin_cert_file.is_file() and private_key_file.is_file():
+                    LOGGER.info(f"Origin certificate for {','.join(data['domains'])} already exists, skipping origin certs generation...")
+                    return 0
+                LOGGER.info(f"Origin certificate for {','.join(data['domains'])} exists on Cloudflare's side but not locally, regenerating it...")
+                expired = True
+        elif not expired and not changed:
+            LOGGER.info(
+                f"Origin certificate for {','.join(data['domains'])} already exists and is still valid locally, checking if it is still valid on Cloudflare's side..."
+            )
+            remote = client.origin_ca_certificates.get(cert_id)
+            if is_expired(getattr(remote, "expires_on", "")):
+                expired = True
+            else:
+                LOGGER.info(f"Origin certificate for {','.join(data['domains'])} is still valid on Cloudflare's side, no need to regenerate it")
+                return 0
+    except APIError as e:
+        LOGGER.error(f"Cloudflare API error while resolving certificate state for {first_server}: {e}")
+        return 2
+
+    if cert_id and (expired or changed):
+        LOGGER.info(f"Origin certificate for {','.join(data['domains'])} has {'expired' if expired else 'changed'}, revoking it...")
+        if revoke_cert(client, first_server, cert_id):
+            LOGGER.info(f"Successfully deleted expired origin certificate for {','.join(data['domains'])}")
+            cert_id = None
+
+    # * Generating the CSR + private key if they are missing or the subdomains changed.
+    # (CSRs have no expiry — regeneration is driven only by missing files / changes.)
+    csr_content = csr_file.read_text() if csr_file.is_file() else None
+    if not csr_content or changed:
+        if changed:
+            LOGGER.info(f"Subdomains for {first_server} have changed, generating a new Certificate Signing Request (CSR)...")
+        else:
+            LOGGER.info(f"Generating a Certificate Signing Request (CSR) for {first_server}")
+
+        try:
+            private_key, csr_content = generate_key_and_csr(first_server, data["domains"], data["type"])
+        except ValueError as e:
+            LOGGER.error(f"CSR generation failed for {first_server}: {e}")
+            return 2
+
+        cached, err = cache_file("csr.pem", csr_content.encode(), service_id=first_server)
+        if not cached:
+            LOGGER.error(f"Error while caching csr.pem file for {first_server} : {err}")
+            return 2
+
+        cached, err = cache_file("private.key", private_key, service_id=first_server)
+        if not cached:
+            LOGGER.error(f"Error while caching private.key file for {first_server} : {err}")
+            return 2
+
+        # csr.conf is no longer used to generate the CSR, only kept (in openssl req format)
+        # as the fingerprint of the domains the CSR was generated for.
+        if changed or not csr_conf_file.is_file():
+            cached, err = cache_file("csr.conf", build_csr_config(first_server, data["domains"]).encode(), service_id=first_server)
+            if not cached:
+                LOGGER.error(f"Error while caching csr.conf file for {first_server} : {err}")
+                return 2
+
+        LOGGER.info(f"🔐 Successfully generated CSR for {first_server} ✅")
+    else:
+        LOGGER.info(f"Certificate Signing Request (CSR) for {first_server} is still valid, no need to regenerate it")
+
+    # * Generating a new origin certificate
+    LOGGER.info(f"Generating a new origin certificate for {','.join(data['domains'])}...")
+    try:
+        created = client.origin_ca_certificates.create(
+            csr=csr_content,
+            hostnames=data["domains"],
+            request_type=request_type_for(data["type"]),
+            requested_validity=int(data["validity"]),
+        )
+    except APIError as e:
+        LOGGER.error(f"Failed to generate origin certificate for {','.join(data['domains'])}: {e}")
+        return 2
+
+    # Tolerate whitespace/newline normalization by the API (the CSR is "newline-encoded")
+    # so a successfully issued (already-billed) cert isn't discarded over a trailing \n.
+    if (getattr(created, "csr", None) or "").strip() != csr_content.strip():
+        LOGGER.error("CSR of generated certificate does not match the one we sent")
+        return 2
+
+    cert_id = getattr(created, "id", None)
+    cert_content = getattr(created, "certificate", None)
+    if not cert_id or not cert_content:
+        LOGGER.error("No certificate ID or content received from Cloudflare")
+        return 2
+
+    cached, err = cache_file("origin_cert.pem", cert_content.encode(), service_id=first_server)
+    if not cached:
+        LOGGER.error(f"Error while caching origin_cert.pem file for {first_server} : {err}")
+        return 2
+
+    cached, err = cache_file("cert.id", cert_id.encode(), service_id=first_server)
+    if not cached:
+        LOGGER.error(f"Error while caching cert.id file for {first_server} : {err}")
+        return 2
+
+    if data["zone_id"]:
+        INVENTORY.add_cert(data["zone_id"], {"id": cert_id, "hostnames": data["domains"], "expires_on": getattr(created, "expires_on", "")})
+
+    LOGGER.info(f"📜 Successfully generated origin certificate for {','.join(data['domains'])} ✅")
+    return 1
+
+
 try:
     # Check if at least a server has Cloudflare activated. Keep the original case: the
     # service id is the cache-dir name the Lua side reads back (it uses the original-case
@@ -118,283 +506,24 @@ try:
         sys_exit(0)
 
     JOB = Job(LOGGER, __file__)
-
-    valid_tokens = set()
-    invalid_tokens = set()
-    for first_server in servers:
-        if not first_server:
-            continue
-        service_cache_path = CACHE_PATH.joinpath(first_server)
-
-        cert_id_file = service_cache_path.joinpath("cert.id")
-        origin_cert_file = service_cache_path.joinpath("origin_cert.pem")
-        csr_file = service_cache_path.joinpath("csr.pem")
-        private_key_file = service_cache_path.joinpath("private.key")
-        csr_conf_file = service_cache_path.joinpath("csr.conf")
-
-        # * Getting all the necessary data (api_token / zone_id support the _FILE secret convention)
-        api_token = get_env_secret(f"{first_server}_CLOUDFLARE_API_TOKEN", "CLOUDFLARE_API_TOKEN").strip().removeprefix("Bearer ").strip()
-        data = {
-            "use_cloudflare": getenv(f"{first_server}_USE_CLOUDFLARE", getenv("USE_CLOUDFLARE", "no")),
-            "manage_origin_certs": getenv(f"{first_server}_CLOUDFLARE_MANAGE_ORIGIN_CERTS", getenv("CLOUDFLARE_MANAGE_ORIGIN_CERTS", "yes")),
-            "api_token": api_token,
-            "domains": [
-                domain for domain in (getenv(f"{first_server}_SERVER_NAME", getenv("SERVER_NAME", "")).lower() or first_server).strip().split(" ") if domain
-            ],
-            "zone_id": get_env_secret(f"{first_server}_CLOUDFLARE_ZONE_ID", "CLOUDFLARE_ZONE_ID"),
-            "type": getenv(f"{first_server}_CLOUDFLARE_ORIGIN_CERT_TYPE", getenv("CLOUDFLARE_ORIGIN_CERT_TYPE", "rsa")),
-            "validity": getenv(f"{first_server}_CLOUDFLARE_ORIGIN_CERT_VALIDITY", getenv("CLOUDFLARE_ORIGIN_CERT_VALIDITY", "5475")),
-        }
-
-        if data["use_cloudflare"] != "yes" or data["manage_origin_certs"] != "yes":
-            LOGGER.info(f"Skipping origin certs generation for {first_server} because it is not configured to use Cloudflare or manage origin certs")
-
-            if cert_id_file.is_file():
-                if not api_token or api_token in invalid_tokens or (api_token not in valid_tokens and not token_is_active(get_client(api_token))):
-                    LOGGER.warning(
-                        f"API token for {first_server} is either not set or invalid, therefore we cannot revoke the existing origin certificate, check your Cloudflare account to see if the certificate isn't still active"
-                    )
-                    for name in ("cert.id", "origin_cert.pem", "csr.pem", "private.key", "csr.conf"):
-                        JOB.del_cache(name, service_id=first_server)
-                else:
-                    valid_tokens.add(api_token)
-                    LOGGER.info(f"Revoking existing origin certificate for {first_server}...")
-                    if revoke_cert(get_client(api_token), first_server, cert_id_file.read_text().strip()):
-                        LOGGER.info(f"Successfully deleted existing origin certificate for {first_server}")
-            elif origin_cert_file.is_file() or csr_file.is_file() or private_key_file.is_file() or csr_conf_file.is_file():
-                LOGGER.warning(
-                    f"Cache files found for {first_server} but no certificate ID, therefore we cannot revoke the existing origin certificate, check your Cloudflare account to see if the certificate isn't still active"
-                )
-                for name in ("origin_cert.pem", "csr.pem", "private.key", "csr.conf"):
-                    JOB.del_cache(name, service_id=first_server)
-            continue
-
-        LOGGER.debug(f"Data for service {first_server}: {dumps({k: v for k, v in data.items() if k != 'api_token'})}")
-
-        # * Checking if the data is valid
-        if not data["api_token"]:
-            LOGGER.warning(f"API token for {first_server} is not set, skipping origin certs generation...")
-            status = 2
-            continue
-
-        client = get_client(data["api_token"])
-
-        # * Checking if the API token is valid (cached across services)
-        if data["api_token"] in invalid_tokens:
-            LOGGER.warning(f"API token for {first_server} is invalid, skipping origin certs generation...")
-            status = 2
-            continue
-
-        if data["api_token"] not in valid_tokens:
-            LOGGER.info(f"Checking if the API token for {first_server} is valid...")
-            if not token_is_active(client):
-                invalid_tokens.add(data["api_token"])
-                LOGGER.warning(f"API token for {first_server} is invalid or not active, skipping origin certs generation...")
-                status = 2
-                continue
-            LOGGER.info(f"🔑 API token for {first_server} is valid ✅")
-            valid_tokens.add(data["api_token"])
-
-        service_cache_path.mkdir(parents=True, exist_ok=True)
-
-        cert_id = None
-        expired = False
-        changed = False
-        # * Inspecting the locally cached cert/key/CSR config to decide if we must act
-        if cert_id_file.is_file():
-            cert_id = cert_id_file.read_text().strip()
-
-            if csr_conf_file.is_file():
-                LOGGER.info(f"CSR configuration file found for {first_server}, checking if the subdomains have changed...")
-                changed = csr_conf_file.read_text() != build_csr_config(first_server, data["domains"])
-
-            if origin_cert_file.is_file() and private_key_file.is_file():
-                LOGGER.info(f"Certificate file found for {first_server}, checking if the certificate is still valid...")
-                certificate = x509.load_pem_x509_certificate(origin_cert_file.read_bytes(), default_backend())
-                not_valid_after = certificate.not_valid_after_utc  # type: ignore[attr-defined]  # cryptography>=42 (image ships 49)
-                if not_valid_after < datetime.now(tz=not_valid_after.tzinfo):
-                    expired = True
-
-                public_key = certificate.public_key()
-                if isinstance(public_key, rsa.RSAPublicKey) and data["type"] == "ecdsa":
-                    LOGGER.warning(f"Certificate type for {first_server} does not match the one we want to generate (ECDSA vs RSA)")
-                    changed = True
-                elif isinstance(public_key, ec.EllipticCurvePublicKey) and data["type"] == "rsa":
-                    LOGGER.warning(f"Certificate type for {first_server} does not match the one we want to generate (RSA vs ECDSA)")
-                    changed = True
-            else:
-                expired = True
-
-        try:
-            if not cert_id:
-                # * Getting the zone ID if it is not set
-                if not data["zone_id"]:
-                    zone_name = select_zone_name(data["domains"])
-                    LOGGER.info(f"Getting the active zone ID for {first_server} (querying zone '{zone_name}')...")
-
-                    zones = [
-                        {"id": z.id, "name": z.name, "type": getattr(z, "type", ""), "modified_on": str(getattr(z, "modified_on", ""))}
-                        for z in client.zones.list(name=zone_name, status="active")
-                    ]
-                    if not zones:
-                        LOGGER.error(f"No active zone found for {first_server}'s API token, skipping origin certs generation...")
-                        status = 2
-                        continue
-                    if len(zones) > 1:
-                        LOGGER.warning(f"More than one zone found for {first_server}, using the one with the most recent modification date...")
-
-                    zone = select_zone(zones)
-                    if not zone:
-                        status = 2
-                        continue
-                    data["zone_id"] = zone.get("id", "")
-                    if not data["zone_id"]:
-                        status = 2
-                        continue
-                    LOGGER.info(f"🌐 Zone ID for {first_server} is {data['zone_id']} (name: {zone.get('name', '')}, type: {zone.get('type', '')})")
-
-                # * Getting all existing origin certificates for the zone (SDK auto-paginates)
-                certs = [
-                    {"id": c.id, "hostnames": list(getattr(c, "hostnames", []) or []), "expires_on": getattr(c, "expires_on", "")}
-                    for c in client.origin_ca_certificates.list(zone_id=data["zone_id"])
-                ]
-
-                cert_id, found, cert_expired = find_matching_cert(certs, data["domains"])
-                if cert_expired:
-                    expired = True
-                if not found:
-                    cert_id = None
-
-                if cert_id and not expired:
-                    if cert_id_file.is_file() and origin_cert_file.is_file() and private_key_file.is_file():
-                        LOGGER.info(f"Origin certificate for {','.join(data['domains'])} already exists, skipping origin certs generation...")
-                        continue
-                    LOGGER.info(f"Origin certificate for {','.join(data['domains'])} exists on Cloudflare's side but not locally, regenerating it...")
-                    expired = True
-            elif not expired and not changed:
-                LOGGER.info(
-                    f"Origin certificate for {','.join(data['domains'])} already exists and is still valid locally, checking if it is still valid on Cloudflare's side..."
-                )
-                remote = client.origin_ca_certificates.get(cert_id)
-                if is_expired(getattr(remote, "expires_on", "")):
-                    expired = True
-                else:
-                    LOGGER.info(f"Origin certificate for {','.join(data['domains'])} is still valid on Cloudflare's side, no need to regenerate it")
-                    continue
-        except APIError as e:
-            LOGGER.error(f"Cloudflare API error while resolving certificate state for {first_server}: {e}")
-            status = 2
-            continue
-
-        if cert_id and (expired or changed):
-            LOGGER.info(f"Origin certificate for {','.join(data['domains'])} has {'expired' if expired else 'changed'}, revoking it...")
-            if revoke_cert(client, first_server, cert_id):
-                LOGGER.info(f"Successfully deleted expired origin certificate for {','.join(data['domains'])}")
-                cert_id = None
-
-        # * Generating the CSR + private key if they are missing or the subdomains changed.
-        # (CSRs have no expiry — regeneration is driven only by missing files / changes.)
-        csr_content = csr_file.read_text() if csr_file.is_file() else None
-        if not csr_content or changed:
-            if changed:
-                LOGGER.info(f"Subdomains for {first_server} have changed, generating a new Certificate Signing Request (CSR)...")
-            else:
-                LOGGER.info(f"Generating a Certificate Signing Request (CSR) for {first_server}")
-
-            if changed or not csr_conf_file.is_file():
-                content = build_csr_config(first_server, data["domains"]).encode()
-                cached, err = JOB.cache_file("csr.conf", content, service_id=first_server)
-                if not cached:
-                    LOGGER.error(f"Error while caching csr.conf file for {first_server} : {err}")
-                    status = 2
-                    continue
-                LOGGER.info(f"🔩 Successfully generated CSR configuration file for {first_server} ✅")
-
-            command = [
-                "openssl",
-                "req",
-                "-nodes",
-                "-new",
-                "-newkey",
-                "-keyout",
-                private_key_file.as_posix(),
-                "-out",
-                csr_file.as_posix(),
-                "-config",
-                csr_conf_file.as_posix(),
-            ]
-            if data["type"] == "ecdsa":
-                command.insert(5, "ec")
-                command.insert(6, "-pkeyopt")
-                command.insert(7, "ec_paramgen_curve:prime256v1")
-            else:
-                command.insert(5, "rsa:2048")
-
-            result = run(command, capture_output=True, text=True, check=False)
-            if result.returncode != 0:
-                LOGGER.error(f"CSR generation failed for {first_server}: {result.stderr}")
-                status = 2
-                continue
-
-            cached, err = JOB.cache_file("csr.pem", csr_file, service_id=first_server, overwrite_file=False)
-            if not cached:
-                LOGGER.error(f"Error while caching csr.pem file for {first_server} : {err}")
-                status = 2
-                continue
-
-            cached, err = JOB.cache_file("private.key", private_key_file, service_id=first_server, overwrite_file=False)
-            if not cached:
-                LOGGER.error(f"Error while caching private.key file for {first_server} : {err}")
-                status = 2
-                continue
-
-            LOGGER.info(f"🔐 Successfully generated CSR for {first_server} ✅")
-            csr_content = csr_file.read_text()
-        else:
-            LOGGER.info(f"Certificate Signing Request (CSR) for {first_server} is still valid, no need to regenerate it")
-
-        # * Generating a new origin certificate
-        LOGGER.info(f"Generating a new origin certificate for {','.join(data['domains'])}...")
-        try:
-            created = client.origin_ca_certificates.create(
-                csr=csr_content,
-                hostnames=data["domains"],
-                request_type=request_type_for(data["type"]),
-                requested_validity=int(data["validity"]),
-            )
-        except APIError as e:
-            LOGGER.error(f"Failed to generate origin certificate for {','.join(data['domains'])}: {e}")
-            status = 2
-            continue
-
-        # Tolerate whitespace/newline normalization by the API (the CSR is "newline-encoded")
-        # so a successfully issued (already-billed) cert isn't discarded over a trailing \n.
-        if (getattr(created, "csr", None) or "").strip() != csr_content.strip():
-            LOGGER.error("CSR of generated certificate does not match the one we sent")
-            status = 2
-            continue
-
-        cert_id = getattr(created, "id", None)
-        cert_content = getattr(created, "certificate", None)
-        if not cert_id or not cert_content:
-            LOGGER.error("No certificate ID or content received from Cloudflare")
-            status = 2
-            continue
-
-        cached, err = JOB.cache_file("origin_cert.pem", cert_content.encode(), service_id=first_server)
+    INVENTORY = Inventory(load_inventory(JOB.get_cache(INVENTORY_FILE), INVENTORY_TTL, time()))
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(min(WORKERS, len(servers)), 1), thread_name_prefix="origin-certs") as executor:
+        futures = {executor.submit(run_service, first_server): first_server for first_server in dict.fromkeys(servers) if first_server}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+
+    # Summarize in SERVER_NAME order (not completion order) so runs are comparable.
+    for first_server in futures.values():
+        service_status, elapsed = results[first_server]
+        LOGGER.info(f"⏱️ {first_server}: {('no change', 'new certificate', 'error')[service_status]} in {elapsed:.2f}s")
+    status = max((service_status for service_status, _ in results.values()), default=0)
+
+    if INVENTORY_TTL > 0 and INVENTORY.changed:
+        cached, err = JOB.cache_file(INVENTORY_FILE, dumps(INVENTORY.data).encode())
         if not cached:
-            LOGGER.error(f"Error while caching origin_cert.pem file for {first_server} : {err}")
-            status = 2
-            continue
-
-        cached, err = JOB.cache_file("cert.id", cert_id.encode(), service_id=first_server)
-        if not cached:
-            LOGGER.error(f"Error while caching cert.id file for {first_server} : {err}")
-            status = 2
-            continue
-
-        LOGGER.info(f"📜 Successfully generated origin certificate for {','.join(data['domains'])} ✅")
-        status = status or 1
+            LOGGER.warning(f"Error while caching the zone and certificate inventory : {err}")
 except SystemExit as e:
     status = e.code
 except:
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps
 from os import getenv, sep
 from os.path import dirname, join
 from sys import exit as sys_exit, path as sys_path
@@ -18,13 +20,25 @@ from logger import setup_logger  # type: ignore
 from common_utils import bytes_hash  # type: ignore
 from jobs import Job  # type: ignore
 
-from cloudflare_helpers import CF_IPS_V4_DEFAULT_URL, CF_IPS_V6_DEFAULT_URL, check_line  # type: ignore
+from cloudflare_helpers import (  # type: ignore
+    CF_IPS_V4_DEFAULT_URL,
+    CF_IPS_V6_DEFAULT_URL,
+    check_line,
+    conditional_headers,
+    dedupe_ranges,
+    load_validators,
+    render_realip_conf,
+    response_validators,
+    serialize_ranges,
+)
 
 LOGGER = setup_logger("CLOUDFLARE.TRUSTED-IPS-DOWNLOAD", getenv("LOG_LEVEL", "INFO"))
 try:
     _timeout = int(getenv("CLOUDFLARE_API_TIMEOUT", "10"))
 except ValueError:
     _timeout = 10
+# ETag / Last-Modified of each source URL, sent back as conditional request headers.
+VALIDATORS_FILE = "ips_validators.json"
 status = 0
 
 
@@ -38,6 +52,56 @@ def make_session() -> Session:
     return session
 
 
+def write_realip_conf() -> int:
+    """(Re)build the shared realip.conf include from the cached lists.
+
+    Returns 1 if it changed (reload needed), 2 on error and 0 otherwise.
+    """
+    ranges = []
+    for _type in ("ipv4", "ipv6"):
+        ranges.extend((JOB.get_cache(f"{_type}.list") or b"").decode().split())
+    if not ranges:
+        return 0
+
+    content = render_realip_conf(ranges)
+    new_hash = bytes_hash(content)
+    if new_hash == JOB.cache_hash("realip.conf"):
+        return 0
+
+    cached, err = JOB.cache_file("realip.conf", content, checksum=new_hash)
+    if not cached:
+        LOGGER.error(f"Error while caching realip.conf : {err}")
+        return 2
+    LOGGER.info("Regenerated the realip.conf include from Cloudflare's ranges")
+    return 1
+
+
+def fetch(session: Session, url: str, _type: str, headers: dict):
+    """Download and parse one range list (runs in a worker thread).
+
+    Returns ``(status code, deduplicated ranges or None, response validators)``.
+    """
+    LOGGER.info(f"Downloading Cloudflare's {_type} list from {url}...")
+    with session.get(url, headers=headers, stream=True, timeout=_timeout, allow_redirects=True, verify=True) as resp:
+        if resp.status_code != 200:
+            return resp.status_code, None, {}
+
+        ranges = []
+        for line in resp.iter_lines():
+            line = line.strip().split(b" ")[0]
+
+            if not line or line.startswith((b"#", b";")):
+                continue
+
+            ok, data = check_line(line)
+            if ok:
+                ranges.append(data)
+
+        # Same prefix-trie verdicts as the Lua trust check: drop duplicates and
+        # ranges already covered by a broader one of the list.
+        return resp.status_code, dedupe_ranges(ranges), response_validators(resp.headers)
+
+
 try:
     # Check if at least a server has Cloudflare activated
     cf_activated = False
@@ -65,7 +129,8 @@ try:
     # Don't go further if the cache is fresh (the job runs daily; CF ranges change rarely)
     if JOB.is_cached_file("ipv4.list", "day") and JOB.is_cached_file("ipv6.list", "day"):
         LOGGER.info("Cloudflare's IPv4 and IPv6 trusted IPs/nets lists are already in cache, skipping download...")
-        sys_exit(0)
+        # Still build the include if missing (e.g. lists cached by a previous version).
+        sys_exit(write_realip_conf())
 
     # URLs are overridable (testing / Cloudflare-compatible mirrors); each pair carries
     # its own type so an override URL is never mislabelled by sniffing its suffix.
@@ -75,41 +140,43 @@ try:
     )
 
     session = make_session()
-
-    # Download and write data to cache
-    for url, _type in sources:
-        i = 0
-        content = b""
+    validators = load_validators(JOB.get_cache(VALIDATORS_FILE))
+    new_validators = {url: validators[url] for url, _ in sources if url in validators}
+
+    # Fetch both lists concurrently. Validators are only sent for a list we still have
+    # in cache, a 304 for a missing one would leave us with nothing to serve.
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        futures = [
+            executor.submit(fetch, session, url, _type, conditional_headers(validators.get(url)) if JOB.cache_hash(f"{_type}.list") else {})
+            for url, _type in sources
+        ]
+
+    # Write data to cache, in sources order
+    for (url, _type), future in zip(sources, futures):
         try:
-            LOGGER.info(f"Downloading Cloudflare's {_type} list from {url}...")
-            resp = session.get(url, stream=True, timeout=_timeout, allow_redirects=True, verify=True)
+            status_code, ranges, source_validators = future.result()
 
-            if resp.status_code != 200:
-                LOGGER.warning(f"Got status code {resp.status_code}, skipping {_type} list download...")
-                status = 2
+            if status_code == 304:
+                LOGGER.info(f"Cloudflare's {_type} list is not modified since the last download, reload is not needed")
                 continue
 
-            for line in resp.iter_lines():
-                line = line.strip().split(b" ")[0]
-
-                if not line or line.startswith((b"#", b";")):
-                    continue
-
-                ok, data = check_line(line)
-                if ok:
-                    content += data + b"\n"
-                    i += 1
+            if status_code != 200:
+                LOGGER.warning(f"Got status code {status_code}, skipping {_type} list download...")
+                status = 2
+                continue
 
-            if not content:
+            if not ranges:
                 LOGGER.warning(f"No valid {_type} IPs/nets found at {url}, skipping...")
                 status = 2
                 continue
 
+            content, new_hash = serialize_ranges(ranges)
+
             # Check if file has changed
-            new_hash = bytes_hash(content)
             old_hash = JOB.cache_hash(f"{_type}.list")
             if new_hash == old_hash:
                 LOGGER.info(f"New {_type}.list file is identical to cache file, reload is not needed")
+                new_validators[url] = source_validators
                 continue
 
             # Put file in cache
@@ -118,13 +185,22 @@ try:
                 LOGGER.error(f"Error while caching {_type} list : {err}")
                 status = 2
                 continue
+            new_validators[url] = source_validators
 
-            LOGGER.info(f"Downloaded {i} trusted {_type} IPs/nets")
+            LOGGER.info(f"Downloaded {len(ranges)} trusted {_type} IPs/nets")
 
             status = status or 1
         except BaseException as e:
             status = 2
             LOGGER.error(f"Exception while getting Cloudflare {_type} list from {url} :\n{e}")
+
+    status = max(status, write_realip_conf())
+
+    new_validators = {url: source_validators for url, source_validators in new_validators.items() if source_validators}
+    if new_validators != validators:
+        cached, err = JOB.cache_file(VALIDATORS_FILE, dumps(new_validators, sort_keys=True).encode())
+        if not cached:
+            LOGGER.warning(f"Error while caching the download validators, the next download won't be conditional : {err}")
 except SystemExit as e:
     status = e.code
 except:
@@ -9,10 +9,14 @@ themselves.
 
 from contextlib import suppress
 from datetime import datetime, timezone
-from ipaddress import ip_address, ip_network
+from hashlib import sha512
+from ipaddress import collapse_addresses, ip_address, ip_network
+from json import JSONDecodeError, dumps, loads
 from os import getenv, sep
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from threading import Lock
+from time import monotonic, sleep
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
 
 CF_API_DEFAULT_URL = "https://api.cloudflare.com/client/v4"
 CF_IPS_V4_DEFAULT_URL = "https://www.cloudflare.com/ips-v4/"
@@ -21,6 +25,17 @@ CF_IPS_V6_DEFAULT_URL = "https://www.cloudflare.com/ips-v6/"
 # customers — proves "came through Cloudflare", same trust level as IP allowlisting
 # but cryptographic). NOT the Origin CA cert.
 CF_AOP_CA_DEFAULT_URL = "https://developers.cloudflare.com/ssl/static/authenticated_origin_pull_ca.pem"
+# Trust kinds in priority order, shared with cloudflare_helpers.lua (first match wins).
+TRUST_KINDS = ("ipv4", "ipv6", "additional")
+# Redis keys fed by the ban events watcher of cloudflare.lua : ban key -> time of its last
+# keyspace event, the watcher heartbeat and when its uninterrupted coverage began.
+BAN_EVENTS = "plugin_cloudflare_ban_events"
+BAN_EVENTS_ALIVE = "plugin_cloudflare_ban_events_alive"
+BAN_EVENTS_START = "plugin_cloudflare_ban_events_start"
+# Seconds the watcher keeps events for, and the clock skew tolerated between the nginx
+# hosts recording them and the scheduler.
+BAN_EVENTS_RETENTION = 86400
+BAN_EVENTS_SKEW = 5
 
 
 def get_env_secret(primary: str, fallback: str = "", default: str = "") -> str:
@@ -70,6 +85,278 @@ def parse_ban_key(key) -> Optional[str]:
     return None
 
 
+def group_ban_keys(keys: Iterable[Union[str, bytes]]) -> Dict[str, List[str]]:
+    """Group ban keys by banned IP (``{ip: [sorted keys]}``), skipping non-ban keys."""
+    bans = {}
+    for key in keys:
+        if isinstance(key, bytes):
+            key = key.decode("utf-8", "replace")
+        ip = parse_ban_key(key)
+        if ip:
+            bans.setdefault(ip, []).append(key)
+    for ip_keys in bans.values():
+        ip_keys.sort()
+    return bans
+
+
+def read_ban_changes(redis_client, bans: Optional[Dict[str, List[str]]], since: Optional[float], now: float) -> Optional[Tuple[Dict[str, List[str]], float]]:
+    """Apply the ban keys changed since the ``since`` watermark to ``bans`` without a SCAN.
+
+    Only the keys recorded in ``BAN_EVENTS`` since then (minus ``BAN_EVENTS_SKEW``), and the
+    other known keys of the same IPs, are checked for existence. Returns the updated copy
+    of ``bans`` (``{ip: [ban keys]}``) and the new watermark, or None when the events can't
+    be trusted to cover the whole period (no watcher alive, coverage restarted after
+    ``since``, watermark past the retention) and every ban key must be scanned instead.
+    """
+    if not isinstance(bans, dict) or not since or now - since >= BAN_EVENTS_RETENTION:
+        return None
+    alive, start = redis_client.pipeline(transaction=False).exists(BAN_EVENTS_ALIVE).get(BAN_EVENTS_START).execute()
+    try:
+        start = float(start)
+    except (TypeError, ValueError):
+        return None
+    if not alive or start > since:
+        return None
+
+    changed = {}
+    latest = since
+    for key, score in redis_client.zrangebyscore(BAN_EVENTS, since - BAN_EVENTS_SKEW, "+inf", withscores=True):
+        if isinstance(key, bytes):
+            key = key.decode("utf-8", "replace")
+        ip = parse_ban_key(key)
+        if ip:
+            changed.setdefault(ip, set(bans.get(ip, ()))).add(key)
+        latest = max(latest, float(score))
+    if not changed:
+        return bans, latest
+
+    keys = [(ip, key) for ip, ip_keys in changed.items() for key in sorted(ip_keys)]
+    pipe = redis_client.pipeline(transaction=False)
+    for _, key in keys:
+        pipe.exists(key)
+    bans = {ip: ip_keys for ip, ip_keys in bans.items() if ip not in changed}
+    for (ip, key), exists in zip(keys, pipe.execute()):
+        if exists:
+            bans.setdefault(ip, []).append(key)
+    return bans, latest
+
+
+def parse_ban_date(raw) -> float:
+    """Ban timestamp from a BunkerWeb ban value (JSON with a ``date`` field), 0 if unknown."""
+    with suppress(ValueError, TypeError, AttributeError):
+        return float(loads(raw).get("date") or 0)
+    return 0.0
+
+
+def collapse_bans(ips: Iterable[str], threshold: int) -> Dict[str, List[str]]:
+    """Group banned IPs into the edge list items that will carry them.
+
+    With ``threshold`` > 0, every /24 (IPv4) or /64 (IPv6) holding at least that many
+    banned IPs becomes a single CIDR item; other IPs stay on their own. Returns
+    ``{item: [member IPs]}`` so callers can rank a CIDR by its members' bans.
+    """
+    items = {}
+    if threshold <= 0:
+        for ip in ips:
+            items[ip] = [ip]
+        return items
+    groups = {}
+    for ip in ips:
+        with suppress(ValueError):
+            addr = ip_address(ip)
+            groups.setdefault(str(ip_network(f"{addr}/{24 if addr.version == 4 else 64}", strict=False)), []).append(ip)
+            continue
+        items[ip] = [ip]
+    for cidr, members in groups.items():
+        if len(members) >= threshold:
+            items[cidr] = members
+        else:
+            for ip in members:
+                items[ip] = [ip]
+    return items
+
+
+def select_bans(items: Dict[str, List[str]], meta: Dict[str, Tuple[float, float]], limit: int, priority: str = "recent") -> Set[str]:
+    """Pick the ``limit`` edge list items worth pushing when there are too many.
+
+    ``meta`` maps a banned IP to ``(remaining ttl, ban date)`` (ttl is ``inf`` for a
+    permanent ban); an item ranks as its best member. ``priority`` is ``recent`` (newest
+    bans first) or ``ttl`` (longest remaining ban first). Ties break on the item itself
+    so the selection is stable between runs.
+    """
+    if len(items) <= limit:
+        return set(items)
+    index = 0 if priority == "ttl" else 1
+
+    def rank(item):
+        return max((meta.get(ip, (0.0, 0.0))[index] for ip in items[item]), default=0.0)
+
+    return set(sorted(items, key=lambda item: (-rank(item), item))[:limit])
+
+
+def chunked(seq: List[Any], size: int) -> Iterable[List[Any]]:
+    """Yield consecutive slices of at most ``size`` elements of ``seq``."""
+    for start in range(0, len(seq), size):
+        end = start + size
+        yield seq[start:end]
+
+
+def retry_after_seconds(value, default: float, cap: float = 60.0) -> float:
+    """Seconds to wait from a ``Retry-After`` header (delta-seconds form), else ``default``.
+
+    Capped at ``cap`` so a bogus header can't stall the job past its schedule.
+    """
+    with suppress(ValueError, TypeError):
+        return min(max(float(value), 0.0), cap)
+    return min(default, cap)
+
+
+class TokenBucket:
+    """Thread-safe token bucket shared by the workers spending one API rate limit.
+
+    Holds up to ``capacity`` tokens refilled at ``rate`` per second; ``acquire`` takes one,
+    sleeping (outside the lock) until one is available.
+    """
+
+    def __init__(self, rate: float, capacity: float, clock=monotonic, wait=sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._clock = clock
+        self._wait = wait
+        self._updated = clock()
+        self._lock = Lock()
+
+    def acquire(self) -> float:
+        """Take one token, returning how long we waited for it."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            self._wait(delay)
+            waited += delay
+
+
+def load_sync_state(raw: Optional[bytes], account_id: str, list_name: str) -> Dict[str, Any]:
+    """Decode the edge ban sync state cached by the previous run.
+
+    The state records the Cloudflare IP List id, the IPs last pushed to it (mapped to
+    their list item id, or None while unknown) and when the last full reconcile ran. In
+    incremental mode it also keeps the ban keys of each banned IP (``bans``) and the
+    time they were last read up to (``since``), see ``read_ban_changes``. A missing,
+    corrupt or foreign (other account / list name) state yields a blank one, which
+    forces a full reconcile.
+    """
+    blank = {"account_id": account_id, "list_name": list_name, "list_id": None, "items": {}, "last_full_sync": 0}
+    if not raw:
+        return blank
+    try:
+        state = loads(raw)
+    except (JSONDecodeError, UnicodeDecodeError):
+        return blank
+    if not isinstance(state, dict) or state.get("account_id") != account_id or state.get("list_name") != list_name:
+        return blank
+    if not state.get("list_id") or not isinstance(state.get("items"), dict):
+        return blank
+    state.setdefault("last_full_sync", 0)
+    if not isinstance(state.get("bans"), dict):
+        state.pop("bans", None)
+        state.pop("since", None)
+    return state
+
+
+def dump_sync_state(state: Dict[str, Any]) -> bytes:
+    """Serialize the edge ban sync state deterministically (so unchanged state hashes the same)."""
+    return dumps(state, sort_keys=True, separators=(",", ":")).encode()
+
+
+def full_sync_due(state: Dict[str, Any], interval: int, now: float) -> bool:
+    """True when the periodic full reconcile (list download + diff) must run."""
+    return not state.get("list_id") or now - float(state.get("last_full_sync") or 0) >= interval
+
+
+def plan_edge_sync(banned: Set[str], items: Dict[str, Optional[str]]) -> Tuple[Set[str], Dict[str, str], Set[str]]:
+    """Diff the banned IPs against the last pushed ``items`` (ip -> list item id or None).
+
+    Returns ``(to_add, to_remove, unknown)``: IPs to push, IPs to delete mapped to their
+    item id, and IPs to delete whose item id isn't known yet (pushed since the last full
+    reconcile), which can only be removed after a full list download.
+    """
+    to_add = banned - items.keys()
+    to_remove = {}
+    unknown = set()
+    for ip, item_id in items.items():
+        if ip in banned:
+            continue
+        if item_id:
+            to_remove[ip] = item_id
+        else:
+            unknown.add(ip)
+    return to_add, to_remove, unknown
+
+
+def load_validators(raw: Optional[bytes]) -> Dict[str, Dict[str, str]]:
+    """Decode the cached HTTP validators (``{url: {"etag": ..., "last_modified": ...}}``)."""
+    with suppress(ValueError, TypeError, UnicodeDecodeError):
+        validators = loads(raw or b"{}")
+        if isinstance(validators, dict):
+            return validators
+    return {}
+
+
+def conditional_headers(validators: Optional[Dict[str, str]]) -> Dict[str, str]:
+    """If-None-Match / If-Modified-Since request headers from a source's validators."""
+    headers = {}
+    if (validators or {}).get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if (validators or {}).get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+def response_validators(headers) -> Dict[str, str]:
+    """The ETag / Last-Modified validators of a response, to send back next time."""
+    validators = {}
+    if headers.get("ETag"):
+        validators["etag"] = headers["ETag"]
+    if headers.get("Last-Modified"):
+        validators["last_modified"] = headers["Last-Modified"]
+    return validators
+
+
+def serialize_ranges(ranges: Iterable[str]) -> Tuple[bytes, str]:
+    """Render ranges one per line, hashing them on the way (sha512 hex, as ``bytes_hash``)."""
+    digest = sha512()
+    lines = []
+    for cidr in ranges:
+        line = f"{cidr}\n".encode()
+        digest.update(line)
+        lines.append(line)
+    return b"".join(lines), digest.hexdigest()
+
+
+def render_realip_conf(ranges: Iterable[str]) -> bytes:
+    """Render the ``set_real_ip_from`` include shared by every service (http and stream).
+
+    Ranges are merged per family with ``collapse_addresses`` (duplicates, covered and
+    adjacent networks), so each service includes the smallest equivalent list.
+    """
+    networks = {4: [], 6: []}
+    for cidr in ranges:
+        with suppress(ValueError):
+            network = ip_network(cidr, strict=False)
+            networks[network.version].append(network)
+    lines = ["# Cloudflare's edge ranges, generated by cf-trusted-ips-download.py"]
+    lines.extend(f"set_real_ip_from {network};" for version in (4, 6) for network in collapse_addresses(networks[version]))
+    return ("\n".join(lines) + "\n").encode()
+
+
 def check_line(line: bytes) -> Tuple[bool, bytes]:
     """Validate a single IP / CIDR line from a Cloudflare IP-range list."""
     with suppress(ValueError):
@@ -81,12 +368,108 @@ def check_line(line: bytes) -> Tuple[bool, bytes]:
     return False, b""
 
 
+class IPClassifier:
+    """Prefix-trie IP classifier, the Python twin of ``new_classifier``/``classify`` in
+    ``cloudflare_helpers.lua``.
+
+    Networks are inserted per address family into a binary trie whose nodes keep the
+    best (lowest) ``TRUST_KINDS`` rank ending there, so ``classify`` answers "which kind,
+    if any, contains this address" in one walk of at most 32/128 bits. Host bits past
+    the prefix are ignored (``1.2.3.4/24`` is ``1.2.3.0/24``), like the Lua side, so both
+    give identical verdicts and the jobs can pre-validate and deduplicate ranges.
+    """
+
+    def __init__(self, trusted: Optional[Dict[str, Iterable[str]]] = None):
+        # node = [child_0, child_1, rank]
+        self._roots = {4: [None, None, None], 6: [None, None, None]}
+        for kind in TRUST_KINDS:
+            for cidr in (trusted or {}).get(kind, ()):
+                self.add(kind, cidr)
+
+    def _path(self, address: int, version: int, max_prefixlen: int, length: int, create: bool = False) -> List[list]:
+        """Trie nodes along the first ``length`` bits of ``address``, root first.
+
+        Stops early at a missing child unless ``create`` is set.
+        """
+        node = self._roots[version]
+        path = [node]
+        for i in range(length):
+            bit = (address >> (max_prefixlen - 1 - i)) & 1
+            if node[bit] is None:
+                if not create:
+                    break
+                node[bit] = [None, None, None]
+            node = node[bit]
+            path.append(node)
+        return path
+
+    def add(self, kind: str, cidr: Union[str, bytes]) -> None:
+        """Insert ``cidr`` as ``kind``. Raises ValueError on an invalid IP/network."""
+        if isinstance(cidr, bytes):
+            cidr = cidr.decode()
+        network = ip_network(cidr, strict=False)
+        rank = TRUST_KINDS.index(kind)
+        node = self._path(int(network.network_address), network.version, network.max_prefixlen, network.prefixlen, create=True)[-1]
+        if node[2] is None or rank < node[2]:
+            node[2] = rank
+
+    def covers(self, cidr: Union[str, bytes]) -> bool:
+        """True if an already-inserted network (of any kind) contains the whole of ``cidr``."""
+        if isinstance(cidr, bytes):
+            cidr = cidr.decode()
+        network = ip_network(cidr, strict=False)
+        return any(node[2] is not None for node in self._path(int(network.network_address), network.version, network.max_prefixlen, network.prefixlen))
+
+    def classify(self, addr: Union[str, bytes]) -> Tuple[bool, str]:
+        """``(True, kind)`` when a loaded network contains ``addr``, else ``(False, "ko")``.
+
+        Raises ValueError when ``addr`` is not an IP address (the Lua side returns nil, err).
+        """
+        if isinstance(addr, bytes):
+            addr = addr.decode()
+        address = ip_address(addr)
+        ranks = [node[2] for node in self._path(int(address), address.version, address.max_prefixlen, address.max_prefixlen) if node[2] is not None]
+        if ranks:
+            return True, TRUST_KINDS[min(ranks)]
+        return False, "ko"
+
+
+def dedupe_ranges(lines: Iterable[Union[str, bytes]]) -> List[str]:
+    """Validate and deduplicate IP / CIDR lines with an ``IPClassifier``.
+
+    Invalid lines are dropped, host bits are cleared and any range already contained in
+    a broader one of the list is removed. The surviving ranges keep their original order.
+    """
+    networks = []
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", "replace")
+        with suppress(ValueError):
+            networks.append(ip_network(line.strip(), strict=False))
+
+    # Insert broadest first so a range is only kept when nothing broader covers it.
+    classifier = IPClassifier()
+    kept = set()
+    for network in sorted(set(networks), key=lambda n: (n.version, n.prefixlen)):
+        if not classifier.covers(str(network)):
+            classifier.add("ipv4" if network.version == 4 else "ipv6", str(network))
+            kept.add(network)
+
+    ranges = []
+    for network in networks:
+        if network in kept:
+            ranges.append(str(network))
+            kept.discard(network)
+    return ranges
+
+
 def build_csr_config(first_server: str, domains: List[str]) -> str:
     """Render the OpenSSL CSR config for a service (no Jinja / no template file).
 
     A plugin's ``templates/`` directory is reserved by BunkerWeb for JSON config
     templates, so the CSR config is built here in pure Python and cached as ``csr.conf``.
-    Deterministic so the daily job can diff it to detect domain changes.
+    The key and CSR are generated in-process, so this is only a derived artifact now:
+    deterministic so the daily job can diff it to detect domain changes.
     """
     lines = [
         "[req]",
@@ -173,14 +556,43 @@ def hostnames_match(cert_hostnames: List[str], domains: List[str]) -> bool:
     return set(cert_hostnames) == set(domains)
 
 
+def index_certs(certs: List[Dict]) -> Dict[frozenset, Dict]:
+    """Index Origin CA certs by hostname set (the first cert listed wins on duplicates)."""
+    index = {}
+    for cert in certs:
+        index.setdefault(frozenset(cert.get("hostnames", [])), cert)
+    return index
+
+
 def find_matching_cert(certs: List[Dict], domains: List[str], now: Optional[datetime] = None) -> Tuple[Optional[str], bool, bool]:
     """Find an existing Origin CA cert whose hostnames match the service's domains.
 
     Returns ``(cert_id, found, expired)``. ``cert_id``/``found`` describe the match;
     ``expired`` is True when the matched cert is past its ``expires_on``.
     """
+    return find_indexed_cert(index_certs(certs), domains, now)
+
+
+def find_indexed_cert(index: Dict[frozenset, Dict], domains: List[str], now: Optional[datetime] = None) -> Tuple[Optional[str], bool, bool]:
+    """Same as ``find_matching_cert`` with the ``index_certs`` of a zone shared by many services."""
     now = now or datetime.now(timezone.utc)
-    for cert in certs:
-        if hostnames_match(cert.get("hostnames", []), domains):
-            return cert.get("id"), True, is_expired(cert.get("expires_on", ""), now)
-    return None, False, False
+    cert = index.get(frozenset(domains))
+    if cert is None:
+        return None, False, False
+    return cert.get("id"), True, is_expired(cert.get("expires_on", ""), now)
+
+
+def load_inventory(raw: Optional[bytes], ttl: int, now: float) -> Dict[str, Any]:
+    """Decode the zone / certificate inventory cached by a previous run.
+
+    Returns ``{"saved": ts, "zones": {token digest: {zone name: [zones]}}, "certs":
+    {zone id: [certs]}}``; a blank inventory when missing, corrupt or older than ``ttl``.
+    """
+    blank = {"saved": now, "zones": {}, "certs": {}}
+    if not raw or ttl <= 0:
+        return blank
+    with suppress(ValueError, TypeError, KeyError, UnicodeDecodeError):
+        inventory = loads(raw)
+        if now - float(inventory["saved"]) < ttl and isinstance(inventory["zones"], dict) and isinstance(inventory["certs"], dict):
+            return inventory
+    return blank
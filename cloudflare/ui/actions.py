@@ -2,11 +2,56 @@ from logging import getLogger
 from traceback import format_exc
 
 
+def merge_metrics(data):
+    """Sum the `GET /cloudflare/metrics` answers of every instance.
+
+    `data` is what `bw_instances_utils.get_data()` returns: one `{hostname: response}` dict per
+    instance, where a successful response carries the Lua `api()` metrics table in `msg`.
+    Instances that failed or have metrics disabled are skipped.
+    """
+    total = {"counters": {}, "latency": {}, "latency_buckets_us": [], "workers": 0}
+    for instance in data or []:
+        for response in instance.values():
+            metrics = response.get("msg") if isinstance(response, dict) else None
+            if not isinstance(metrics, dict):
+                continue
+            total["workers"] += metrics.get("workers", 0)
+            total["latency_buckets_us"] = metrics.get("latency_buckets_us") or total["latency_buckets_us"]
+            for name, value in (metrics.get("counters") or {}).items():
+                total["counters"][name] = total["counters"].get(name, 0) + value
+            for name, histogram in (metrics.get("latency") or {}).items():
+                into = total["latency"].setdefault(name, {"buckets": [], "count": 0})
+                buckets = histogram.get("buckets") or []
+                into["buckets"] += [0] * (len(buckets) - len(into["buckets"]))
+                for i, n in enumerate(buckets):
+                    into["buckets"][i] += n
+                into["count"] += histogram.get("count", 0)
+    return total
+
+
+def percentile(histogram, bounds, rank=0.99):
+    """Upper bound of the bucket holding the `rank` percentile, as a display string."""
+    if not histogram or not histogram["count"]:
+        return "n/a"
+    seen = 0
+    for i, n in enumerate(histogram["buckets"]):
+        seen += n
+        if seen >= rank * histogram["count"]:
+            return f"≤ {bounds[i]} µs" if i < len(bounds) else f"> {bounds[-1]} µs"
+    return "n/a"
+
+
+def ratio(hits, misses):
+    total = hits + misses
+    return f"{hits / total:.1%}" if total else "n/a"
+
+
 def pre_render(**kwargs):
-    """Build the Cloudflare plugin status card shown on the BunkerWeb web UI.
+    """Build the Cloudflare plugin status cards shown on the BunkerWeb web UI.
 
     Reflects the result of the Lua `api()` ping (`POST /cloudflare/ping`), which reports
-    that the plugin is up and how many Cloudflare trusted ranges are loaded.
+    that the plugin is up and how many Cloudflare trusted ranges are loaded, plus the hot
+    path metrics summed over every worker of every instance (`GET /cloudflare/metrics`).
     """
     logger = getLogger("UI")
     ret = {
@@ -25,6 +70,30 @@ def pre_render(**kwargs):
         logger.error(f"Failed to get cloudflare ping: {e}")
         # Never surface the raw exception (it may contain internal URLs / details).
         ret["error"] = "Could not retrieve the plugin status"
+        return ret
+
+    # Metrics are informative only: failing to get them never marks the plugin in error.
+    try:
+        metrics = merge_metrics(kwargs["bw_instances_utils"].get_data("cloudflare/metrics"))
+    except BaseException as e:
+        logger.debug(format_exc())
+        logger.warning(f"Failed to get cloudflare metrics: {e}")
+        return ret
+
+    counters = metrics["counters"]
+    bounds = metrics["latency_buckets_us"]
+    cards = {
+        "trust_cache": (
+            "TRUST CACHE HIT RATIO",
+            ratio(counters.get("trust_lru_hit", 0) + counters.get("trust_cache_hit", 0), counters.get("trust_cache_miss", 0)),
+        ),
+        "trust_latency": ("TRUST CHECK P99", percentile(metrics["latency"].get("peer_trust"), bounds)),
+        "fail_open": ("FAIL-OPEN EVENTS", counters.get("fail_open_empty", 0) + counters.get("fail_open_error", 0)),
+        "matcher_builds": ("MATCHER BUILDS", counters.get("matcher_build", 0)),
+        "cert_latency": ("CERTIFICATE LOOKUP P99", percentile(metrics["latency"].get("cert_lookup"), bounds)),
+    }
+    for key, (title, value) in cards.items():
+        ret[key] = {"title": title, "value": value, "col-size": "col-12 col-md-6", "card-classes": "h-100"}
 
     return ret
 
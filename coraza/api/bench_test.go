@@ -0,0 +1,68 @@
+package main
+
+import (
+	"io"
+	"net/http"
+	"net/http/httptest"
+	"strings"
+	"testing"
+)
+
+// benchBody and benchHeaders make up the inspection of a small form POST, as
+// coraza:process_request() sends it : the X-Coraza-* request line, one
+// X-Coraza-Header-* header per header of the inspected request and its body.
+const benchBody = "q=hello&page=2&lang=en"
+
+var benchHeaders = map[string]string{
+	"X-Coraza-Header-Host":            "www.example.com",
+	"X-Coraza-Header-User-Agent":      "Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0",
+	"X-Coraza-Header-Accept":          "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+	"X-Coraza-Header-Accept-Language": "en-US,en;q=0.5",
+	"X-Coraza-Header-Accept-Encoding": "gzip, deflate, br",
+	"X-Coraza-Header-Cookie":          "session=0123456789abcdef; theme=dark",
+	"X-Coraza-Header-Content-Type":    "application/x-www-form-urlencoded",
+	"X-Coraza-Header-Content-Length":  "22",
+}
+
+// The benchmarks below measure an inspection as the API server sees it (newServer
+// and handleRequest) when the client reuses its connection, what the plugin does
+// with CORAZA_KEEPALIVE_POOL_SIZE > 0, and when every inspection opens a new
+// connection (CORAZA_KEEPALIVE_POOL_SIZE = 0). The Lua side of coraza:send() is not
+// part of them. Run them with :
+//
+//	go test -bench . -run '^$'
+func benchmarkRequest(b *testing.B, keepalive bool) {
+	waf = newTestWAF(b, argsRule)
+	srv := httptest.NewUnstartedServer(nil)
+	srv.Config = newServer(http.HandlerFunc(handleRequest))
+	srv.Start()
+	defer srv.Close()
+	client := &http.Client{Transport: &http.Transport{DisableKeepAlives: !keepalive}}
+	defer client.CloseIdleConnections()
+
+	b.ResetTimer()
+	for i := 0; i < b.N; i++ {
+		req, err := http.NewRequest(http.MethodPost, srv.URL+"/request", strings.NewReader(benchBody))
+		if err != nil {
+			b.Fatal(err)
+		}
+		corazaHeaders(req, "0123456789abcdef", "POST", "/search?from=bench")
+		for name, value := range benchHeaders {
+			req.Header.Set(name, value)
+		}
+		res, err := client.Do(req)
+		if err != nil {
+			b.Fatal(err)
+		}
+		// The body must be drained for the connection to go back to the pool.
+		io.Copy(io.Discard, res.Body)
+		res.Body.Close()
+		if res.StatusCode != http.StatusOK {
+			b.Fatalf("unexpected status %d", res.StatusCode)
+		}
+	}
+}
+
+func BenchmarkRequestKeepalive(b *testing.B) { benchmarkRequest(b, true) }
+
+func BenchmarkRequestNewConnection(b *testing.B) { benchmarkRequest(b, false) }
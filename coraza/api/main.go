@@ -189,6 +189,54 @@ func handleRequest(w http.ResponseWriter, req *http.Request) {
 	json.NewEncoder(w).Encode(data)
 }
 
+// envDuration reads a duration (e.g. "75s") from the environment variable name, or
+// returns def when it is unset or invalid.
+func envDuration(name string, def time.Duration) time.Duration {
+	value, ok := os.LookupEnv(name)
+	if !ok {
+		return def
+	}
+	d, err := time.ParseDuration(value)
+	if err != nil || d <= 0 {
+		WarningLogger.Printf("Invalid %s value %q, using %s", name, value, def)
+		return def
+	}
+	return d
+}
+
+// envInt reads a positive integer from the environment variable name, or returns def
+// when it is unset or invalid.
+func envInt(name string, def int) int {
+	value, ok := os.LookupEnv(name)
+	if !ok {
+		return def
+	}
+	i, err := strconv.Atoi(value)
+	if err != nil || i <= 0 {
+		WarningLogger.Printf("Invalid %s value %q, using %d", name, value, def)
+		return def
+	}
+	return i
+}
+
+// newServer returns the API server. BunkerWeb keeps its connections alive between
+// requests (CORAZA_KEEPALIVE_TIMEOUT, 60s by default), so idle connections must live
+// longer than that : otherwise nginx may reuse one the server is closing. The header
+// size limit stays Go's default (1 MB), CORAZA_MAX_HEADER_BYTES only makes it
+// configurable : the X-Coraza-Header-* headers forwarded are bounded by the nginx
+// client header buffers (32 KB by default), far below it.
+func newServer(handler http.Handler) *http.Server {
+	return &http.Server{
+		Handler:           handler,
+		Addr:              "0.0.0.0:8080",
+		WriteTimeout:      15 * time.Second,
+		ReadTimeout:       15 * time.Second,
+		ReadHeaderTimeout: envDuration("CORAZA_READ_HEADER_TIMEOUT", 5*time.Second),
+		IdleTimeout:       envDuration("CORAZA_IDLE_TIMEOUT", 75*time.Second),
+		MaxHeaderBytes:    envInt("CORAZA_MAX_HEADER_BYTES", http.DefaultMaxHeaderBytes),
+	}
+}
+
 func loggingMiddleware(next http.Handler) http.Handler {
     return handlers.LoggingHandler(os.Stdout, next)
 }
@@ -230,11 +278,6 @@ func main() {
 	}()
 
 	InfoLogger.Printf("Coraza API is ready to handle requests")
-	srv := &http.Server{
-        Handler:      r,
-        Addr:         "0.0.0.0:8080",
-        WriteTimeout: 15 * time.Second,
-        ReadTimeout:  15 * time.Second,
-    }
+	srv := newServer(r)
 	srv.ListenAndServe()
 }
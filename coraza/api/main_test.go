@@ -7,6 +7,7 @@ import (
 	"net/http/httptest"
 	"strings"
 	"testing"
+	"time"
 
 	"github.com/corazawaf/coraza/v3"
 )
@@ -19,7 +20,7 @@ func (errReader) Read([]byte) (int, error) { return 0, fmt.Errorf("forced read e
 // newTestWAF builds a self-contained WAF from inline directives so tests never
 // depend on the vendored coreruleset/ (gitignored, only present after a Docker
 // build).
-func newTestWAF(t *testing.T, directives string) coraza.WAF {
+func newTestWAF(t testing.TB, directives string) coraza.WAF {
 	t.Helper()
 	w, err := coraza.NewWAF(coraza.NewWAFConfig().WithDirectives(directives))
 	if err != nil {
@@ -192,3 +193,39 @@ func TestHandleRequest_OversizedBody(t *testing.T) {
 		t.Fatalf("expected 200(deny) or 500 for oversized body, got %d", rec.Code)
 	}
 }
+
+func TestEnvDuration(t *testing.T) {
+	t.Setenv("CORAZA_TEST_DURATION", "90s")
+	if d := envDuration("CORAZA_TEST_DURATION", time.Second); d != 90*time.Second {
+		t.Fatalf("expected 90s, got %s", d)
+	}
+	t.Setenv("CORAZA_TEST_DURATION", "soon")
+	if d := envDuration("CORAZA_TEST_DURATION", time.Second); d != time.Second {
+		t.Fatalf("expected the default on an invalid value, got %s", d)
+	}
+	if d := envDuration("CORAZA_TEST_UNSET", 75*time.Second); d != 75*time.Second {
+		t.Fatalf("expected the default when unset, got %s", d)
+	}
+}
+
+func TestEnvInt(t *testing.T) {
+	t.Setenv("CORAZA_TEST_INT", "4096")
+	if i := envInt("CORAZA_TEST_INT", 1); i != 4096 {
+		t.Fatalf("expected 4096, got %d", i)
+	}
+	t.Setenv("CORAZA_TEST_INT", "-1")
+	if i := envInt("CORAZA_TEST_INT", 1); i != 1 {
+		t.Fatalf("expected the default on a negative value, got %d", i)
+	}
+}
+
+func TestNewServer_IdleOutlivesKeepalive(t *testing.T) {
+	srv := newServer(http.NotFoundHandler())
+	// BunkerWeb keeps idle connections for CORAZA_KEEPALIVE_TIMEOUT (60s by default).
+	if srv.IdleTimeout <= 60*time.Second {
+		t.Fatalf("expected an idle timeout above 60s, got %s", srv.IdleTimeout)
+	}
+	if srv.ReadHeaderTimeout <= 0 || srv.MaxHeaderBytes <= 0 {
+		t.Fatalf("expected header limits to be set, got %s / %d", srv.ReadHeaderTimeout, srv.MaxHeaderBytes)
+	}
+}
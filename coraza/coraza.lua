@@ -16,12 +16,23 @@ local has_variable = utils.has_variable
 local get_deny_status = utils.get_deny_status
 local rand = utils.rand
 local tostring = tostring
+local tonumber = tonumber
 local decode = cjson.decode
 local open = io.open
 local coroutine_create = coroutine.create
 local coroutine_yield = coroutine.yield
 local coroutine_resume = coroutine.resume
 
+-- Per-worker connection settings, only parsed again when their variables change : the
+-- parsed CORAZA_API (scheme, host, port and base path without its trailing slashes),
+-- and the keepalive pool size and timeout.
+local api_setting = nil
+local api = nil
+local pool_size_setting = nil
+local keepalive_timeout_setting = nil
+local pool_size = 0
+local keepalive_timeout = nil
+
 function coraza:initialize(ctx)
 	-- Call parent initialize
 	plugin.initialize(self, "coraza", ctx)
@@ -59,15 +70,8 @@ function coraza:access()
 end
 
 function coraza:ping()
-	-- Get http object
-	local httpc, err = http_new()
-	if not httpc then
-		return false, err
-	end
-	httpc:set_timeout(1000)
 	-- Send ping
-	local res
-	res, err = httpc:request_uri(self.variables["CORAZA_API"] .. "/ping", { keepalive = false })
+	local res, err = self:send("GET", "/ping", nil, nil, 1000)
 	if not res then
 		return false, err
 	end
@@ -92,11 +96,6 @@ function coraza:ping()
 end
 
 function coraza:process_request()
-	-- Instantiate lua-resty-http obj
-	local httpc, err = http_new()
-	if not httpc then
-		return false, err
-	end
 	-- Variables to pass to coraza
 	local data = {
 		["X-Coraza-Version"] = self.ctx.bw.http_version,
@@ -106,8 +105,7 @@ function coraza:process_request()
 		["X-Coraza-Uri"] = self.ctx.bw.request_uri,
 	}
 	-- Compute headers
-	local headers
-	headers, err = ngx_req.get_headers()
+	local headers, err = ngx_req.get_headers()
 	if err == "truncated" then
 		return true, true, "too many headers"
 	end
@@ -154,11 +152,7 @@ function coraza:process_request()
 			body = fbody()
 		end
 	end
-	local res, err = httpc:request_uri(self.variables["CORAZA_API"] .. "/request", {
-		method = "POST",
-		headers = data,
-		body = body,
-	})
+	local res, err = self:send("POST", "/request", data, body)
 	if not res then
 		return false, err
 	end
@@ -184,6 +178,74 @@ function coraza:process_request()
 	return true, data.deny, data.msg
 end
 
+-- Send a request to the Coraza API and read its response. The connection comes from the
+-- worker's keepalive pool and goes back to it once the response is read, or is closed
+-- when CORAZA_KEEPALIVE_POOL_SIZE is 0.
+function coraza:send(method, path, headers, body, timeout)
+	-- Instantiate lua-resty-http obj
+	local httpc, err = http_new()
+	if not httpc then
+		return nil, err
+	end
+	if timeout then
+		httpc:set_timeout(timeout)
+	end
+	if self.variables["CORAZA_API"] ~= api_setting then
+		local parsed
+		parsed, err = httpc:parse_uri(self.variables["CORAZA_API"])
+		if not parsed then
+			return nil, err
+		end
+		parsed[4] = parsed[4]:gsub("/+$", "")
+		api_setting, api = self.variables["CORAZA_API"], parsed
+	end
+	if
+		self.variables["CORAZA_KEEPALIVE_POOL_SIZE"] ~= pool_size_setting
+		or self.variables["CORAZA_KEEPALIVE_TIMEOUT"] ~= keepalive_timeout_setting
+	then
+		pool_size_setting = self.variables["CORAZA_KEEPALIVE_POOL_SIZE"]
+		keepalive_timeout_setting = self.variables["CORAZA_KEEPALIVE_TIMEOUT"]
+		pool_size = tonumber(pool_size_setting) or 0
+		keepalive_timeout = tonumber(keepalive_timeout_setting)
+	end
+	local ok
+	ok, err = httpc:connect({
+		scheme = api[1],
+		host = api[2],
+		port = api[3],
+		pool_size = pool_size > 0 and pool_size or nil,
+	})
+	if not ok then
+		return nil, err
+	end
+	local res
+	res, err = httpc:request({
+		method = method,
+		path = api[4] .. path,
+		headers = headers,
+		body = body,
+	})
+	if not res then
+		httpc:close()
+		return nil, err
+	end
+	-- The whole body must be read before the connection can be reused
+	res.body, err = res:read_body()
+	if not res.body then
+		httpc:close()
+		return nil, err
+	end
+	if pool_size > 0 then
+		ok, err = httpc:set_keepalive(keepalive_timeout, pool_size)
+		if not ok then
+			self.logger:log(ERR, "can't put Coraza API connection into keepalive pool : " .. err)
+		end
+	else
+		httpc:close()
+	end
+	return res
+end
+
 function coraza:is_needed()
 	-- Loading case
 	if self.is_loading then
@@ -0,0 +1,76 @@
+-- luacheck: std min+busted
+-- Micro-benchmark of the ClamAV INSTREAM framing at several upload chunk sizes
+-- (CLAMAV_CHUNK_SIZE). Not part of the default run, use : busted --run=bench
+-- A fake socket stands in for the cosocket : it only records what a real send()
+-- would write, so the numbers show the Lua-side cost (calls and allocations).
+local helpers = require("clamav/clamav_helpers")
+
+local PAYLOAD_SIZE = 8 * 1024 * 1024
+local CHUNK_SIZES = { 4096, 16384, 65536 }
+
+local function fake_socket()
+	local sock = { calls = 0, bytes = 0, parts = {} }
+	function sock:send(data)
+		self.calls = self.calls + 1
+		if type(data) == "table" then
+			for _, part in ipairs(data) do
+				self.bytes = self.bytes + #part
+				self.parts[#self.parts + 1] = part
+			end
+		else
+			self.bytes = self.bytes + #data
+			self.parts[#self.parts + 1] = data
+		end
+		return self.bytes
+	end
+	return sock
+end
+
+-- Send payload the way scan() used to : one concatenated string per chunk.
+local function send_concat(sock, payload, chunk_size)
+	for i = 1, #payload, chunk_size do
+		local chunk = payload:sub(i, i + chunk_size - 1)
+		sock:send(helpers.stream_size(#chunk) .. chunk)
+	end
+end
+
+-- Send payload the way scan() does now : a reused { prefix, chunk } array.
+local function send_table(sock, payload, chunk_size)
+	local frame = {}
+	local full_size = helpers.stream_size(chunk_size)
+	for i = 1, #payload, chunk_size do
+		local chunk = payload:sub(i, i + chunk_size - 1)
+		frame[1] = #chunk == chunk_size and full_size or helpers.stream_size(#chunk)
+		frame[2] = chunk
+		sock:send(frame)
+	end
+end
+
+local function measure(send, payload, chunk_size)
+	local sock = fake_socket()
+	local start = os.clock()
+	send(sock, payload, chunk_size)
+	return sock, os.clock() - start
+end
+
+describe("clamav INSTREAM framing benchmark", function()
+	local payload = ("0123456789abcdef"):rep(PAYLOAD_SIZE / 16)
+
+	for _, chunk_size in ipairs(CHUNK_SIZES) do
+		it("frames " .. PAYLOAD_SIZE .. " bytes in " .. chunk_size .. " byte chunks", function()
+			local concat_sock, concat_time = measure(send_concat, payload, chunk_size)
+			local table_sock, table_time = measure(send_table, payload, chunk_size)
+			-- Both write the same bytes, with one send() per chunk.
+			assert.equals(table.concat(concat_sock.parts), table.concat(table_sock.parts))
+			assert.equals(math.ceil(PAYLOAD_SIZE / chunk_size), table_sock.calls)
+			print(
+				("\n%6d bytes/chunk : %5d sends, concat %7.1f MiB/s, table %7.1f MiB/s"):format(
+					chunk_size,
+					table_sock.calls,
+					PAYLOAD_SIZE / 1048576 / math.max(concat_time, 1e-9),
+					PAYLOAD_SIZE / 1048576 / math.max(table_time, 1e-9)
+				)
+			)
+		end)
+	end
+end)
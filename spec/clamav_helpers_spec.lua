@@ -35,4 +35,149 @@ describe("clamav helpers", function()
 			assert.equals(4, #helpers.stream_size(0xFFFFFFFF))
 		end)
 	end)
+
+	describe("frames", function()
+		it("prefixes every chunk with its size", function()
+			assert.same(
+				{ helpers.stream_size(3), "abc", helpers.stream_size(2), "de" },
+				helpers.frames({ "abc", "de" })
+			)
+		end)
+		it("skips empty chunks, which would end the stream", function()
+			assert.same({ helpers.stream_size(1), "a" }, helpers.frames({ "", "a", "" }))
+			assert.same({}, helpers.frames({}))
+		end)
+	end)
+
+	describe("session_reply", function()
+		it("strips the IDSESSION request id", function()
+			assert.equals("stream: OK", helpers.session_reply("1: stream: OK"))
+			assert.equals("stream: Eicar-Test-Signature FOUND", helpers.session_reply("42: stream: Eicar-Test-Signature FOUND"))
+		end)
+		it("leaves replies outside a session untouched", function()
+			assert.equals("stream: OK", helpers.session_reply("stream: OK"))
+			assert.equals("PONG", helpers.session_reply("PONG"))
+		end)
+	end)
+
+	describe("session_reusable", function()
+		it("keeps the session after a verdict", function()
+			assert.is_true(helpers.session_reusable("stream: OK", true))
+			assert.is_true(helpers.session_reusable("stream: Eicar-Test-Signature FOUND", true))
+		end)
+		it("drops the session after an error", function()
+			assert.is_false(helpers.session_reusable("INSTREAM size limit exceeded. ERROR", true))
+			assert.is_false(helpers.session_reusable("COMMAND READ TIMED OUT", true))
+		end)
+		it("drops a connection outside a session after any reply", function()
+			assert.is_false(helpers.session_reusable("stream: OK", false))
+			assert.is_false(helpers.session_reusable("stream: Eicar-Test-Signature FOUND", nil))
+		end)
+	end)
+
+	describe("parse_backends", function()
+		it("defaults the port", function()
+			assert.same({ { host = "clamav", port = 3310, id = "clamav:3310" } }, helpers.parse_backends("clamav", "3310"))
+		end)
+		it("parses several backends with their own ports", function()
+			local backends = helpers.parse_backends(" clamav-1:3311  10.0.0.2 [2001:db8::1]:3312 [::1] ", 3310)
+			assert.same({ "clamav-1:3311", "10.0.0.2:3310", "2001:db8::1:3312", "::1:3310" }, {
+				backends[1].id,
+				backends[2].id,
+				backends[3].id,
+				backends[4].id,
+			})
+			assert.equals("2001:db8::1", backends[3].host)
+			assert.equals(3312, backends[3].port)
+		end)
+		it("returns an empty list for an empty setting", function()
+			assert.same({}, helpers.parse_backends("", 3310))
+			assert.same({}, helpers.parse_backends(nil, 3310))
+		end)
+	end)
+
+	describe("pick_backend", function()
+		local backends = helpers.parse_backends("a b c", 3310)
+
+		it("rotates in round-robin mode", function()
+			local picked = {}
+			for turn = 0, 3 do
+				picked[#picked + 1] = helpers.pick_backend(backends, {}, {}, "round-robin", turn).host
+			end
+			assert.same({ "a", "b", "c", "a" }, picked)
+		end)
+		it("skips backends that are down", function()
+			local down = { ["b:3310"] = true }
+			assert.equals("c", helpers.pick_backend(backends, down, {}, "round-robin", 1).host)
+			assert.equals("c", helpers.pick_backend(backends, down, {}, "least-conn", 1).host)
+		end)
+		it("picks the backend with the fewest scans in flight", function()
+			local inflight = { ["a:3310"] = 2, ["b:3310"] = 1, ["c:3310"] = 3 }
+			assert.equals("b", helpers.pick_backend(backends, {}, inflight, "least-conn", 0).host)
+		end)
+		it("breaks least-conn ties by turn", function()
+			assert.equals("b", helpers.pick_backend(backends, {}, {}, "least-conn", 1).host)
+			assert.equals("c", helpers.pick_backend(backends, {}, {}, "least-conn", 5).host)
+		end)
+		it("returns nil when every backend is down", function()
+			local down = { ["a:3310"] = true, ["b:3310"] = true, ["c:3310"] = true }
+			assert.is_nil(helpers.pick_backend(backends, down, {}, "least-conn", 0))
+			assert.is_nil(helpers.pick_backend({}, {}, {}, "round-robin", 0))
+		end)
+	end)
+
+	describe("cap_chunk", function()
+		it("keeps every chunk when there is no cap or it isn't reached", function()
+			assert.same({ "abcd" }, { helpers.cap_chunk("abcd", 100, 0, "deny") })
+			assert.same({ "abcd" }, { helpers.cap_chunk("abcd", 6, 10, "deny") })
+		end)
+		it("drops the chunk past the cap with the allow and deny policies", function()
+			assert.same({ "", "allow" }, { helpers.cap_chunk("abcd", 8, 10, "allow") })
+			assert.same({ "", "deny" }, { helpers.cap_chunk("abcd", 8, 10, "deny") })
+		end)
+		it("cuts the chunk to the bytes left before the cap with the prefix policy", function()
+			assert.same({ "ab", "prefix" }, { helpers.cap_chunk("abcd", 8, 10, "prefix") })
+		end)
+		it("cuts the chunk to nothing when the cap was reached exactly", function()
+			assert.same({ "", "prefix" }, { helpers.cap_chunk("abcd", 10, 10, "prefix") })
+		end)
+	end)
+
+	describe("signature_version", function()
+		it("returns the database version of a VERSION reply", function()
+			assert.equals(27431, helpers.signature_version("ClamAV 1.4.1/27431/Tue Oct 13 08:32:11 2026"))
+			assert.equals(27431, helpers.signature_version("ClamAV 1.4.1/27431"))
+		end)
+		it("returns nil without a database version", function()
+			assert.is_nil(helpers.signature_version("ClamAV 1.4.1"))
+			assert.is_nil(helpers.signature_version("COMMAND UNAVAILABLE"))
+			assert.is_nil(helpers.signature_version(nil))
+		end)
+	end)
+
+	describe("cache_key", function()
+		it("includes the signature version when known", function()
+			assert.equals("plugin_clamav_27431_abc", helpers.cache_key("abc", 27431))
+			assert.equals("plugin_clamav_abc", helpers.cache_key("abc", nil))
+		end)
+	end)
+
+	describe("verdict_ttl", function()
+		it("uses the clean or detected TTL", function()
+			assert.equals(3600, helpers.verdict_ttl("clean", "3600", "604800"))
+			assert.equals(604800, helpers.verdict_ttl("Eicar-Test-Signature", "3600", "604800"))
+		end)
+		it("defaults to a day", function()
+			assert.equals(86400, helpers.verdict_ttl("clean", nil, nil))
+			assert.equals(86400, helpers.verdict_ttl("Eicar-Test-Signature", "", nil))
+		end)
+	end)
+
+	describe("journal_key", function()
+		it("cuts the checksum to 32 hex digits after the signature version", function()
+			local checksum = string.rep("ab", 64)
+			assert.equals("27431_" .. string.rep("ab", 16), helpers.journal_key(checksum, 27431))
+			assert.equals(string.rep("ab", 16), helpers.journal_key(checksum, nil))
+		end)
+	end)
 end)
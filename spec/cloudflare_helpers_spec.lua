@@ -1,5 +1,4 @@
 -- luacheck: std min+busted
-local fake = require("spec/helpers/fake_ipmatcher")
 local helpers = require("cloudflare/cloudflare_helpers")
 
 describe("cloudflare helpers", function()
@@ -26,6 +25,35 @@ describe("cloudflare helpers", function()
 		end)
 	end)
 
+	describe("verdict_key", function()
+		it("keys by IP alone when the service has no additional list", function()
+			assert.equals(
+				"plugin_cloudflare_0a1b2c3d__1.2.3.4",
+				helpers.verdict_key("0a1b2c3d", "a.example.com", "1.2.3.4", nil)
+			)
+			assert.equals(
+				helpers.verdict_key("0a1b2c3d", "a.example.com", "1.2.3.4", ""),
+				helpers.verdict_key("0a1b2c3d", "b.example.com", "1.2.3.4", "  ")
+			)
+		end)
+		it("keys by server when the service has an additional list", function()
+			assert.equals(
+				"plugin_cloudflare_0a1b2c3d_a.example.com_1.2.3.4",
+				helpers.verdict_key("0a1b2c3d", "a.example.com", "1.2.3.4", "10.0.0.0/8")
+			)
+			assert.are_not.equals(
+				helpers.verdict_key("0a1b2c3d", "a.example.com", "1.2.3.4", "10.0.0.0/8"),
+				helpers.verdict_key("0a1b2c3d", "a.example.com", "1.2.3.4", "")
+			)
+		end)
+		it("keys by generation of the trusted ranges", function()
+			assert.are_not.equals(
+				helpers.verdict_key("0a1b2c3d", "a.example.com", "1.2.3.4", nil),
+				helpers.verdict_key("ffffffff", "a.example.com", "1.2.3.4", nil)
+			)
+		end)
+	end)
+
 	describe("classify_cache", function()
 		it("maps a miss (nil) to 'miss'", function()
 			assert.equals("miss", helpers.classify_cache(nil))
@@ -54,42 +82,176 @@ describe("cloudflare helpers", function()
 		end)
 	end)
 
-	describe("match_trusted", function()
-		local function ips(t)
-			return { ipv4 = t.ipv4 or {}, ipv6 = t.ipv6 or {}, additional = t.additional or {} }
-		end
-
-		it("matches an ipv4 address and labels it", function()
-			assert.same({ true, "ipv4" }, { helpers.match_trusted(ips({ ipv4 = { "1.2.3.4" } }), "1.2.3.4", fake.new) })
+	describe("addr_family", function()
+		it("detects ipv6 by the presence of a colon", function()
+			assert.equals("ipv6", helpers.addr_family("2400:cb00::1"))
+			assert.equals("ipv6", helpers.addr_family("::ffff:1.2.3.4"))
 		end)
-		it("matches ipv6 and labels it", function()
-			assert.same({ true, "ipv6" }, { helpers.match_trusted(ips({ ipv6 = { "::1" } }), "::1", fake.new) })
+		it("defaults to ipv4", function()
+			assert.equals("ipv4", helpers.addr_family("1.2.3.4"))
+			assert.equals("ipv4", helpers.addr_family(nil))
 		end)
-		it("falls back to the additional list", function()
+	end)
+
+	describe("parse_ip / parse_cidr", function()
+		it("parses IPv4 into 4 bytes", function()
+			assert.same({ "ipv4", { 173, 245, 48, 1 } }, { helpers.parse_ip("173.245.48.1") })
+		end)
+		it("parses compressed and embedded-IPv4 IPv6 into 16 bytes", function()
+			assert.same({ "ipv6", { 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0 } }, { helpers.parse_ip("::") })
+			assert.same({ "ipv6", { 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1 } }, { helpers.parse_ip("::1") })
+			assert.same(
+				{ "ipv6", { 36, 0, 203, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0 } },
+				{ helpers.parse_ip("2400:cb00::") }
+			)
 			assert.same(
-				{ true, "additional" },
-				{ helpers.match_trusted(ips({ additional = { "9.9.9.9" } }), "9.9.9.9", fake.new) }
+				{ "ipv6", { 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 255, 255, 1, 2, 3, 4 } },
+				{ helpers.parse_ip("::ffff:1.2.3.4") }
 			)
 		end)
-		it("checks ipv4 before additional (order matters)", function()
-			local t = ips({ ipv4 = { "1.2.3.4" }, additional = { "1.2.3.4" } })
-			assert.same({ true, "ipv4" }, { helpers.match_trusted(t, "1.2.3.4", fake.new) })
+		it("rejects malformed addresses", function()
+			for _, addr in ipairs({
+				"not-an-ip",
+				"1.2.3",
+				"1.2.3.256",
+				"01.2.3.4",
+				"1::2::3",
+				"1:2:3:4:5:6:7:8:9",
+				"1:2:3:4:5:6:7::8",
+				":1::",
+				"1::2:",
+				"12345::",
+				"1.2.3.4::",
+			}) do
+				assert.is_nil((helpers.parse_ip(addr)))
+			end
+			assert.is_nil((helpers.parse_ip(nil)))
 		end)
-		it("returns false/'ko' when nothing matches", function()
-			assert.same({ false, "ko" }, { helpers.match_trusted(ips({ ipv4 = { "1.2.3.4" } }), "8.8.8.8", fake.new) })
+		it("defaults the prefix to the address length", function()
+			assert.same({ "ipv4", { 1, 2, 3, 4 }, 32 }, { helpers.parse_cidr("1.2.3.4") })
+			assert.equals(128, select(3, helpers.parse_cidr("::1")))
+			assert.equals(20, select(3, helpers.parse_cidr("173.245.48.0/20")))
 		end)
-		it("treats missing categories as empty (no nil index)", function()
-			assert.same({ false, "ko" }, { helpers.match_trusted({}, "8.8.8.8", fake.new) })
+		it("rejects an out of range prefix", function()
+			assert.is_nil((helpers.parse_cidr("1.2.3.0/33")))
+			assert.is_nil((helpers.parse_cidr("::/129")))
+			assert.is_nil((helpers.parse_cidr("1.2.3.0/")))
 		end)
-		it("propagates a matcher construction error", function()
-			local trusted, err = helpers.match_trusted(ips({}), "1.2.3.4", fake.new_err)
-			assert.is_nil(trusted)
-			assert.equals("construction boom", err)
+	end)
+
+	describe("new_classifier / classify", function()
+		-- Same vectors as tests/test_cloudflare_helpers.py : the Lua and Python
+		-- classifiers must return identical verdicts.
+		local trusted = {
+			ipv4 = { "173.245.48.0/20", "103.21.244.0/22" },
+			ipv6 = { "2400:cb00::/32" },
+			additional = { "10.0.0.0/8", "173.245.48.1", "2001:db8::/32" },
+		}
+		local vectors = {
+			{ "173.245.48.1", true, "ipv4" },
+			{ "173.245.63.255", true, "ipv4" },
+			{ "103.21.247.1", true, "ipv4" },
+			{ "173.245.64.0", false, "ko" },
+			{ "10.1.2.3", true, "additional" },
+			{ "2400:cb00::1", true, "ipv6" },
+			{ "2400:cb01::1", false, "ko" },
+			{ "2001:db8:1::5", true, "additional" },
+			{ "::ffff:173.245.48.1", false, "ko" },
+			{ "8.8.8.8", false, "ko" },
+		}
+
+		it("returns the highest-priority kind containing the address", function()
+			local classifier = assert(helpers.new_classifier(trusted))
+			for _, vector in ipairs(vectors) do
+				assert.same({ vector[2], vector[3] }, { helpers.classify(classifier, vector[1]) })
+			end
+		end)
+		it("ignores host bits past the prefix", function()
+			local classifier = assert(helpers.new_classifier({ additional = { "192.0.2.77/24" } }))
+			assert.same({ true, "additional" }, { helpers.classify(classifier, "192.0.2.1") })
+		end)
+		it("supports a /0 network", function()
+			local classifier = assert(helpers.new_classifier({ additional = { "0.0.0.0/0" } }))
+			assert.same({ true, "additional" }, { helpers.classify(classifier, "198.51.100.7") })
+			assert.same({ false, "ko" }, { helpers.classify(classifier, "::1") })
+		end)
+		it("treats missing categories as empty", function()
+			local classifier = assert(helpers.new_classifier({}))
+			assert.same({ false, "ko" }, { helpers.classify(classifier, "1.2.3.4") })
+		end)
+		it("fails to build on an invalid entry", function()
+			local classifier, err = helpers.new_classifier({ additional = { "1.2.3.4", "nope" } })
+			assert.is_nil(classifier)
+			assert.equals("invalid IP/network nope", err)
+		end)
+		it("returns nil, err for an invalid address", function()
+			local classifier = assert(helpers.new_classifier(trusted))
+			local trusted_ok, err = helpers.classify(classifier, "not-an-ip")
+			assert.is_nil(trusted_ok)
+			assert.equals("invalid IP address not-an-ip", err)
+		end)
+	end)
+
+	describe("metrics", function()
+		it("counts events by name", function()
+			local metrics = helpers.new_metrics()
+			helpers.count(metrics, "trust_lru_hit")
+			helpers.count(metrics, "trust_lru_hit")
+			helpers.count(metrics, "matcher_build", 3)
+			assert.same({ trust_lru_hit = 2, matcher_build = 3 }, metrics.counters)
+		end)
+		it("puts observations in the first bucket whose bound they don't exceed", function()
+			local metrics = helpers.new_metrics()
+			helpers.observe(metrics, "peer_trust", 0.000005) -- 5us
+			helpers.observe(metrics, "peer_trust", 0.00001) -- 10us, bounds are inclusive
+			helpers.observe(metrics, "peer_trust", 0.0002) -- 200us
+			helpers.observe(metrics, "peer_trust", 1) -- past the last bound
+			local histogram = metrics.latency.peer_trust
+			assert.same({ 2, 0, 0, 1, 0, 0, 1 }, histogram.buckets)
+			assert.equals(4, histogram.count)
+			assert.is_true(math.abs(histogram.sum_us - 1000215) < 1e-6)
+		end)
+		it("merges workers, tolerating missing tables", function()
+			local a = helpers.new_metrics()
+			helpers.count(a, "fail_open_empty")
+			helpers.observe(a, "cert_lookup", 0.00002)
+			local b = helpers.new_metrics()
+			helpers.count(b, "fail_open_empty", 2)
+			helpers.count(b, "fail_open_error")
+			helpers.observe(b, "cert_lookup", 0.002)
+			local total = helpers.new_metrics()
+			helpers.merge_metrics(total, a)
+			helpers.merge_metrics(total, b)
+			helpers.merge_metrics(total, {})
+			assert.same({ fail_open_empty = 3, fail_open_error = 1 }, total.counters)
+			assert.same({ 0, 1, 0, 0, 0, 1, 0 }, total.latency.cert_lookup.buckets)
+			assert.equals(2, total.latency.cert_lookup.count)
+		end)
+		it("computes hit ratios", function()
+			assert.is_nil(helpers.hit_ratio(nil, nil))
+			assert.is_nil(helpers.hit_ratio(0, 0))
+			assert.equals(0.75, helpers.hit_ratio(3, 1))
+			assert.equals(1, helpers.hit_ratio(2, nil))
 		end)
-		it("propagates a matcher :match error", function()
-			local trusted, err = helpers.match_trusted(ips({ ipv4 = { "1.2.3.4" } }), "1.2.3.4", fake.new_match_err)
-			assert.is_nil(trusted)
-			assert.equals("match boom", err)
+	end)
+
+	describe("keyspace_events_enabled / keyspace_key", function()
+		it("requires keyspace channels and the set, generic and expired classes", function()
+			assert.is_true(helpers.keyspace_events_enabled("Kg$x"))
+			assert.is_true(helpers.keyspace_events_enabled("KEA"))
+			assert.is_false(helpers.keyspace_events_enabled("Eg$x"))
+			assert.is_false(helpers.keyspace_events_enabled("Kg$"))
+			assert.is_false(helpers.keyspace_events_enabled(""))
+			assert.is_false(helpers.keyspace_events_enabled(nil))
+		end)
+		it("extracts the key of a keyspace channel", function()
+			assert.equals("bans_ip_1.2.3.4", helpers.keyspace_key("__keyspace@0__:bans_ip_1.2.3.4"))
+			assert.equals(
+				"bans_service_a.com_ip_::1",
+				helpers.keyspace_key("__keyspace@12__:bans_service_a.com_ip_::1")
+			)
+			assert.is_nil(helpers.keyspace_key("__keyevent@0__:set"))
+			assert.is_nil(helpers.keyspace_key(nil))
 		end)
 	end)
 end)
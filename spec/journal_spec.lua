@@ -0,0 +1,222 @@
+-- luacheck: std min+busted
+
+-- Shared dict good enough for the journal : values, expiries, lists and add()
+local function fake_dict()
+	local values, expiries = {}, {}
+	local dict = {}
+	function dict:get(key)
+		return values[key]
+	end
+	function dict:set(key, value, ttl)
+		values[key] = value
+		expiries[key] = ttl
+		return true
+	end
+	function dict:add(key, value, ttl)
+		if values[key] ~= nil then
+			return false, "exists"
+		end
+		return self:set(key, value, ttl)
+	end
+	function dict:delete(key)
+		values[key] = nil
+	end
+	function dict:incr(key, n, init)
+		values[key] = (values[key] or init) + n
+		return values[key]
+	end
+	function dict:ttl(key)
+		return expiries[key]
+	end
+	function dict:llen(key)
+		return #(values[key] or {})
+	end
+	function dict:rpush(key, value)
+		values[key] = values[key] or {}
+		table.insert(values[key], value)
+		return #values[key]
+	end
+	function dict:lpop(key)
+		return table.remove(values[key] or {}, 1)
+	end
+	return dict
+end
+
+-- Plugin datastore wrapper around it
+local function fake_datastore()
+	local dict = fake_dict()
+	return {
+		dict = dict,
+		get = function(_, key)
+			return dict:get(key)
+		end,
+		set = function(_, key, value, ttl)
+			return dict:set(key, value, ttl)
+		end,
+		delete = function(_, key)
+			dict:delete(key)
+			return true
+		end,
+	}
+end
+
+local function read(path)
+	local f = io.open(path, "r")
+	local data = f:read("*a")
+	f:close()
+	return data
+end
+
+describe("journal copies", function()
+	it("are the same file in every plugin", function()
+		assert.equals(read("clamav/journal.lua"), read("virustotal/journal.lua"))
+	end)
+end)
+
+-- Every plugin ships its own copy of the journal : they all go through the same tests
+for _, name in ipairs({ "clamav/journal", "virustotal/journal" }) do
+	local journal = require(name)
+
+	describe(name, function()
+		describe("journal_line", function()
+			it("serializes a value on one line", function()
+				assert.equals("KEY\t1700000000\tclean\n", journal.journal_line("KEY", 1700000000.6, "clean"))
+			end)
+			it("keeps the line format whatever the value", function()
+				assert.equals("KEY\t1700000000\ta b c\n", journal.journal_line("KEY", 1700000000, "a\tb\nc"))
+			end)
+		end)
+
+		describe("parse_journal_line", function()
+			it("reads back a journal line", function()
+				local key, expiry, value = journal.parse_journal_line("KEY\t1700000000\tclean")
+				assert.equals("KEY", key)
+				assert.equals(1700000000, expiry)
+				assert.equals("clean", value)
+			end)
+			it("returns nil on a malformed line", function()
+				assert.is_nil(journal.parse_journal_line("KEY\tsoon\tclean"))
+				assert.is_nil(journal.parse_journal_line("KEY\t1700000000"))
+				assert.is_nil(journal.parse_journal_line(""))
+			end)
+		end)
+
+		describe("compact_journal", function()
+			local lines = {
+				"a\t2000\tclean",
+				"b\t2000\tclean",
+				"a\t3000\tdetected",
+				"c\t500\tclean",
+				"garbage",
+				"d\t2000\tclean",
+			}
+			it("keeps the last unexpired line of each key, oldest first", function()
+				assert.same({
+					{ "b", 2000, "clean" },
+					{ "a", 3000, "detected" },
+					{ "d", 2000, "clean" },
+				}, journal.compact_journal(lines, 1000, 10))
+			end)
+			it("evicts the least recently written entries past the cap", function()
+				assert.same({
+					{ "a", 3000, "detected" },
+					{ "d", 2000, "clean" },
+				}, journal.compact_journal(lines, 1000, 2))
+			end)
+			it("drops the entries expired by now", function()
+				assert.same({ { "a", 3000, "detected" } }, journal.compact_journal(lines, 2000, 10))
+			end)
+		end)
+
+		describe("file", function()
+			local saved_ngx = _G.ngx
+			local path, datastore, logged
+
+			before_each(function()
+				_G.ngx = {
+					ERR = 1,
+					now = function()
+						return 1000
+					end,
+					time = function()
+						return 1000
+					end,
+				}
+				path = os.tmpname()
+				os.remove(path)
+				datastore = fake_datastore()
+				logged = {}
+			end)
+
+			after_each(function()
+				os.remove(path)
+				os.remove(path .. ".tmp")
+				_G.ngx = saved_ngx
+			end)
+
+			local function new(cap)
+				local logger = {
+					log = function(_, _, msg)
+						logged[#logged + 1] = msg
+					end,
+				}
+				return journal.new(datastore, logger, path, "plugin_test", cap or 10)
+			end
+
+			it("loads nothing without a journal", function()
+				assert.equals(0, new():load())
+			end)
+
+			it("appends the queued values and loads them back", function()
+				local j = new()
+				j:append("a", "clean", 100)
+				j:append("b", "detected", 200)
+				j:flush()
+				assert.equals("a\t1100\tclean\nb\t1200\tdetected\n", read(path))
+				assert.equals(2, datastore.dict:get("plugin_test_journal_lines"))
+
+				datastore = fake_datastore()
+				assert.equals(2, new():load())
+				assert.equals("detected", datastore:get("plugin_test_persist_b"))
+				assert.equals(200, datastore.dict:ttl("plugin_test_persist_b"))
+			end)
+
+			it("takes a loaded value out of the datastore", function()
+				local j = new()
+				datastore:set("plugin_test_persist_a", "clean", 50)
+				local value, ttl = j:take("a")
+				assert.equals("clean", value)
+				assert.equals(50, ttl)
+				assert.is_nil(datastore:get("plugin_test_persist_a"))
+				assert.is_nil(j:take("a"))
+			end)
+
+			it("leaves the queue to the worker holding the lock", function()
+				local j = new()
+				j:append("a", "clean", 100)
+				datastore.dict:add("plugin_test_journal_lock", true, 30)
+				j:flush()
+				assert.is_nil(io.open(path, "r"))
+				assert.equals(1, datastore.dict:llen("plugin_test_journal_queue"))
+
+				datastore.dict:delete("plugin_test_journal_lock")
+				j:flush()
+				assert.equals("a\t1100\tclean\n", read(path))
+				assert.is_nil(datastore.dict:get("plugin_test_journal_lock"))
+			end)
+
+			it("compacts the journal past twice the cache size", function()
+				local j = new(1)
+				j:append("a", "clean", 100)
+				j:append("a", "detected", 100)
+				j:flush()
+				assert.equals("a\t1100\tclean\na\t1100\tdetected\n", read(path))
+				j:append("b", "clean", 100)
+				j:flush()
+				assert.equals("b\t1100\tclean\n", read(path))
+				assert.equals(1, datastore.dict:get("plugin_test_journal_lines"))
+				assert.same({}, logged)
+			end)
+		end)
+	end)
+end
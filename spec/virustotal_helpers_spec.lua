@@ -20,4 +20,90 @@ describe("virustotal helpers", function()
 			assert.equals("10 suspicious and 4 malicious", helpers.evaluate(10, 4, 5, 2))
 		end)
 	end)
+
+	describe("lookup_interval", function()
+		it("spreads lookups over the minute", function()
+			assert.equals(15, helpers.lookup_interval("4"))
+			assert.equals(0.1, helpers.lookup_interval("600"))
+		end)
+		it("runs every second without a quota", function()
+			assert.equals(1, helpers.lookup_interval(nil))
+			assert.equals(1, helpers.lookup_interval("0"))
+			assert.equals(1, helpers.lookup_interval("abc"))
+		end)
+	end)
+
+	describe("lookup_batch", function()
+		it("looks up one IP per run within a quota", function()
+			assert.equals(1, helpers.lookup_batch("4", 8))
+			assert.equals(1, helpers.lookup_batch("600", 8))
+		end)
+		it("looks up a batch of IPs per run without a quota", function()
+			assert.equals(8, helpers.lookup_batch("0", 8))
+			assert.equals(8, helpers.lookup_batch(nil, 8))
+		end)
+	end)
+
+	describe("fresh_ttl", function()
+		it("subtracts the refresh window from the cache TTL", function()
+			assert.equals(82800, helpers.fresh_ttl(86400, "3600"))
+			assert.equals(86400, helpers.fresh_ttl(86400, "0"))
+			assert.equals(86400, helpers.fresh_ttl(86400, nil))
+		end)
+		it("never goes below one second", function()
+			assert.equals(1, helpers.fresh_ttl(86400, "86400"))
+			assert.equals(1, helpers.fresh_ttl(86400, "100000"))
+		end)
+	end)
+
+	describe("quota_summary", function()
+		it("reports the daily and per minute quota", function()
+			assert.equals(
+				"12 request(s) used today out of 500, 3/4 left this minute, 2 throttled, 5 coalesced",
+				helpers.quota_summary({
+					per_minute = 4,
+					tokens = 3,
+					per_day = 500,
+					used_today = 12,
+					throttled = 2,
+					coalesced = 5,
+				})
+			)
+		end)
+		it("leaves out the daily quota when there is none", function()
+			assert.equals(
+				"12 request(s) used today, 0/4 left this minute, 0 throttled, 0 coalesced",
+				helpers.quota_summary({
+					per_minute = 4,
+					tokens = 0,
+					per_day = 0,
+					used_today = 12,
+					throttled = 0,
+					coalesced = 0,
+				})
+			)
+		end)
+		it("leaves out the per minute quota when there is none", function()
+			assert.equals(
+				"12 request(s) used today, 0 throttled, 1 coalesced",
+				helpers.quota_summary({
+					per_minute = 0,
+					per_day = 0,
+					used_today = 12,
+					throttled = 0,
+					coalesced = 1,
+				})
+			)
+		end)
+	end)
+
+	describe("journal_key", function()
+		it("cuts file checksums to 32 hex digits", function()
+			assert.equals("file_" .. string.rep("ab", 16), helpers.journal_key("file_" .. string.rep("ab", 32)))
+		end)
+		it("keeps IPs as is", function()
+			assert.equals("ip_2001:db8::1", helpers.journal_key("ip_2001:db8::1"))
+			assert.equals("ip_1.2.3.4", helpers.journal_key("ip_1.2.3.4"))
+		end)
+	end)
 end)
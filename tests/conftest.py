@@ -9,12 +9,17 @@ class FakePingUtils:
     ``get_ping`` either returns a canned ``{"status": ...}`` payload or raises,
     so both the happy path and the broad ``except BaseException`` path of
     ``pre_render`` can be exercised without a running BunkerWeb instance.
+    ``get_data`` does the same for the per-instance answers of a plugin API
+    route (cloudflare's metrics, virustotal's quota).
     """
 
-    def __init__(self, status=None, exc=None):
+    def __init__(self, status=None, exc=None, data=None, data_exc=None):
         self._status = status
         self._exc = exc
+        self._data = data
+        self._data_exc = data_exc
         self.called_with = None
+        self.data_called_with = None
 
     def get_ping(self, plugin):
         self.called_with = plugin
@@ -22,6 +27,12 @@ class FakePingUtils:
             raise self._exc
         return {"status": self._status}
 
+    def get_data(self, endpoint):
+        self.data_called_with = endpoint
+        if self._data_exc is not None:
+            raise self._data_exc
+        return self._data or []
+
 
 @pytest.fixture
 def fake_ping_utils():
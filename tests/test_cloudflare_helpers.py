@@ -1,5 +1,6 @@
 """Unit tests for cloudflare/jobs/cloudflare_helpers.py (pure logic, no BunkerWeb deps)."""
 
+import hashlib
 import importlib.util
 from datetime import datetime, timezone
 from pathlib import Path
@@ -38,6 +39,66 @@ def test_check_line_rejects_junk(helpers):
     assert helpers.check_line(b"999.999.0.0/8") == (False, b"")
 
 
+# --- IPClassifier / dedupe_ranges -------------------------------------------------
+
+# Same vectors as spec/cloudflare_helpers_spec.lua: the Lua and Python classifiers must
+# return identical verdicts.
+TRUSTED = {
+    "ipv4": ["173.245.48.0/20", "103.21.244.0/22"],
+    "ipv6": ["2400:cb00::/32"],
+    "additional": ["10.0.0.0/8", "173.245.48.1", "2001:db8::/32"],
+}
+
+
+@pytest.mark.parametrize(
+    "addr,expected",
+    [
+        ("173.245.48.1", (True, "ipv4")),
+        ("173.245.63.255", (True, "ipv4")),
+        ("103.21.247.1", (True, "ipv4")),
+        ("173.245.64.0", (False, "ko")),
+        ("10.1.2.3", (True, "additional")),
+        ("2400:cb00::1", (True, "ipv6")),
+        ("2400:cb01::1", (False, "ko")),
+        ("2001:db8:1::5", (True, "additional")),
+        ("::ffff:173.245.48.1", (False, "ko")),
+        ("8.8.8.8", (False, "ko")),
+    ],
+)
+def test_classifier_verdicts(helpers, addr, expected):
+    assert helpers.IPClassifier(TRUSTED).classify(addr) == expected
+
+
+def test_classifier_ignores_host_bits_and_supports_slash_zero(helpers):
+    assert helpers.IPClassifier({"additional": ["192.0.2.77/24"]}).classify("192.0.2.1") == (True, "additional")
+    classifier = helpers.IPClassifier({"additional": ["0.0.0.0/0"]})
+    assert classifier.classify(b"198.51.100.7") == (True, "additional")
+    assert classifier.classify("::1") == (False, "ko")
+
+
+def test_classifier_rejects_invalid(helpers):
+    with pytest.raises(ValueError):
+        helpers.IPClassifier({"additional": ["nope"]})
+    with pytest.raises(ValueError):
+        helpers.IPClassifier(TRUSTED).classify("not-an-ip")
+
+
+def test_classifier_covers(helpers):
+    classifier = helpers.IPClassifier({"ipv4": ["173.245.48.0/20"]})
+    assert classifier.covers("173.245.49.0/24") is True
+    assert classifier.covers("173.245.48.0/20") is True
+    assert classifier.covers("173.245.0.0/16") is False
+
+
+def test_dedupe_ranges_drops_duplicates_and_covered(helpers):
+    lines = [b"173.245.48.0/20", b"173.245.49.0/24", b"2400:cb00::/32", b"173.245.48.0/20", b"2400:cb00:1::/48", b"103.21.244.0/22"]
+    assert helpers.dedupe_ranges(lines) == ["173.245.48.0/20", "2400:cb00::/32", "103.21.244.0/22"]
+
+
+def test_dedupe_ranges_skips_junk_and_clears_host_bits(helpers):
+    assert helpers.dedupe_ranges(["junk", "1.2.3.4/24", "", "1.2.3.9"]) == ["1.2.3.0/24"]
+
+
 # --- parse_ban_key ----------------------------------------------------------------
 
 
@@ -196,3 +257,294 @@ def test_find_matching_cert_match_expired(helpers, now):
 def test_find_matching_cert_no_match(helpers, now):
     certs = [{"id": "c1", "hostnames": ["other.example.com"], "expires_on": "2099-01-01 00:00:00 +0000 UTC"}]
     assert helpers.find_matching_cert(certs, ["www.example.com"], now) == (None, False, False)
+
+
+def test_index_certs_first_listed_wins(helpers):
+    certs = [{"id": "c1", "hostnames": ["b.com", "a.com"]}, {"id": "c2", "hostnames": ["a.com", "b.com"]}, {"id": "c3", "hostnames": ["a.com"]}]
+    index = helpers.index_certs(certs)
+    assert index[frozenset(["a.com", "b.com"])]["id"] == "c1"
+    assert index[frozenset(["a.com"])]["id"] == "c3"
+
+
+def test_find_indexed_cert(helpers, now):
+    certs = [
+        {"id": "c1", "hostnames": ["other.example.com"], "expires_on": "2099-01-01 00:00:00 +0000 UTC"},
+        {"id": "c2", "hostnames": ["example.com", "www.example.com"], "expires_on": "2020-01-01 00:00:00 +0000 UTC"},
+    ]
+    index = helpers.index_certs(certs)
+    assert helpers.find_indexed_cert(index, ["www.example.com", "example.com"], now) == ("c2", True, True)
+    assert helpers.find_indexed_cert(index, ["example.com"], now) == (None, False, False)
+
+
+def test_load_inventory(helpers):
+    inventory = {"saved": 1000.0, "zones": {"digest": {"example.com": [{"id": "z1"}]}}, "certs": {"z1": []}}
+    raw = helpers.dumps(inventory).encode()
+    assert helpers.load_inventory(raw, 3600, 2000.0) == inventory
+    blank = {"saved": 5000.0, "zones": {}, "certs": {}}
+    assert helpers.load_inventory(raw, 3600, 5000.0) == blank
+    assert helpers.load_inventory(raw, 0, 2000.0) == {"saved": 2000.0, "zones": {}, "certs": {}}
+    for raw in (None, b"{oops", b"[]", b"{}"):
+        assert helpers.load_inventory(raw, 3600, 5000.0) == blank
+
+
+# --- edge ban sync state ----------------------------------------------------------
+
+
+def test_load_sync_state_blank_when_missing_or_corrupt(helpers):
+    for raw in (None, b"", b"{not json", b"[]", b"\xff"):
+        state = helpers.load_sync_state(raw, "acc", "bans")
+        assert state == {"account_id": "acc", "list_name": "bans", "list_id": None, "items": {}, "last_full_sync": 0}
+
+
+def test_load_sync_state_round_trip(helpers):
+    state = {"account_id": "acc", "list_name": "bans", "list_id": "l1", "items": {"1.2.3.4": "i1", "5.6.7.8": None}, "last_full_sync": 42}
+    raw = helpers.dump_sync_state(state)
+    assert raw == helpers.dump_sync_state(dict(reversed(list(state.items()))))
+    assert helpers.load_sync_state(raw, "acc", "bans") == state
+
+
+def test_load_sync_state_ignores_foreign_list(helpers):
+    raw = helpers.dump_sync_state({"account_id": "acc", "list_name": "bans", "list_id": "l1", "items": {}, "last_full_sync": 42})
+    assert helpers.load_sync_state(raw, "other", "bans")["list_id"] is None
+    assert helpers.load_sync_state(raw, "acc", "other_bans")["list_id"] is None
+
+
+def test_full_sync_due(helpers):
+    assert helpers.full_sync_due({"list_id": None, "last_full_sync": 1000}, 3600, 1001) is True
+    assert helpers.full_sync_due({"list_id": "l1", "last_full_sync": 1000}, 3600, 1001) is False
+    assert helpers.full_sync_due({"list_id": "l1", "last_full_sync": 1000}, 3600, 4600) is True
+
+
+def test_plan_edge_sync(helpers):
+    items = {"1.1.1.1": "i1", "2.2.2.2": "i2", "3.3.3.3": None}
+    to_add, to_remove, unknown = helpers.plan_edge_sync({"1.1.1.1", "4.4.4.4"}, items)
+    assert to_add == {"4.4.4.4"}
+    assert to_remove == {"2.2.2.2": "i2"}
+    assert unknown == {"3.3.3.3"}
+
+
+def test_plan_edge_sync_in_sync(helpers):
+    assert helpers.plan_edge_sync({"1.1.1.1"}, {"1.1.1.1": None}) == (set(), {}, set())
+
+
+class FakeRedis:
+    """Minimal Redis client for ``read_ban_changes``: string keys, one sorted set, and a
+    log of every key whose existence was checked. Any SCAN fails the test."""
+
+    def __init__(self, keys, events=(), alive=True, start=0.0):
+        self.keys = set(keys)
+        self.events = list(events)
+        self.values = {"plugin_cloudflare_ban_events_start": str(start).encode()} if start is not None else {}
+        if alive:
+            self.keys.add("plugin_cloudflare_ban_events_alive")
+        self.checked = []
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def zrangebyscore(self, name, low, high, withscores=False):
+        return [(key.encode(), score) for key, score in self.events if score >= low]
+
+    def scan_iter(self, *args, **kwargs):
+        raise AssertionError("the incremental path must not scan the ban keys")
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def exists(self, key):
+        self.redis.checked.append(key)
+        self.calls.append(int(key in self.redis.keys))
+        return self
+
+    def get(self, key):
+        self.calls.append(self.redis.values.get(key))
+        return self
+
+    def execute(self):
+        return self.calls
+
+
+def test_group_ban_keys(helpers):
+    keys = [b"bans_ip_1.2.3.4", "bans_service_a.com_ip_1.2.3.4", "bans_service_b.com_ip_5.6.7.8", "not_a_ban"]
+    assert helpers.group_ban_keys(keys) == {
+        "1.2.3.4": ["bans_ip_1.2.3.4", "bans_service_a.com_ip_1.2.3.4"],
+        "5.6.7.8": ["bans_service_b.com_ip_5.6.7.8"],
+    }
+
+
+def test_read_ban_changes_only_checks_changed_ips(helpers):
+    bans = {
+        "1.1.1.1": ["bans_ip_1.1.1.1"],
+        "2.2.2.2": ["bans_ip_2.2.2.2", "bans_service_a.com_ip_2.2.2.2"],
+        "3.3.3.3": ["bans_ip_3.3.3.3"],
+    }
+    redis = FakeRedis(
+        # 2.2.2.2 lost its global ban but keeps its service one, 3.3.3.3 expired, 4.4.4.4 is new.
+        keys={"bans_ip_1.1.1.1", "bans_service_a.com_ip_2.2.2.2", "bans_ip_4.4.4.4"},
+        events=[("bans_ip_2.2.2.2", 1010.0), ("bans_ip_3.3.3.3", 1020.0), ("bans_ip_4.4.4.4", 1030.0)],
+        start=500.0,
+    )
+    new_bans, since = helpers.read_ban_changes(redis, bans, 1000.0, 1060.0)
+    assert new_bans == {
+        "1.1.1.1": ["bans_ip_1.1.1.1"],
+        "2.2.2.2": ["bans_service_a.com_ip_2.2.2.2"],
+        "4.4.4.4": ["bans_ip_4.4.4.4"],
+    }
+    assert since == 1030.0
+    # The unchanged ban of 1.1.1.1 is never read.
+    assert "bans_ip_1.1.1.1" not in redis.checked
+    assert bans["2.2.2.2"] == ["bans_ip_2.2.2.2", "bans_service_a.com_ip_2.2.2.2"]
+
+
+def test_read_ban_changes_without_events_keeps_bans(helpers):
+    bans = {"1.1.1.1": ["bans_ip_1.1.1.1"]}
+    redis = FakeRedis(keys=set(), start=500.0)
+    assert helpers.read_ban_changes(redis, bans, 1000.0, 1060.0) == (bans, 1000.0)
+    assert redis.checked == ["plugin_cloudflare_ban_events_alive"]
+
+
+def test_read_ban_changes_requires_uninterrupted_coverage(helpers):
+    bans = {"1.1.1.1": ["bans_ip_1.1.1.1"]}
+    # No watcher alive, or one whose coverage began after the watermark.
+    assert helpers.read_ban_changes(FakeRedis(keys=set(), alive=False, start=500.0), bans, 1000.0, 1060.0) is None
+    assert helpers.read_ban_changes(FakeRedis(keys=set(), start=1001.0), bans, 1000.0, 1060.0) is None
+    assert helpers.read_ban_changes(FakeRedis(keys=set(), start=None), bans, 1000.0, 1060.0) is None
+    # No previous scan to build on, or a watermark past the event retention.
+    assert helpers.read_ban_changes(FakeRedis(keys=set()), None, 1000.0, 1060.0) is None
+    assert helpers.read_ban_changes(FakeRedis(keys=set()), bans, None, 1060.0) is None
+    assert helpers.read_ban_changes(FakeRedis(keys=set()), bans, 1000.0, 1000.0 + helpers.BAN_EVENTS_RETENTION) is None
+
+
+def test_load_sync_state_drops_invalid_bans(helpers):
+    raw = helpers.dump_sync_state({"account_id": "acc", "list_name": "bans", "list_id": "l1", "items": {}, "bans": [], "since": 42})
+    state = helpers.load_sync_state(raw, "acc", "bans")
+    assert "bans" not in state and "since" not in state
+
+
+# --- edge ban selection -----------------------------------------------------------
+
+
+def test_parse_ban_date(helpers):
+    assert helpers.parse_ban_date(b'{"reason": "bad behavior", "date": 1700000000}') == 1700000000.0
+    for raw in (None, b"", b"{oops", b"[]", b'{"date": "soon"}'):
+        assert helpers.parse_ban_date(raw) == 0.0
+
+
+def test_chunked(helpers):
+    assert list(helpers.chunked([1, 2, 3, 4, 5], 2)) == [[1, 2], [3, 4], [5]]
+    assert list(helpers.chunked([], 2)) == []
+
+
+def test_collapse_bans_disabled(helpers):
+    assert helpers.collapse_bans(["1.2.3.4", "1.2.3.5"], 0) == {"1.2.3.4": ["1.2.3.4"], "1.2.3.5": ["1.2.3.5"]}
+
+
+def test_collapse_bans_threshold(helpers):
+    ips = ["1.2.3.4", "1.2.3.5", "9.9.9.9", "2001:db8::1", "2001:db8::2", "not-an-ip"]
+    assert helpers.collapse_bans(ips, 2) == {
+        "1.2.3.0/24": ["1.2.3.4", "1.2.3.5"],
+        "2001:db8::/64": ["2001:db8::1", "2001:db8::2"],
+        "9.9.9.9": ["9.9.9.9"],
+        "not-an-ip": ["not-an-ip"],
+    }
+
+
+def test_select_bans_under_limit_keeps_all(helpers):
+    assert helpers.select_bans({"1.1.1.1": ["1.1.1.1"]}, {}, 10) == {"1.1.1.1"}
+
+
+def test_select_bans_by_recency_and_ttl(helpers):
+    items = {ip: [ip] for ip in ("1.1.1.1", "2.2.2.2", "3.3.3.3")}
+    meta = {"1.1.1.1": (float("inf"), 100.0), "2.2.2.2": (60.0, 300.0), "3.3.3.3": (600.0, 200.0)}
+    assert helpers.select_bans(items, meta, 2) == {"2.2.2.2", "3.3.3.3"}
+    assert helpers.select_bans(items, meta, 2, "ttl") == {"1.1.1.1", "3.3.3.3"}
+
+
+def test_select_bans_cidr_ranks_as_best_member(helpers):
+    items = {"1.2.3.0/24": ["1.2.3.4", "1.2.3.5"], "9.9.9.9": ["9.9.9.9"]}
+    meta = {"1.2.3.4": (60.0, 100.0), "1.2.3.5": (60.0, 500.0), "9.9.9.9": (60.0, 400.0)}
+    assert helpers.select_bans(items, meta, 1) == {"1.2.3.0/24"}
+
+
+def test_retry_after_seconds(helpers):
+    assert helpers.retry_after_seconds("3", 1.0) == 3.0
+    assert helpers.retry_after_seconds(None, 2.0) == 2.0
+    assert helpers.retry_after_seconds("Wed, 21 Oct 2015 07:28:00 GMT", 4.0) == 4.0
+    assert helpers.retry_after_seconds("-5", 1.0) == 0.0
+    assert helpers.retry_after_seconds("3600", 1.0) == 60.0
+    assert helpers.retry_after_seconds(None, 128.0) == 60.0
+
+
+# --- TokenBucket ------------------------------------------------------------------
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.now += delay
+
+
+def test_token_bucket_burst_then_rate(helpers):
+    clock = FakeClock()
+    bucket = helpers.TokenBucket(4.0, 2, clock=clock, wait=clock.sleep)
+    assert bucket.acquire() == 0.0
+    assert bucket.acquire() == 0.0
+    assert bucket.acquire() == pytest.approx(0.25)
+    assert clock.now == pytest.approx(0.25)
+
+
+def test_token_bucket_refills_up_to_capacity(helpers):
+    clock = FakeClock()
+    bucket = helpers.TokenBucket(1.0, 2, clock=clock, wait=clock.sleep)
+    bucket.acquire()
+    bucket.acquire()
+    clock.now += 100
+    assert [bucket.acquire() for _ in range(2)] == [0.0, 0.0]
+    assert bucket.acquire() == pytest.approx(1.0)
+
+
+# --- conditional downloads ----------------------------------------------------------
+
+
+def test_load_validators(helpers):
+    assert helpers.load_validators(b'{"https://x/": {"etag": "\\"abc\\""}}') == {"https://x/": {"etag": '"abc"'}}
+    for raw in (None, b"", b"{oops", b"[]"):
+        assert helpers.load_validators(raw) == {}
+
+
+def test_conditional_headers(helpers):
+    assert helpers.conditional_headers(None) == {}
+    assert helpers.conditional_headers({"etag": '"abc"', "last_modified": "Mon, 01 Jan 2024 00:00:00 GMT"}) == {
+        "If-None-Match": '"abc"',
+        "If-Modified-Since": "Mon, 01 Jan 2024 00:00:00 GMT",
+    }
+
+
+def test_response_validators(helpers):
+    assert helpers.response_validators({"ETag": '"abc"', "Content-Type": "text/plain"}) == {"etag": '"abc"'}
+    assert helpers.response_validators({}) == {}
+
+
+def test_serialize_ranges_hash_matches_content(helpers):
+    content, digest = helpers.serialize_ranges(["1.2.3.0/24", "2400:cb00::/32"])
+    assert content == b"1.2.3.0/24\n2400:cb00::/32\n"
+    assert digest == hashlib.sha512(content).hexdigest()
+
+
+def test_render_realip_conf_merges_ranges(helpers):
+    conf = helpers.render_realip_conf(["2400:cb00::/32", "10.0.0.0/24", "10.0.1.0/24", "10.0.0.5", "1.2.3.4", "bogus"]).decode()
+    assert conf.splitlines()[1:] == [
+        "set_real_ip_from 1.2.3.4/32;",
+        "set_real_ip_from 10.0.0.0/23;",
+        "set_real_ip_from 2400:cb00::/32;",
+    ]
+    assert conf.startswith("#")
+    assert conf.endswith(";\n")
@@ -1,9 +1,10 @@
 """Unit tests for every plugin's ``ui/actions.py``.
 
-The ``actions.py`` files are byte-identical apart from the plugin name, so one
-parametrized suite covers them all. Each module is loaded under a unique
-synthetic name to avoid the ``sys.modules`` collision that would otherwise make
-us test a single plugin many times. (authentik is excluded: it ships no
+The ``actions.py`` files share the same ping card, so one parametrized suite
+covers them all; cloudflare's extra metrics cards and virustotal's quota cards
+are tested at the end. Each module is loaded under a unique synthetic name to
+avoid the ``sys.modules`` collision that would otherwise make us test a single
+plugin many times. (authentik is excluded: it ships no
 ``ui/actions.py``.)
 """
 
@@ -54,3 +55,98 @@ def test_plugin_stub_is_noop(plugin):
     fn = getattr(module, plugin)
     assert callable(fn)
     assert fn() is None
+
+
+METRICS = {
+    "counters": {"trust_lru_hit": 90, "trust_cache_hit": 5, "trust_cache_miss": 5, "matcher_build": 2, "fail_open_error": 1},
+    "latency": {"peer_trust": {"buckets": [98, 1, 1, 0, 0, 0, 0], "count": 100, "sum_us": 900}},
+    "latency_buckets_us": [10, 50, 100, 500, 1000, 5000],
+    "workers": 2,
+}
+
+
+def test_cloudflare_metrics_are_summed_over_instances():
+    module = load_actions("cloudflare")
+    merged = module.merge_metrics(
+        [
+            {"bw-1": {"status": "success", "msg": METRICS}},
+            {"bw-2": {"status": "success", "msg": METRICS}},
+            {"bw-3": {"status": "error"}},
+            {"bw-4": {"status": "success", "msg": "cloudflare metrics are disabled"}},
+        ]
+    )
+    assert merged["workers"] == 4
+    assert merged["counters"]["trust_lru_hit"] == 180
+    assert merged["latency"]["peer_trust"] == {"buckets": [196, 2, 2, 0, 0, 0, 0], "count": 200}
+
+
+def test_cloudflare_metrics_cards(fake_ping_utils):
+    module = load_actions("cloudflare")
+    fake = fake_ping_utils(status="success", data=[{"bw-1": {"status": "success", "msg": METRICS}}])
+    ret = module.pre_render(bw_instances_utils=fake)
+    assert fake.data_called_with == "cloudflare/metrics"
+    assert ret["trust_cache"]["value"] == "95.0%"
+    # 98% of the checks took <= 10us, the 99th percentile falls in the <= 50us bucket.
+    assert ret["trust_latency"]["value"] == "≤ 50 µs"
+    assert ret["fail_open"]["value"] == 1
+    assert ret["matcher_builds"]["value"] == 2
+    assert ret["cert_latency"]["value"] == "n/a"
+
+
+def test_cloudflare_metrics_percentile_past_last_bucket():
+    module = load_actions("cloudflare")
+    histogram = {"buckets": [0, 0, 0, 0, 0, 0, 3], "count": 3}
+    assert module.percentile(histogram, [10, 50, 100, 500, 1000, 5000]) == "> 5000 µs"
+
+
+def test_cloudflare_metrics_failure_keeps_status(fake_ping_utils):
+    module = load_actions("cloudflare")
+    fake = fake_ping_utils(status="success", data_exc=RuntimeError("boom"))
+    ret = module.pre_render(bw_instances_utils=fake)
+    assert ret["ping_status"]["value"] == "success"
+    assert "error" not in ret
+    assert "trust_cache" not in ret
+
+
+QUOTA = {"per_minute": 4, "tokens": 1, "per_day": 500, "used_today": 120, "remaining_today": 380, "throttled": 3, "coalesced": 7}
+
+
+def test_virustotal_quota_is_summed_over_instances():
+    module = load_actions("virustotal")
+    merged = module.merge_quota(
+        [
+            {"bw-1": {"status": "success", "msg": QUOTA}},
+            {"bw-2": {"status": "success", "msg": QUOTA}},
+            {"bw-3": {"status": "error"}},
+            {"bw-4": {"status": "success", "msg": "Virustotal plugin not enabled"}},
+        ]
+    )
+    assert merged == {"per_day": 500, "used_today": 240, "throttled": 6, "coalesced": 14}
+
+
+def test_virustotal_quota_cards(fake_ping_utils):
+    module = load_actions("virustotal")
+    fake = fake_ping_utils(status="success", data=[{"bw-1": {"status": "success", "msg": QUOTA}}])
+    ret = module.pre_render(bw_instances_utils=fake)
+    assert fake.data_called_with == "virustotal/quota"
+    assert ret["quota_used"]["value"] == "120 / 500"
+    assert ret["quota_remaining"]["value"] == 380
+    assert ret["quota_saved"]["value"] == "3 / 7"
+
+
+def test_virustotal_quota_without_daily_limit(fake_ping_utils):
+    module = load_actions("virustotal")
+    quota = dict(QUOTA, per_day=0)
+    fake = fake_ping_utils(status="success", data=[{"bw-1": {"status": "success", "msg": quota}}])
+    ret = module.pre_render(bw_instances_utils=fake)
+    assert ret["quota_used"]["value"] == 120
+    assert ret["quota_remaining"]["value"] == "unlimited"
+
+
+def test_virustotal_quota_failure_keeps_status(fake_ping_utils):
+    module = load_actions("virustotal")
+    fake = fake_ping_utils(status="success", data_exc=RuntimeError("boom"))
+    ret = module.pre_render(bw_instances_utils=fake)
+    assert ret["ping_status"]["value"] == "success"
+    assert "error" not in ret
+    assert "quota_used" not in ret
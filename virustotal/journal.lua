@@ -0,0 +1,213 @@
+-- Persistent cache journal of the clamav and virustotal plugins. Cached values are
+-- queued in the datastore, appended to a journal file by worker 0 and loaded back into
+-- the datastore at init, so that a restart doesn't start from an empty cache. The lines
+-- of the file are counted, and it is compacted once it holds twice the cache size of them.
+--
+-- Appending and compacting both take a datastore lock : during a reload the exiting worker
+-- 0 flushes one last time while the new one already runs, and they must not write the
+-- file at the same time. A flush that can't take the lock leaves the queue for the next.
+--
+-- Each plugin ships its own copy (clamav/journal.lua and virustotal/journal.lua) so that
+-- it can be installed alone : keep them identical, spec/journal_spec.lua tests both.
+local floor = math.floor
+local open = io.open
+local rename = os.rename
+local concat = table.concat
+local ipairs = ipairs
+local tonumber = tonumber
+local tostring = tostring
+local setmetatable = setmetatable
+
+local _M = {}
+_M.__index = _M
+
+-- Queued lines past it are dropped until worker 0 catches up
+local QUEUE_MAX = 10000
+-- Longest time a flush may hold the lock, should its worker die while holding it
+local LOCK_TTL = 30
+
+-- Journal line of a cached value : "<key>\t<expiry>\t<value>\n", expiry being a unix time.
+function _M.journal_line(key, expiry, value)
+	return key .. "\t" .. tostring(floor(expiry)) .. "\t" .. (value:gsub("[\t\r\n]", " ")) .. "\n"
+end
+
+-- Parse a journal line (without its newline) into key, expiry and value, nil if malformed.
+function _M.parse_journal_line(line)
+	local key, expiry, value = line:match("^([^\t]+)\t(%d+)\t([^\t]+)$")
+	if not key then
+		return nil
+	end
+	return key, tonumber(expiry), value
+end
+
+-- Entries of a journal (an array of lines, oldest first) still worth keeping at time now :
+-- the last line of each key, if not expired, and at most cap of them, the least recently
+-- written going first. Returns an array of { key, expiry, value }, oldest first.
+function _M.compact_journal(lines, now, cap)
+	local last = {}
+	for i, line in ipairs(lines) do
+		local key = _M.parse_journal_line(line)
+		if key then
+			last[key] = i
+		end
+	end
+	local kept = {}
+	for i, line in ipairs(lines) do
+		local key, expiry, value = _M.parse_journal_line(line)
+		if key and last[key] == i and expiry > now then
+			kept[#kept + 1] = { key, expiry, value }
+		end
+	end
+	if #kept <= cap then
+		return kept
+	end
+	local newest = {}
+	for i = #kept - cap + 1, #kept do
+		newest[#newest + 1] = kept[i]
+	end
+	return newest
+end
+
+local function read_lines(path)
+	local f, err = open(path, "r")
+	if not f then
+		return nil, err
+	end
+	local lines = {}
+	for line in f:lines() do
+		lines[#lines + 1] = line
+	end
+	f:close()
+	return lines
+end
+
+-- Journal of the file at path, keeping at most cap values. Its datastore keys start with
+-- prefix (plugin_<id>). datastore is the plugin datastore wrapper : the list, counter,
+-- add() and ttl() operations it has no method for go to the shared dict behind it.
+function _M.new(datastore, logger, path, prefix, cap)
+	return setmetatable({
+		datastore = datastore,
+		dict = datastore.dict,
+		logger = logger,
+		path = path,
+		cap = cap,
+		queue = prefix .. "_journal_queue",
+		lines = prefix .. "_journal_lines",
+		lock = prefix .. "_journal_lock",
+		persist = prefix .. "_persist_",
+	}, _M)
+end
+
+-- Load the journal into the datastore, from init. Returns the number of values loaded
+-- (0 without a journal), or nil and an error.
+function _M:load()
+	local lines = read_lines(self.path)
+	if not lines then
+		return 0
+	end
+	local current = ngx.time()
+	local entries = _M.compact_journal(lines, current, self.cap)
+	for _, entry in ipairs(entries) do
+		local ok, err = self.datastore:set(self.persist .. entry[1], entry[3], entry[2] - current)
+		if not ok then
+			return nil, err
+		end
+	end
+	self.dict:set(self.lines, #lines)
+	return #entries
+end
+
+-- Take a value loaded from the journal out of the datastore. Returns the value and the
+-- seconds it has left, or nil if there is none (or it has expired).
+function _M:take(key)
+	local value = self.datastore:get(self.persist .. key)
+	if not value then
+		return nil
+	end
+	local ttl = self.dict:ttl(self.persist .. key)
+	if not ttl or ttl <= 0 then
+		return nil
+	end
+	self.datastore:delete(self.persist .. key)
+	return value, ttl
+end
+
+-- Queue a value for worker 0 to append to the journal (see flush).
+function _M:append(key, value, ttl)
+	local len = self.dict:llen(self.queue)
+	if len and len >= QUEUE_MAX then
+		return
+	end
+	local ok, err = self.dict:rpush(self.queue, _M.journal_line(key, ngx.now() + ttl, value))
+	if not ok then
+		self.logger:log(ngx.ERR, "can't queue value for the persistent cache " .. self.path .. " : " .. err)
+	end
+end
+
+-- Append the queued values to the journal, and compact it when it gets too big.
+function _M:flush()
+	local locked, err = self.dict:add(self.lock, true, LOCK_TTL)
+	if not locked then
+		if err ~= "exists" then
+			self.logger:log(ngx.ERR, "can't lock the persistent cache " .. self.path .. " : " .. err)
+		end
+		return
+	end
+	local lines = {}
+	while true do
+		local line = self.dict:lpop(self.queue)
+		if not line then
+			break
+		end
+		lines[#lines + 1] = line
+	end
+	if #lines > 0 then
+		local f
+		f, err = open(self.path, "a")
+		if not f then
+			self.dict:delete(self.lock)
+			self.logger:log(ngx.ERR, "can't open the persistent cache " .. self.path .. " : " .. err)
+			return
+		end
+		f:write(concat(lines))
+		f:close()
+		self.dict:incr(self.lines, #lines, 0)
+	end
+	if (self.dict:get(self.lines) or 0) > 2 * self.cap then
+		self:rewrite()
+	end
+	self.dict:delete(self.lock)
+end
+
+-- Rewrite the journal with only the values worth keeping (see compact_journal). The
+-- caller holds the lock.
+function _M:rewrite()
+	local lines, err = read_lines(self.path)
+	if not lines then
+		self.logger:log(ngx.ERR, "can't open the persistent cache " .. self.path .. " : " .. err)
+		return
+	end
+	local entries = _M.compact_journal(lines, ngx.time(), self.cap)
+	lines = {}
+	for i, entry in ipairs(entries) do
+		lines[i] = _M.journal_line(entry[1], entry[2], entry[3])
+	end
+	-- Written aside then renamed : the journal is never left half written
+	local f
+	f, err = open(self.path .. ".tmp", "w")
+	if not f then
+		self.logger:log(ngx.ERR, "can't compact the persistent cache " .. self.path .. " : " .. err)
+		return
+	end
+	f:write(concat(lines))
+	f:close()
+	local ok
+	ok, err = rename(self.path .. ".tmp", self.path)
+	if not ok then
+		self.logger:log(ngx.ERR, "can't compact the persistent cache " .. self.path .. " : " .. err)
+		return
+	end
+	self.dict:set(self.lines, #entries)
+end
+
+return _M
@@ -2,6 +2,25 @@ from logging import getLogger
 from traceback import format_exc
 
 
+def merge_quota(data):
+    """Sum the `GET /virustotal/quota` answers of every instance.
+
+    `data` is what `bw_instances_utils.get_data()` returns: one `{hostname: response}` dict per
+    instance, where a successful response carries the Lua `quota()` table in `msg`. The API key
+    quota is shared by every instance, so the limits are taken as is and the usage is summed.
+    """
+    total = {"per_day": 0, "used_today": 0, "throttled": 0, "coalesced": 0}
+    for instance in data or []:
+        for response in instance.values():
+            quota = response.get("msg") if isinstance(response, dict) else None
+            if not isinstance(quota, dict):
+                continue
+            total["per_day"] = quota.get("per_day", 0) or total["per_day"]
+            for name in ("used_today", "throttled", "coalesced"):
+                total[name] += quota.get(name, 0)
+    return total
+
+
 def pre_render(**kwargs):
     logger = getLogger("UI")
     ret = {
@@ -19,6 +38,24 @@ def pre_render(**kwargs):
         logger.debug(format_exc())
         logger.error(f"Failed to get virustotal ping: {e}")
         ret["error"] = "Could not retrieve the plugin status"
+        return ret
+
+    # The quota is informative only: failing to get it never marks the plugin in error.
+    try:
+        quota = merge_quota(kwargs["bw_instances_utils"].get_data("virustotal/quota"))
+    except BaseException as e:
+        logger.debug(format_exc())
+        logger.warning(f"Failed to get virustotal quota: {e}")
+        return ret
+
+    used = quota["used_today"]
+    cards = {
+        "quota_used": ("API REQUESTS TODAY", f"{used} / {quota['per_day']}" if quota["per_day"] else used),
+        "quota_remaining": ("API REQUESTS LEFT TODAY", max(quota["per_day"] - used, 0) if quota["per_day"] else "unlimited"),
+        "quota_saved": ("LOOKUPS THROTTLED / COALESCED", f"{quota['throttled']} / {quota['coalesced']}"),
+    }
+    for key, (title, value) in cards.items():
+        ret[key] = {"title": title, "value": value, "col-size": "col-12 col-md-6", "card-classes": "h-100"}
 
     return ret
 
@@ -1,6 +1,7 @@
 local cjson = require("cjson")
 local class = require("middleclass")
 local http = require("resty.http")
+local journal = require("virustotal.journal")
 local plugin = require("bunkerweb.plugin")
 local sha256 = require("resty.sha256")
 local str = require("resty.string")
@@ -11,7 +12,23 @@ local virustotal_helpers = require("virustotal.virustotal_helpers")
 local virustotal = class("virustotal", plugin)
 
 local ngx = ngx
+local INFO = ngx.INFO
+local WARN = ngx.WARN
 local ERR = ngx.ERR
+local worker = ngx.worker
+local ngx_timer = ngx.timer
+local now = ngx.now
+local update_time = ngx.update_time
+local spawn = ngx.thread.spawn
+local wait = ngx.thread.wait
+local kill = ngx.thread.kill
+local sleep = ngx.sleep
+local time = ngx.time
+local date = os.date
+local max = math.max
+local floor = math.floor
+local pairs = pairs
+local unpack = unpack or table.unpack
 local HTTP_INTERNAL_SERVER_ERROR = ngx.HTTP_INTERNAL_SERVER_ERROR
 local HTTP_OK = ngx.HTTP_OK
 local to_hex = str.to_hex
@@ -19,29 +36,131 @@ local http_new = http.new
 local has_variable = utils.has_variable
 local get_deny_status = utils.get_deny_status
 local tostring = tostring
+local tonumber = tonumber
+local ipairs = ipairs
 local decode = cjson.decode
 local encode = cjson.encode
+local lookup_interval = virustotal_helpers.lookup_interval
+local lookup_batch = virustotal_helpers.lookup_batch
+local fresh_ttl = virustotal_helpers.fresh_ttl
+local quota_summary = virustotal_helpers.quota_summary
+local journal_key = virustotal_helpers.journal_key
 
-local read_all = function(form)
-	while true do
-		local typ = form:read()
-		if not typ then
-			return
-		end
-		if typ == "eof" then
-			return
-		end
-	end
+-- Reports are cached for a day. In async IP mode, lookups are queued in the datastore
+-- (at most QUEUE_MAX IPs) and made by a background timer instead of the access phase.
+local CACHE_TTL = 86400
+local QUEUE = "plugin_virustotal_ip_queue"
+local QUEUE_MAX = 1024
+-- Queued IPs looked up per second without a quota (VIRUSTOTAL_REQUESTS_PER_MINUTE = 0)
+local QUEUE_BATCH = 8
+local PENDING = "not checked yet"
+-- Requests to VT API take a token from a bucket shared by every worker, refilled with one
+-- token every VIRUSTOTAL_REQUESTS_PER_MINUTE-th of a minute, up to a minute worth of them
+-- (no bucket when it is 0). Lookups past the quota are skipped, logged once a minute.
+local TOKENS = "plugin_virustotal_tokens"
+local THROTTLED = "plugin_virustotal_throttled"
+local THROTTLED_LOGGED = "plugin_virustotal_throttled_logged"
+local COALESCED = "plugin_virustotal_coalesced"
+-- Persistent cache of the reports (see virustotal/journal.lua), flushed every JOURNAL_INTERVAL
+-- seconds and holding up to VIRUSTOTAL_PERSISTENT_CACHE_SIZE of them.
+local JOURNAL = "/var/cache/bunkerweb/virustotal_reports.journal"
+local JOURNAL_INTERVAL = 5
+-- Per-worker journal of the persistent cache, built again only when
+-- VIRUSTOTAL_PERSISTENT_CACHE_SIZE changes.
+local journal_size_setting = nil
+local persistent_cache = nil
+
+-- Datastore key counting the requests sent today (UTC)
+local function used_key()
+	return "plugin_virustotal_used_" .. date("!%Y%m%d", time())
 end
 
 function virustotal:initialize(ctx)
 	-- Call parent initialize
 	plugin.initialize(self, "virustotal", ctx)
+	if self.variables["VIRUSTOTAL_PERSISTENT_CACHE"] == "yes" then
+		local size = self.variables["VIRUSTOTAL_PERSISTENT_CACHE_SIZE"]
+		if not persistent_cache or size ~= journal_size_setting then
+			journal_size_setting = size
+			persistent_cache =
+				journal.new(self.datastore, self.logger, JOURNAL, "plugin_virustotal", tonumber(size) or 10000)
+		end
+		self.journal = persistent_cache
+	end
+end
+
+-- True while worker 0 looks up queued IPs : a batch can outlast the timer interval, and
+-- the next runs leave it alone instead of piling up concurrent lookups.
+local looking_up = false
+
+local function quota_timer(premature, self)
+	if premature then
+		return
+	end
+	self:refill_token()
+	if self.variables["VIRUSTOTAL_IP_MODE"] == "async" and not looking_up then
+		looking_up = true
+		local ok, err = pcall(self.lookup_queued_ip, self)
+		looking_up = false
+		if not ok then
+			self.logger:log(ERR, "error while looking up queued IPs : " .. tostring(err))
+		end
+	end
+end
+
+-- Also runs (prematurely) when the worker exits, to write what is still queued.
+local function journal_timer(_, self)
+	self.journal:flush()
+end
+
+function virustotal:init()
+	-- Check if init is needed
+	local init_needed, err = has_variable("USE_VIRUSTOTAL", "yes")
+	if init_needed == nil then
+		return self:ret(false, "can't check USE_VIRUSTOTAL variable : " .. err)
+	end
+	if not init_needed or self.variables["VIRUSTOTAL_PERSISTENT_CACHE"] ~= "yes" then
+		return self:ret(true, "init not needed")
+	end
+	-- Load the persistent cache into the datastore
+	local loaded
+	loaded, err = self.journal:load()
+	if not loaded then
+		return self:ret(false, "can't load VirusTotal persistent cache into datastore : " .. err)
+	end
+	return self:ret(true, "loaded " .. tostring(loaded) .. " report(s) from the VirusTotal persistent cache")
 end
 
--- Todo : find a "ping" endpoint on VT API
--- function virustotal:init_worker()
--- end
+function virustotal:init_worker()
+	-- Check if worker is needed
+	local init_needed, err = has_variable("USE_VIRUSTOTAL", "yes")
+	if init_needed == nil then
+		return self:ret(false, "can't check USE_VIRUSTOTAL variable : " .. err)
+	end
+	if not init_needed or self.is_loading then
+		return self:ret(true, "init_worker not needed")
+	end
+	-- One worker refills the token bucket and makes the queued IP lookups for all of them.
+	if worker.id() ~= 0 then
+		return self:ret(true, "VirusTotal quota is handled in worker 0")
+	end
+	local ok
+	ok, err = ngx_timer.every(
+		lookup_interval(self.variables["VIRUSTOTAL_REQUESTS_PER_MINUTE"]),
+		quota_timer,
+		self
+	)
+	if not ok then
+		return self:ret(false, "can't create the VirusTotal quota timer : " .. err)
+	end
+	if self.journal then
+		ok, err = ngx_timer.every(JOURNAL_INTERVAL, journal_timer, self)
+		if not ok then
+			return self:ret(false, "can't create the VirusTotal persistent cache timer : " .. err)
+		end
+	end
+	return self:ret(true, "success")
+end
 
 function virustotal:access()
 	-- Check if enabled
@@ -58,6 +177,18 @@ function virustotal:access()
 		if not ok then
 			return self:ret(false, "error while checking if IP is malicious : " .. report)
 		end
+		if report == PENDING then
+			return self:ret(
+				true,
+				"IP " .. self.ctx.bw.remote_addr .. " is not checked by VirusTotal yet",
+				get_deny_status(),
+				nil,
+				{
+					id = "ip",
+					report = report,
+				}
+			)
+		end
 		if report and report ~= "clean" then
 			return self:ret(
 				true,
@@ -108,41 +239,134 @@ function virustotal:access()
 end
 
 function virustotal:check_ip()
+	local ip = self.ctx.bw.remote_addr
+	local async = self.variables["VIRUSTOTAL_IP_MODE"] == "async"
 	-- Check cache
-	local ok, report = self:is_in_cache("ip_" .. self.ctx.bw.remote_addr)
+	local ok, report = self:is_in_cache("ip_" .. ip)
 	if not ok then
 		return false, report
 	end
 	if report then
+		-- Stale-while-revalidate : a report close to expiry is still used while a new
+		-- one is fetched in the background.
+		if async and not self:is_fresh(ip) then
+			self:queue_ip(ip)
+		end
 		return true, report
 	end
-	-- Ask VT API
-	local found, response
-	ok, found, response = self:request("/ip_addresses/" .. self.ctx.bw.remote_addr)
-	if not ok then
-		return false, response
+	if not async then
+		return self:lookup_ip(ip)
 	end
-	local result = "clean"
-	if found then
-		result = self:get_result(response, "IP")
+	-- Unknown IP : let it through (or not) until the background lookup is done
+	self:queue_ip(ip)
+	if self.variables["VIRUSTOTAL_IP_PROVISIONAL"] == "deny" then
+		return true, PENDING
 	end
-	-- Add to cache
-	local err
-	ok, err = self:add_to_cache("ip_" .. self.ctx.bw.remote_addr, result)
+	return true, nil
+end
+
+-- Ask VT API about an IP and cache the report.
+function virustotal:lookup_ip(ip)
+	local ok, result = self:lookup("ip_" .. ip, "/ip_addresses/" .. ip, "IP")
 	if not ok then
-		return false, err
+		return false, result
+	end
+	if result and self.variables["VIRUSTOTAL_IP_MODE"] == "async" then
+		local err
+		ok, err = self.cachestore:set(
+			"plugin_virustotal_fresh_ip_" .. ip,
+			true,
+			fresh_ttl(CACHE_TTL, self.variables["VIRUSTOTAL_IP_REFRESH"])
+		)
+		if not ok then
+			self.logger:log(ERR, "can't cache IP report freshness : " .. err)
+		end
 	end
 	return true, result
 end
 
+-- Whether the cached report of an IP doesn't need a refresh yet. Its freshness is cached
+-- next to it, so the instances sharing the reports (through Redis) share it too. When
+-- the cache fails, the report is kept as it is rather than spending the quota on it.
+function virustotal:is_fresh(ip)
+	local ok, fresh = self.cachestore:get("plugin_virustotal_fresh_ip_" .. ip)
+	if not ok then
+		self.logger:log(ERR, "can't get IP report freshness from cache : " .. fresh)
+		return true
+	end
+	return fresh ~= nil
+end
+
+-- Queue an IP for lookup_queued_ip(). The datastore wrapper has no add() nor list
+-- operations : the shared dict behind it is used directly.
+function virustotal:queue_ip(ip)
+	local dict = ngx.shared.datastore
+	-- The marker keeps an IP from being queued twice
+	local ok, err = dict:add("plugin_virustotal_queued_ip_" .. ip, true, 3600)
+	if not ok then
+		if err ~= "exists" then
+			self.logger:log(ERR, "can't queue VirusTotal lookup of IP " .. ip .. " : " .. err)
+		end
+		return
+	end
+	local len = dict:llen(QUEUE)
+	if len and len >= QUEUE_MAX then
+		dict:delete("plugin_virustotal_queued_ip_" .. ip)
+		self.logger:log(WARN, "VirusTotal IP lookup queue is full, IP " .. ip .. " not queued")
+		return
+	end
+	len, err = dict:rpush(QUEUE, ip)
+	if not len then
+		dict:delete("plugin_virustotal_queued_ip_" .. ip)
+		self.logger:log(ERR, "can't queue VirusTotal lookup of IP " .. ip .. " : " .. err)
+	end
+end
+
+-- Look up the first queued IPs that still need it : one lookup per call, the timer
+-- calling it every VIRUSTOTAL_REQUESTS_PER_MINUTE-th of a minute, or up to QUEUE_BATCH
+-- of them every second when there is no quota.
+function virustotal:lookup_queued_ip()
+	local dict = ngx.shared.datastore
+	local per_minute = self.variables["VIRUSTOTAL_REQUESTS_PER_MINUTE"]
+	-- Leave the queue alone while requests use up the quota
+	if (tonumber(per_minute) or 0) > 0 and (dict:get(TOKENS) or 1) <= 0 then
+		return
+	end
+	local left = lookup_batch(per_minute, QUEUE_BATCH)
+	while left > 0 do
+		local ip, err = dict:lpop(QUEUE)
+		if not ip then
+			if err then
+				self.logger:log(ERR, "can't read VirusTotal IP lookup queue : " .. err)
+			end
+			return
+		end
+		dict:delete("plugin_virustotal_queued_ip_" .. ip)
+		-- Skip IPs refreshed since they were queued
+		if not self:is_fresh(ip) then
+			local ok, result = self:lookup_ip(ip)
+			if not ok then
+				self.logger:log(ERR, "error while checking if IP " .. ip .. " is malicious : " .. result)
+			elseif not result then
+				-- Throttled : try again later
+				self:queue_ip(ip)
+				return
+			end
+			left = left - 1
+		end
+	end
+end
+
 function virustotal:check_file()
-	-- Loop on files
-	local form, err = upload:new(4096, 512, true)
+	-- Hash every file of the form first : they are all looked up once it is read
+	local form, err = upload:new(tonumber(self.variables["VIRUSTOTAL_CHUNK_SIZE"]) or 4096, 512, true)
 	if not form then
 		return false, err
 	end
 	local sha = sha256:new()
 	local processing = nil
+	local checksums = {}
+	local seen = {}
 	while true do
 		-- Read part
 		local typ, res
@@ -165,52 +389,99 @@ function virustotal:check_file()
 			-- Body case : update checksum
 		elseif typ == "body" and processing then
 			sha:update(res)
-			-- Part end case : get final checksum and clamav result
+			-- Part end case : get final checksum
 		elseif typ == "part_end" and processing then
 			processing = nil
-			-- Compute checksum
 			local checksum = to_hex(sha:final())
 			sha:reset()
-			-- Check if file is in cache
-			local ok, cached = self:is_in_cache("file_" .. checksum)
-			if not ok then
-				self.logger:log(ERR, "can't check if file with checksum " .. checksum .. " is in cache : " .. cached)
-			elseif cached then
-				if cached ~= "clean" then
-					read_all(form)
-					return true, cached, checksum
-				end
-			else
-				-- Check if file is already present on VT
-				local found, response
-				ok, found, response = self:request("/files/" .. checksum)
-				if not ok then
-					read_all(form)
-					return false, found
-				end
-				local result = "clean"
-				if found then
-					result = self:get_result(response, "FILE")
-				end
-				-- Add to cache
-				ok, err = self:add_to_cache("file_" .. checksum, result)
-				if not ok then
-					read_all(form)
-					return false, err
-				end
-				-- Stop here if one file is detected
-				if result ~= "clean" then
-					read_all(form)
-					return true, result, checksum
-				end
+			-- The same file uploaded twice is only checked once
+			if not seen[checksum] then
+				seen[checksum] = true
+				checksums[#checksums + 1] = checksum
 			end
-			-- End of body case : no file detected
+			-- End of body case
 		elseif typ == "eof" then
-			return true
+			break
 		end
 	end
-	-- luacheck: ignore 511
-	return false, "malformed content"
+	-- Check cache first : a cached detection stops here, without any lookup
+	local misses = {}
+	for _, checksum in ipairs(checksums) do
+		local ok, cached = self:is_in_cache("file_" .. checksum)
+		if not ok then
+			self.logger:log(ERR, "can't check if file with checksum " .. checksum .. " is in cache : " .. cached)
+		elseif cached then
+			if cached ~= "clean" then
+				return true, cached, checksum
+			end
+		else
+			misses[#misses + 1] = checksum
+		end
+	end
+	return self:lookup_files(misses)
+end
+
+-- Light thread body of lookup_files()
+local function lookup_file(self, checksum)
+	update_time()
+	local start = now()
+	local ok, result = self:lookup("file_" .. checksum, "/files/" .. checksum, "FILE")
+	update_time()
+	self.logger:log(
+		INFO,
+		"VirusTotal lookup of file with checksum "
+			.. checksum
+			.. " took "
+			.. tostring(floor((now() - start) * 1000))
+			.. " ms"
+	)
+	return checksum, ok, result
+end
+
+-- Check if files are already present on VT, looking up to VIRUSTOTAL_FILE_CONCURRENCY of
+-- them at a time in light threads. The first detection stops the lookups still running
+-- (their locks expire by themselves) ; without any, the first error is returned, if any.
+function virustotal:lookup_files(checksums)
+	local concurrency = tonumber(self.variables["VIRUSTOTAL_FILE_CONCURRENCY"]) or 1
+	if concurrency < 1 then
+		concurrency = 1
+	end
+	local running = {}
+	local count = 0
+	local next_file = 1
+	local first_err = nil
+	while next_file <= #checksums or count > 0 do
+		while count < concurrency and next_file <= #checksums do
+			running[checksums[next_file]] = spawn(lookup_file, self, checksums[next_file])
+			count = count + 1
+			next_file = next_file + 1
+		end
+		local threads = {}
+		for _, thread in pairs(running) do
+			threads[#threads + 1] = thread
+		end
+		local ok, checksum, lookup_ok, result = wait(unpack(threads))
+		if not ok then
+			for _, thread in pairs(running) do
+				kill(thread)
+			end
+			return false, "lookup thread failed : " .. tostring(checksum)
+		end
+		running[checksum] = nil
+		count = count - 1
+		if not lookup_ok then
+			first_err = first_err or result
+		elseif result and result ~= "clean" then
+			for _, thread in pairs(running) do
+				kill(thread)
+			end
+			return true, result, checksum
+		end
+	end
+	if first_err then
+		return false, first_err
+	end
+	return true
 end
 
 function virustotal:get_result(response, type)
@@ -229,17 +500,189 @@ function virustotal:is_in_cache(key)
 	if not ok then
 		return false, data
 	end
+	if data == nil and self.journal then
+		data = self:restore(key)
+	end
 	return true, data
 end
 
 function virustotal:add_to_cache(key, value)
-	local ok, err = self.cachestore:set("plugin_virustotal_" .. key, value, 86400)
+	local ok, err = self.cachestore:set("plugin_virustotal_" .. key, value, CACHE_TTL)
 	if not ok then
 		return false, err
 	end
+	if self.journal then
+		self.journal:append(journal_key(key), value, CACHE_TTL)
+	end
+	return true
+end
+
+-- Move a report loaded from the persistent cache back into the cache. It is written to
+-- the journal again, which keeps the file in least recently used order for compaction.
+function virustotal:restore(key)
+	local report, ttl = self.journal:take(journal_key(key))
+	if not report then
+		return nil
+	end
+	local ok, err = self.cachestore:set("plugin_virustotal_" .. key, report, ttl)
+	if not ok then
+		self.logger:log(ERR, "can't cache report : " .. err)
+	end
+	self.journal:append(journal_key(key), report, ttl)
+	return report
+end
+
+-- Get the report of a key (ip_<addr> or file_<sha256>) from VT API and cache it. Lookups
+-- of the same key are coalesced across workers : one request is sent while the others
+-- wait, up to VIRUSTOTAL_TIMEOUT, for its report to be cached. A lookup past the quota
+-- is skipped : it succeeds without a report, like a lookup that wasn't needed.
+function virustotal:lookup(key, path, type)
+	local acquired = self:lock(key)
+	if acquired == false then
+		local report = self:wait_report(key)
+		if report then
+			ngx.shared.datastore:incr(COALESCED, 1, 0)
+			return true, report
+		end
+	end
+	local allowed, reason = self:take_token()
+	if not allowed then
+		if acquired then
+			self:unlock(key)
+		end
+		if ngx.shared.datastore:add(THROTTLED_LOGGED, true, 60) then
+			self.logger:log(WARN, reason .. ", lookups are skipped until it is available again")
+		end
+		return true, nil
+	end
+	local ok, found, response = self:request(path)
+	local result = found
+	if ok then
+		result = "clean"
+		if found then
+			result = self:get_result(response, type)
+		end
+		-- Add to cache
+		local err
+		ok, err = self:add_to_cache(key, result)
+		if not ok then
+			result = err
+		end
+	end
+	if acquired then
+		self:unlock(key)
+	end
+	return ok, result
+end
+
+-- Take the in-flight lock of a key. Returns true when taken, false when another request
+-- holds it and nil when it can't be checked (the lookup is then made without it).
+function virustotal:lock(key)
+	-- A request may wait on its connect, send and read timeouts
+	local ttl = (tonumber(self.variables["VIRUSTOTAL_TIMEOUT"]) or 1000) * 3 / 1000 + 1
+	local ok, err = ngx.shared.datastore:add("plugin_virustotal_lookup_" .. key, true, ttl)
+	if ok then
+		return true
+	end
+	if err == "exists" then
+		return false
+	end
+	self.logger:log(ERR, "can't lock VirusTotal lookup of " .. key .. " : " .. err)
+	return nil
+end
+
+function virustotal:unlock(key)
+	ngx.shared.datastore:delete("plugin_virustotal_lookup_" .. key)
+end
+
+-- Wait for the request holding the lock of a key to cache its report. Returns the report,
+-- or nil if the lock went away without one or VIRUSTOTAL_TIMEOUT passed.
+function virustotal:wait_report(key)
+	local deadline = now() + (tonumber(self.variables["VIRUSTOTAL_TIMEOUT"]) or 1000) / 1000
+	repeat
+		sleep(0.05)
+		-- The lock is checked first : a report cached just before it was released is seen.
+		local pending = ngx.shared.datastore:get("plugin_virustotal_lookup_" .. key)
+		local ok, report = self:is_in_cache(key)
+		if ok and report then
+			return report
+		end
+		if not pending then
+			return nil
+		end
+	until now() >= deadline
+	return nil
+end
+
+-- Take a token before a request to VT API, and count the request against the daily quota
+-- (VIRUSTOTAL_REQUESTS_PER_DAY). 0 disables a limit. incr() keeps both atomic across workers.
+function virustotal:take_token()
+	local dict = ngx.shared.datastore
+	local per_minute = tonumber(self.variables["VIRUSTOTAL_REQUESTS_PER_MINUTE"]) or 0
+	if per_minute > 0 then
+		-- A missing bucket starts full
+		local tokens, err = dict:incr(TOKENS, -1, per_minute)
+		if not tokens then
+			self.logger:log(ERR, "can't take a VirusTotal API token : " .. err)
+			return true
+		end
+		if tokens < 0 then
+			dict:incr(TOKENS, 1)
+			dict:incr(THROTTLED, 1, 0)
+			return false, "VirusTotal API quota reached (" .. tostring(per_minute) .. " requests per minute)"
+		end
+	end
+	local per_day = tonumber(self.variables["VIRUSTOTAL_REQUESTS_PER_DAY"]) or 0
+	local key = used_key()
+	local used = dict:incr(key, 1, 0, 172800)
+	if per_day > 0 and used and used > per_day then
+		dict:incr(key, -1)
+		if per_minute > 0 then
+			dict:incr(TOKENS, 1)
+		end
+		dict:incr(THROTTLED, 1, 0)
+		return false, "VirusTotal API daily quota reached (" .. tostring(per_day) .. " requests per day)"
+	end
 	return true
 end
 
+function virustotal:refill_token()
+	local dict = ngx.shared.datastore
+	local per_minute = tonumber(self.variables["VIRUSTOTAL_REQUESTS_PER_MINUTE"]) or 0
+	if per_minute <= 0 then
+		return
+	end
+	local tokens, err = dict:incr(TOKENS, 1, per_minute - 1)
+	if not tokens then
+		self.logger:log(ERR, "can't refill VirusTotal API tokens : " .. err)
+		return
+	end
+	if tokens > per_minute then
+		dict:incr(TOKENS, -1)
+	end
+end
+
+-- Quota usage of the instance, for the ping and quota APIs.
+function virustotal:quota()
+	local dict = ngx.shared.datastore
+	local per_minute = tonumber(self.variables["VIRUSTOTAL_REQUESTS_PER_MINUTE"]) or 0
+	local per_day = tonumber(self.variables["VIRUSTOTAL_REQUESTS_PER_DAY"]) or 0
+	local used = dict:get(used_key()) or 0
+	local quota = {
+		per_minute = per_minute,
+		tokens = per_minute > 0 and max(dict:get(TOKENS) or per_minute, 0) or nil,
+		per_day = per_day,
+		used_today = used,
+		throttled = dict:get(THROTTLED) or 0,
+		coalesced = dict:get(COALESCED) or 0,
+	}
+	if per_day > 0 then
+		quota.remaining_today = max(per_day - used, 0)
+	end
+	return quota
+end
+
+-- Callers take a token first (see take_token())
 function virustotal:request(url)
 	-- Get object
 	local httpc, err = http_new()
@@ -258,11 +701,16 @@ function virustotal:request(url)
 	while base_url:sub(-1) == "/" do
 		base_url = base_url:sub(1, -2)
 	end
+	-- Connections (and their TLS sessions) are kept alive for the next requests
+	local pool_size = tonumber(self.variables["VIRUSTOTAL_KEEPALIVE_POOL_SIZE"]) or 0
 	local res
 	res, err = httpc:request_uri(base_url .. url, {
 		headers = {
 			["x-apikey"] = self.variables["VIRUSTOTAL_API_KEY"],
 		},
+		keepalive = pool_size > 0,
+		keepalive_timeout = tonumber(self.variables["VIRUSTOTAL_KEEPALIVE_TIMEOUT"]),
+		keepalive_pool = pool_size,
 	})
 	if not res then
 		return false, err
@@ -271,6 +719,10 @@ function virustotal:request(url)
 	if res.status == 404 then
 		return true, false
 	end
+	-- The API disagrees with the bucket : hold requests until the next refill
+	if res.status == 429 then
+		ngx.shared.datastore:set(TOKENS, 0)
+	end
 	if res.status ~= 200 then
 		err = "received status " .. tostring(res.status) .. " from VT API"
 		local ok, data = pcall(decode, res.body)
@@ -301,6 +753,15 @@ function virustotal:api()
 			return self:ret(true, "Virustotal plugin not enabled")
 		end
 
+		-- Don't report the API down when only the quota is spent
+		if not self:take_token() then
+			return self:ret(
+				true,
+				"VirusTotal API quota reached, test data not sent : " .. quota_summary(self:quota()),
+				HTTP_OK
+			)
+		end
+
 		-- Send test data to virustotal virustotal
 		local ok, found, response =
 			self:request("/files/275a021bbfb6489e54d471899f7db9d1663fc695ec2fe2a2c4538aabf651fd0f") -- sha256 of eicar test file
@@ -314,7 +775,24 @@ function virustotal:api()
 				HTTP_INTERNAL_SERVER_ERROR
 			)
 		end
-		return self:ret(true, "test data sent to virustotal, response: " .. encode(response), HTTP_OK)
+		return self:ret(
+			true,
+			"test data sent to virustotal, response: "
+				.. encode(response)
+				.. ", quota : "
+				.. quota_summary(self:quota()),
+			HTTP_OK
+		)
+	end
+	if self.ctx.bw.uri == "/virustotal/quota" and self.ctx.bw.request_method == "GET" then
+		local check, err = has_variable("USE_VIRUSTOTAL", "yes")
+		if check == nil then
+			return self:ret(true, "error while checking variable USE_VIRUSTOTAL (" .. err .. ")")
+		end
+		if not check then
+			return self:ret(true, "Virustotal plugin not enabled")
+		end
+		return self:ret(true, self:quota(), HTTP_OK)
 	end
 	return self:ret(false, "success")
 end
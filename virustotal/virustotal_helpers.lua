@@ -1,6 +1,7 @@
 -- Pure helpers extracted from virustotal.lua so they can be unit-tested with
 -- busted outside the OpenResty runtime. No ngx/resty dependencies — see
 -- spec/virustotal_helpers_spec.lua.
+local tonumber = tonumber
 local tostring = tostring
 
 local _M = {}
@@ -16,4 +17,59 @@ function _M.evaluate(suspicious, malicious, susp_threshold, mal_threshold)
 	return "clean"
 end
 
+-- Seconds between two runs of the background lookups so that they stay within a quota
+-- of per_minute requests (every second when there is no quota : 0, unset or invalid).
+function _M.lookup_interval(per_minute)
+	per_minute = tonumber(per_minute)
+	if not per_minute or per_minute <= 0 then
+		return 1
+	end
+	return 60 / per_minute
+end
+
+-- Number of queued IPs looked up per run of the background lookups : one within a quota,
+-- up to batch of them when there is none.
+function _M.lookup_batch(per_minute, batch)
+	per_minute = tonumber(per_minute)
+	if not per_minute or per_minute <= 0 then
+		return batch
+	end
+	return 1
+end
+
+-- How long a cached report stays fresh : it is refreshed in the background once it is
+-- within refresh seconds of its expiry (at least one second, at most the cache TTL).
+function _M.fresh_ttl(cache_ttl, refresh)
+	refresh = tonumber(refresh) or 0
+	if refresh < 0 then
+		refresh = 0
+	end
+	if refresh >= cache_ttl then
+		return 1
+	end
+	return cache_ttl - refresh
+end
+
+-- One line summary of the quota table returned by virustotal:quota(), for the ping API.
+function _M.quota_summary(quota)
+	local summary = tostring(quota.used_today) .. " request(s) used today"
+	if quota.per_day > 0 then
+		summary = summary .. " out of " .. tostring(quota.per_day)
+	end
+	if quota.per_minute > 0 then
+		summary = summary .. ", " .. tostring(quota.tokens) .. "/" .. tostring(quota.per_minute) .. " left this minute"
+	end
+	return summary .. ", " .. tostring(quota.throttled) .. " throttled, " .. tostring(quota.coalesced) .. " coalesced"
+end
+
+-- Compact key of a report in the persistent cache journal : IPs are kept as is and file
+-- checksums cut to their first 32 hex digits (128 bits), enough to tell files apart.
+function _M.journal_key(key)
+	local checksum = key:match("^file_(%x+)$")
+	if checksum then
+		return "file_" .. checksum:sub(1, 32)
+	end
+	return key
+end
+
 return _M